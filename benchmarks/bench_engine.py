@@ -0,0 +1,412 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+End to end benchmark of the chain engine on synthetic chains, nothing leaves the machine: the AI nodes call a mock
+``Model`` that sleeps for a latency drawn from a distribution. The chain is ``depth`` layers of ``width`` nodes, node
+``i`` of a layer reads nodes ``i`` and ``i + 1`` of the layer before it and every ``ai_every``-th layer is AI nodes.
+
+It measures:
+
+- ``construction``: ``Chain.from_dag`` of the serialised chain
+- ``overhead``: a run with zero latency models, ie. the time spent in the engine itself
+- ``throughput``: ``concurrency`` runs in parallel with the latency distribution of the mock models
+- ``batch``: the same runs with ``Chain.batch`` against ``threaded_map`` over ``Chain.__call__``, with the same number
+  of threads (``concurrency * max_workers``)
+- ``memory``: the peak memory allocated by a single run
+
+The results are printed as JSON (and written to ``--out``) so they can be stored per release, pass an earlier result
+as ``--baseline`` to compare, the process exits with 1 when any metric regressed more than ``--tolerance``.
+
+    python3 benchmarks/bench_engine.py --width 8 --depth 6 --out results.json
+    python3 benchmarks/bench_engine.py --width 8 --depth 6 --baseline results.json
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import platform
+import tracemalloc
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import fire
+from tabulate import tabulate
+
+import chainfury.types as T
+from chainfury import (
+    programatic_actions_registry,
+    ai_actions_registry,
+    model_registry,
+    Chain,
+    Model,
+    Node,
+)
+from chainfury.utils import threaded_map
+from chainfury.version import __version__
+
+# metrics where a bigger number is better, every other metric is a time or a size
+HIGHER_IS_BETTER = {
+    "throughput.runs_per_s",
+    "async_throughput.runs_per_s",
+    "batch.runs_per_s",
+    "batch.threaded_map_runs_per_s",
+    "batch.speedup",
+}
+
+
+class MockModel(Model):
+    """Chat model that sleeps for a random latency and echoes the last message.
+
+    Args:
+        id (str): The id of the model.
+        dist (str): One of ``fixed``, ``uniform``, ``exponential`` or ``lognormal``.
+        mean_ms (float): The mean latency of a call in milliseconds.
+        seed (int, optional): Seed of the latency samples. Defaults to 0.
+    """
+
+    def __init__(self, id: str, dist: str, mean_ms: float, seed: int = 0):
+        super().__init__(id=id, description=f"{dist} latency around {mean_ms}ms")
+        if dist not in ("fixed", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {dist}")
+        self.dist = dist
+        self.mean_ms = mean_ms
+        self._random = random.Random(seed)
+
+    def latency_s(self) -> float:
+        mean = self.mean_ms / 1000
+        if mean <= 0:
+            return 0.0
+        if self.dist == "fixed":
+            return mean
+        if self.dist == "uniform":
+            return self._random.uniform(0, 2 * mean)
+        if self.dist == "exponential":
+            return self._random.expovariate(1 / mean)
+        # lognormal with sigma 1 has a long tail, the mean is exp(mu + 1/2)
+        return self._random.lognormvariate(0, 1) * mean / 1.6487212707
+
+    def chat(self, messages: List[Dict[str, str]], **kwargs):
+        delay = self.latency_s()
+        if delay:
+            time.sleep(delay)
+        return {"text": messages[-1]["content"][:64]}
+
+    async def achat(self, messages: List[Dict[str, str]], **kwargs):
+        delay = self.latency_s()
+        if delay:
+            await asyncio.sleep(delay)
+        return {"text": messages[-1]["content"][:64]}
+
+
+def bench_start(text: str) -> Tuple[str, Optional[Exception]]:
+    return text[::-1], None
+
+
+def bench_join(a: str, b: str) -> Tuple[str, Optional[Exception]]:
+    return (a[:32] + b[:32]).upper(), None
+
+
+programatic_actions_registry.register(
+    fn=bench_start, outputs={"out": (0,)}, node_id="bench-start"
+)
+programatic_actions_registry.register(
+    fn=bench_join, outputs={"out": (0,)}, node_id="bench-join"
+)
+
+
+def get_model(dist: str, mean_ms: float, seed: int) -> MockModel:
+    id = f"bench-mock-{dist}-{mean_ms}"
+    if not model_registry.has(id):
+        model_registry.register(MockModel(id, dist, mean_ms, seed))
+    return model_registry.get(id)  # type: ignore
+
+
+def build_dag(width: int, depth: int, ai_every: int, model_id: str) -> T.Dag:
+    """Serialised chain with ``depth`` layers of ``width`` nodes, the output is the first node of the last layer."""
+    ai_node = ai_actions_registry.to_action(
+        action_name="bench-ai",
+        node_id="bench-ai",
+        model_id=model_id,
+        model_params={},
+        fn={"messages": [{"role": "user", "content": "{{ a }} | {{ b }}"}]},
+        outputs={"out": ("text",)},
+    )
+
+    nodes = []
+    edges = []
+    for d in range(depth):
+        for i in range(width):
+            node_id = f"l{d}-{i}"
+            if d == 0:
+                cf_data = T.UINode.CFData(
+                    id="bench-start", type=Node.types.PROGRAMATIC, node={}
+                )
+            elif ai_every and d % ai_every == 0:
+                cf_data = T.UINode.CFData(
+                    id="bench-ai", type=Node.types.AI, node=ai_node.to_dict()
+                )
+            else:
+                cf_data = T.UINode.CFData(
+                    id="bench-join", type=Node.types.PROGRAMATIC, node={}
+                )
+            nodes.append(
+                T.UINode(
+                    id=node_id,
+                    cf_id=cf_data.id,
+                    cf_data=cf_data,
+                    position=T.UINode.Position(x=d * 100, y=i * 100),
+                    width=100,
+                    height=100,
+                )
+            )
+            if d == 0:
+                continue
+            for var, src in (("a", i), ("b", (i + 1) % width)):
+                edges.append(
+                    T.Edge(
+                        id=f"l{d - 1}-{src}/out-{node_id}/{var}",
+                        source=f"l{d - 1}-{src}",
+                        sourceHandle="out",
+                        target=node_id,
+                        targetHandle=var,
+                    )
+                )
+    return T.Dag(
+        nodes=nodes,
+        edges=edges,
+        sample={"text": "hello world"},
+        main_in="text",
+        main_out=f"l{depth - 1}-0/out",
+    )
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure_construction(dag: T.Dag, n: int) -> Dict[str, float]:
+    Chain.from_dag(dag, check_server=False)  # warmup
+    st = time.perf_counter()
+    for _ in range(n):
+        Chain.from_dag(dag, check_server=False)
+    return {"ms": (time.perf_counter() - st) / n * 1000}
+
+
+def measure_overhead(chain: Chain, n: int, max_workers: int) -> Dict[str, float]:
+    chain("warmup", max_workers=max_workers)
+    taken = []
+    for i in range(n):
+        st = time.perf_counter()
+        chain(f"run {i}", max_workers=max_workers)
+        taken.append(time.perf_counter() - st)
+    mean = sum(taken) / n
+    return {
+        "ms": mean * 1000,
+        "p95_ms": percentile(taken, 95) * 1000,
+        "us_per_node": mean / len(chain.nodes) * 1e6,
+    }
+
+
+def measure_throughput(
+    chain: Chain, runs: int, concurrency: int, max_workers: int
+) -> Dict[str, float]:
+    def _run(i: int) -> float:
+        st = time.perf_counter()
+        chain(f"run {i}", max_workers=max_workers)
+        return time.perf_counter() - st
+
+    with ThreadPoolExecutor(concurrency) as exe:
+        st = time.perf_counter()
+        taken = list(exe.map(_run, range(runs)))
+        wall = time.perf_counter() - st
+    return {
+        "runs_per_s": runs / wall,
+        "p50_ms": percentile(taken, 50) * 1000,
+        "p95_ms": percentile(taken, 95) * 1000,
+        "p99_ms": percentile(taken, 99) * 1000,
+    }
+
+
+def measure_async_throughput(chain: Chain, runs: int, concurrency: int):
+    async def _main():
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _run(i: int) -> float:
+            async with sem:
+                st = time.perf_counter()
+                await chain.acall(f"run {i}")
+                return time.perf_counter() - st
+
+        st = time.perf_counter()
+        taken = await asyncio.gather(*[_run(i) for i in range(runs)])
+        return list(taken), time.perf_counter() - st
+
+    taken, wall = asyncio.run(_main())
+    return {
+        "runs_per_s": runs / wall,
+        "p50_ms": percentile(taken, 50) * 1000,
+        "p95_ms": percentile(taken, 95) * 1000,
+    }
+
+
+def measure_batch(
+    chain: Chain, runs: int, concurrency: int, max_workers: int
+) -> Dict[str, float]:
+    inputs = [f"run {i}" for i in range(runs)]
+    st = time.perf_counter()
+    threaded_map(
+        lambda x: chain(x, max_workers=max_workers),
+        [(x,) for x in inputs],
+        max_threads=concurrency,
+    )
+    mapped = time.perf_counter() - st
+
+    st = time.perf_counter()
+    chain.batch(inputs, max_concurrency=concurrency * max_workers)
+    batched = time.perf_counter() - st
+    return {
+        "runs_per_s": runs / batched,
+        "threaded_map_runs_per_s": runs / mapped,
+        "speedup": mapped / batched,
+    }
+
+
+def measure_memory(chain: Chain, n: int, max_workers: int) -> Dict[str, float]:
+    chain("warmup", max_workers=max_workers)
+    peaks = []
+    for i in range(n):
+        tracemalloc.start()
+        chain(f"run {i}", max_workers=max_workers)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+    return {"peak_kib": sum(peaks) / n / 1024}
+
+
+def flatten(results: Dict[str, Any]) -> Dict[str, float]:
+    return {
+        f"{group}.{k}": v
+        for group, metrics in results["metrics"].items()
+        for k, v in metrics.items()
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float):
+    """Print the change of every metric against the baseline, returns the names of the metrics that regressed"""
+    now = flatten(current)
+    before = flatten(baseline)
+    rows = []
+    regressed = []
+    for k in now:
+        if k not in before or not before[k]:
+            continue
+        change = (now[k] - before[k]) / before[k]
+        worse = -change if k in HIGHER_IS_BETTER else change
+        if worse > tolerance:
+            regressed.append(k)
+        rows.append(
+            [
+                k,
+                f"{before[k]:.3f}",
+                f"{now[k]:.3f}",
+                f"{change * 100:+.1f}%",
+                "REGRESSED" if k in regressed else "",
+            ]
+        )
+    if baseline.get("params") != current["params"]:
+        print("warning: the baseline was run with different params", file=sys.stderr)
+    print(
+        tabulate(rows, headers=["metric", "baseline", "current", "change", ""]),
+        file=sys.stderr,
+    )
+    return regressed
+
+
+def main(
+    width: int = 4,
+    depth: int = 4,
+    ai_every: int = 2,
+    dist: str = "lognormal",
+    mean_ms: float = 20,
+    n: int = 50,
+    runs: int = 200,
+    concurrency: int = 8,
+    max_workers: int = 4,
+    seed: int = 0,
+    out: str = "",
+    baseline: str = "",
+    tolerance: float = 0.2,
+):
+    """Run the benchmark and print the results as JSON.
+
+    Args:
+        width (int, optional): Nodes per layer. Defaults to 4.
+        depth (int, optional): Number of layers. Defaults to 4.
+        ai_every (int, optional): Every these many layers are AI nodes, 0 for no AI nodes. Defaults to 2.
+        dist (str, optional): Latency distribution of the mock model for throughput. Defaults to "lognormal".
+        mean_ms (float, optional): Mean latency of the mock model for throughput. Defaults to 20.
+        n (int, optional): Repetitions for construction, overhead and memory. Defaults to 50.
+        runs (int, optional): Total runs for throughput. Defaults to 200.
+        concurrency (int, optional): Chains running in parallel for throughput. Defaults to 8.
+        max_workers (int, optional): ``max_workers`` of each chain run. Defaults to 4.
+        seed (int, optional): Seed of the latency samples. Defaults to 0.
+        out (str, optional): Also write the results to this file. Defaults to "".
+        baseline (str, optional): Results of an earlier run to compare against. Defaults to "".
+        tolerance (float, optional): Allowed relative regression against the baseline. Defaults to 0.2.
+    """
+    params = {
+        "width": width,
+        "depth": depth,
+        "ai_every": ai_every,
+        "dist": dist,
+        "mean_ms": mean_ms,
+        "n": n,
+        "runs": runs,
+        "concurrency": concurrency,
+        "max_workers": max_workers,
+        "seed": seed,
+    }
+
+    instant = get_model("fixed", 0, seed)
+    slow = get_model(dist, mean_ms, seed)
+    instant_dag = build_dag(width, depth, ai_every, instant.id)
+    instant_chain = Chain.from_dag(instant_dag, check_server=False)
+    slow_dag = build_dag(width, depth, ai_every, slow.id)
+    slow_chain = Chain.from_dag(slow_dag, check_server=False)
+
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "params": params,
+        "metrics": {
+            "construction": measure_construction(slow_dag, n),
+            "overhead": measure_overhead(instant_chain, n, max_workers),
+            "throughput": measure_throughput(
+                slow_chain, runs, concurrency, max_workers
+            ),
+            "async_throughput": measure_async_throughput(slow_chain, runs, concurrency),
+            "batch": measure_batch(slow_chain, runs, concurrency, max_workers),
+            "memory": measure_memory(instant_chain, n, max_workers),
+        },
+    }
+    print(json.dumps(results, indent=2))
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            regressed = compare(results, json.load(f), tolerance)
+        if regressed:
+            print(f"regressed: {regressed}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,88 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+Per call cost of preparing the inputs of a chain whose ``sample`` holds a large few-shot payload. Compares the old
+``deepcopy(sample)`` + ``update`` with the overlay mapping used by ``Chain`` now, and the full ``Chain.__call__``.
+
+    python3 benchmarks/bench_inputs.py --n_shots 2000 --n 200
+"""
+
+import copy
+import time
+import tracemalloc
+from typing import Tuple, Optional
+
+import fire
+from tabulate import tabulate
+
+from chainfury import programatic_actions_registry, Chain, Edge
+
+
+def bench_count_shots(text: str, shots: list) -> Tuple[int, Optional[Exception]]:
+    return len(shots), None
+
+
+def bench_echo(count: int) -> Tuple[int, Optional[Exception]]:
+    return count, None
+
+
+programatic_actions_registry.register(
+    fn=bench_count_shots, outputs={"count": (0,)}, node_id="bench-count_shots"
+)
+programatic_actions_registry.register(
+    fn=bench_echo, outputs={"count": (0,)}, node_id="bench-echo"
+)
+
+
+def deepcopy_inputs(sample, data):
+    # this is how Chain prepared the inputs before the overlay mapping
+    _data = copy.deepcopy(sample)
+    _data.update(data)
+    return _data
+
+
+def measure(fn, n: int):
+    fn()  # warmup
+    tracemalloc.start()
+    st = time.perf_counter()
+    for _ in range(n):
+        fn()
+    taken = time.perf_counter() - st
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return taken / n * 1000, peak / 1024
+
+
+def main(n_shots: int = 2000, n: int = 200):
+    sample = {
+        "text": "hello",
+        "shots": [
+            {"input": f"question {i} " * 20, "output": f"answer {i} " * 20}
+            for i in range(n_shots)
+        ],
+    }
+    chain = Chain(
+        nodes=[
+            programatic_actions_registry.get("bench-count_shots"),  # type: ignore
+            programatic_actions_registry.get("bench-echo"),  # type: ignore
+        ],
+        edges=[Edge("bench-count_shots", "count", "bench-echo", "count")],
+        sample=sample,
+        main_in="text",
+        main_out="bench-echo/count",
+    )
+
+    rows = []
+    for name, fn in [
+        ("inputs: deepcopy (before)", lambda: deepcopy_inputs(sample, {"text": "hi"})),
+        ("inputs: overlay (after)", lambda: chain._prepare_data("hi")),
+        ("Chain.__call__ (after)", lambda: chain("hi")),
+    ]:
+        ms, peak_kb = measure(fn, n)
+        rows.append([name, f"{ms:.3f}", f"{peak_kb:.1f}"])
+    print(f"sample with {n_shots} shots, {n} calls")
+    print(tabulate(rows, headers=["case", "ms / call", "peak KiB"]))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
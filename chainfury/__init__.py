@@ -13,6 +13,13 @@ from chainfury.utils import (
     DoNotRetryException,
     logger,
     CFEnv,
+    deadline_scope,
+    remaining_time,
+    IRRecord,
+    ir_to_dict,
+    BlobRef,
+    warm_process_pool,
+    shutdown_process_pool,
 )
 from chainfury.base import (
     Var,
@@ -23,7 +30,14 @@ from chainfury.base import (
     Edge,
     Tools,
     Action,
+    TokenDelta,
+    ChainTimeoutError,
+    OptimizeReport,
 )
+from chainfury.cache import CacheBackend, InMemoryCache, SQLiteCache, llm_cache_scope
+from chainfury.hedging import HedgePolicy, LatencyWindow
+from chainfury.checkpoint import Checkpoint, FileCheckpoint
+from chainfury.tracing import Span, Tracer, SummaryTracer, JSONLTracer, OTelTracer
 from chainfury.core import (
     model_registry,
     programatic_actions_registry,
@@ -31,6 +45,8 @@ from chainfury.core import (
     memory_registry,
     AIAction,
     Memory,
+    MapAction,
+    RouterAction,
 )
 from chainfury.client import get_client
 from chainfury.types import (
@@ -2,23 +2,63 @@
 
 import os
 import copy
+import asyncio
 import json
 import jinja2
 import inspect
-import datetime
+import time
+import queue
 import importlib
+import threading
 import traceback
+import weakref
 from pprint import pformat
 from functools import partial
-from typing import Any, Union, Optional, Dict, List, Tuple, Callable, Generator
-from collections import deque, defaultdict, Counter
+from contextlib import nullcontext
+from typing import (
+    Any,
+    Union,
+    Optional,
+    Dict,
+    List,
+    Tuple,
+    Callable,
+    Generator,
+    Iterable,
+    Mapping,
+    Set,
+)
+from collections import deque, defaultdict, Counter, ChainMap
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 import jinja2schema as j2s
 from jinja2schema import model as j2sm
 
 from tuneapi.utils import load_module_from_path, to_json, from_json
 
-from chainfury.utils import logger, terminal_top_with_text
+from chainfury.utils import (
+    logger,
+    terminal_top_with_text,
+    deadline_scope,
+    run_in_process,
+    arun_in_process,
+    CFEnv,
+    IRRecord,
+    ir_to_dict,
+    ir_from_dict,
+    spill_to_blob,
+    load_value,
+)
+from chainfury.cache import (
+    CacheBackend,
+    InMemoryCache,
+    hash_key,
+    llm_cache_scope,
+    llm_cache_enabled,
+)
+from chainfury.checkpoint import Checkpoint
+from chainfury.tracing import Span, Tracer, trace, nbytes, current_span, span_scope
+from chainfury.hedging import HedgePolicy, LatencyWindow, hedged_call, ahedged_call
 import chainfury.types as T
 
 
@@ -708,10 +748,88 @@ class Model:
         else:
             self.vars = []
         self.tags = tags
+        self.cache: Optional[CacheBackend] = None
+        self.concurrency_limit: Optional[threading.BoundedSemaphore] = None
+        self._max_concurrency: Optional[int] = None
+        self._async_limits: (
+            "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]"
+        ) = weakref.WeakKeyDictionary()
+        self.hedging: Optional[HedgePolicy] = None
 
     def __repr__(self) -> str:
         return f"Model('{self.id}')"
 
+    def set_hedging(self, policy: Optional[HedgePolicy]) -> "Model":
+        """Hedge the calls to this model, a call that is slower than the recent calls gets a duplicate and the first
+        response is used. Only use this when the calls are safe to repeat. Pass ``None`` to turn it off.
+
+        Args:
+            policy (Optional[HedgePolicy]): When to hedge, see ``HedgePolicy``.
+
+        Returns:
+            Model: The model itself so you can chain calls.
+        """
+        self.hedging = policy
+        return self
+
+    @property
+    def latency(self) -> LatencyWindow:
+        """The recent latency of this model id, tracked in ``model_registry``"""
+        from chainfury.core import model_registry
+
+        return model_registry.latency(self.id)
+
+    def _hedge_delay(self, hedging: Optional[HedgePolicy]) -> Optional[float]:
+        policy = hedging or getattr(self, "hedging", None)
+        return None if policy is None else policy.delay(self.latency)
+
+    def set_concurrency_limit(self, n: Optional[int]) -> "Model":
+        """Limit the number of calls to this model that can be in flight at the same time across all the chains in this
+        process, extra calls wait for a free slot. Use this to stay under the rate limits of the API when running
+        ``Chain.batch`` or parallel chains. Pass ``None`` to remove the limit. The async calls wait on an
+        ``asyncio.Semaphore`` of the same size per event loop instead of blocking a thread.
+
+        Args:
+            n (Optional[int]): The maximum number of concurrent calls.
+
+        Returns:
+            Model: The model itself so you can chain calls.
+        """
+        self.concurrency_limit = threading.BoundedSemaphore(n) if n else None
+        self._max_concurrency = n or None
+        self._async_limits = weakref.WeakKeyDictionary()
+        return self
+
+    def _async_limit(self) -> Optional[asyncio.Semaphore]:
+        # a semaphore is bound to the loop it is first used on, so each loop gets its own
+        n = getattr(self, "_max_concurrency", None)
+        if not n:
+            return None
+        loop = asyncio.get_running_loop()
+        sem = self._async_limits.get(loop)
+        if sem is None:
+            sem = self._async_limits[loop] = asyncio.Semaphore(n)
+        return sem
+
+    def set_cache(self, cache: Optional[CacheBackend]) -> "Model":
+        """Cache the responses of this model, calls with the exact same ``model_data`` are served from the ``cache``
+        instead of hitting the API again. Only successful responses are stored. Pass ``None`` to turn it off.
+
+        Args:
+            cache (Optional[CacheBackend]): The cache to use, eg. ``InMemoryCache`` or ``SQLiteCache``.
+
+        Returns:
+            Model: The model itself so you can chain calls.
+        """
+        self.cache = cache
+        return self
+
+    def _cache_key(self, model_data: Dict[str, Any], use_cache: bool) -> Optional[str]:
+        cache = getattr(self, "cache", None)
+        if cache is None or not use_cache or not llm_cache_enabled():
+            return None
+        return hash_key(self.id, self.default_mode, model_data)
+
     def to_dict(self, no_vars: bool = False) -> Dict[str, Any]:
         """Converts the model to a dictionary.
 
@@ -729,11 +847,19 @@ class Model:
             "tags": self.tags,
         }
 
-    def __call__(self, model_data: Dict[str, Any]) -> Tuple[Any, Optional[Exception]]:
-        """Calls the model with the given data.
+    def __call__(
+        self,
+        model_data: Dict[str, Any],
+        use_cache: bool = True,
+        hedging: Optional[HedgePolicy] = None,
+    ) -> Tuple[Any, Optional[Exception]]:
+        """Calls the model with the given data. The latency of every call is recorded in ``model_registry``.
 
         Args:
             model_data (Dict[str, Any]): The data to pass to the model.
+            use_cache (bool, optional): Read and write the response cache if one is set, see ``set_cache``. Defaults to True.
+            hedging (Optional[HedgePolicy], optional): Hedge this call with this policy instead of the one set with
+                ``set_hedging``. Defaults to None.
 
         Returns:
             Tuple[Any, Optional[Exception]]: The result of the model and the exception if any.
@@ -748,11 +874,133 @@ class Model:
             )
             assert self.fn is not None, f"Model {self.id} has no default mode"
 
-        try:
+        span = current_span()
+        if span is not None:
+            span.model_id = self.id
+
+        cache_key = self._cache_key(model_data, use_cache)
+        if cache_key is not None:
+            found, out = self.cache.get(cache_key)  # type: ignore
+            if found:
+                return out, None
+
+        latency = self.latency
+
+        def _call():
+            st = time.monotonic()
             out = fn(**model_data)
-            return out, None
+            latency.record(time.monotonic() - st)
+            return out
+
+        # the slot is taken before hedging, so the time spent waiting for it does not count towards the hedge delay
+        delay = self._hedge_delay(hedging)
+        try:
+            with getattr(self, "concurrency_limit", None) or nullcontext():
+                out = _call() if delay is None else hedged_call(_call, delay, latency)
+        except Exception as e:
+            return traceback.format_exc(), e
+        if cache_key is not None:
+            self.cache.set(cache_key, out)  # type: ignore
+        return out, None
+
+    async def acall(
+        self,
+        model_data: Dict[str, Any],
+        use_cache: bool = True,
+        hedging: Optional[HedgePolicy] = None,
+    ) -> Tuple[Any, Optional[Exception]]:
+        """Async version of ``__call__``, awaits ``achat`` or ``acompletion`` based on the default mode.
+
+        Args:
+            model_data (Dict[str, Any]): The data to pass to the model.
+            use_cache (bool, optional): Read and write the response cache if one is set, see ``set_cache``. Defaults to True.
+            hedging (Optional[HedgePolicy], optional): Hedge this call with this policy instead of the one set with
+                ``set_hedging``. Defaults to None.
+
+        Returns:
+            Tuple[Any, Optional[Exception]]: The result of the model and the exception if any.
+        """
+        if self.default_mode == Model.MODE_CHAT:
+            fn = self.achat
+        elif self.default_mode == Model.MODE_COMPLETION:
+            fn = self.acompletion
+        else:
+            logger.error(
+                f"Model {self.id} has no default mode. During initialisation pass a callable function as Model(fn = ...)"
+            )
+            assert self.fn is not None, f"Model {self.id} has no default mode"
+
+        span = current_span()
+        if span is not None:
+            span.model_id = self.id
+
+        cache_key = self._cache_key(model_data, use_cache)
+        if cache_key is not None:
+            found, out = self.cache.get(cache_key)  # type: ignore
+            if found:
+                return out, None
+
+        limit = self._async_limit()
+        latency = self.latency
+
+        async def _call():
+            st = time.monotonic()
+            out = await fn(**model_data)
+            latency.record(time.monotonic() - st)
+            return out
+
+        delay = self._hedge_delay(hedging)
+        try:
+            async with limit or nullcontext():
+                if delay is None:
+                    out = await _call()
+                else:
+                    out = await ahedged_call(_call, delay, latency)
         except Exception as e:
             return traceback.format_exc(), e
+        if cache_key is not None:
+            self.cache.set(cache_key, out)  # type: ignore
+        return out, None
+
+    @property
+    def can_stream(self) -> bool:
+        """True if this is a chat model that implements ``stream_chat``"""
+        return (
+            self.default_mode == Model.MODE_CHAT
+            and type(self).stream_chat is not Model.stream_chat
+        )
+
+    def stream(
+        self, model_data: Dict[str, Any], use_cache: bool = True
+    ) -> Generator[str, None, None]:
+        """Streams the response of the model chunk by chunk using ``stream_chat``. The full text is stored in the
+        response cache, on a cache hit the cached text is yielded as a single chunk.
+
+        Args:
+            model_data (Dict[str, Any]): The data to pass to the model, same as ``__call__``.
+            use_cache (bool, optional): Read and write the response cache if one is set. Defaults to True.
+
+        Yields:
+            str: The text deltas.
+        """
+        span = current_span()
+        if span is not None:
+            span.model_id = self.id
+
+        cache_key = self._cache_key(model_data, use_cache)
+        if cache_key is not None:
+            found, out = self.cache.get(cache_key)  # type: ignore
+            if found:
+                yield out
+                return
+
+        chunks = []
+        with getattr(self, "concurrency_limit", None) or nullcontext():
+            for chunk in self.stream_chat(**model_data):
+                chunks.append(chunk)
+                yield chunk
+        if cache_key is not None:
+            self.cache.set(cache_key, "".join(chunks))  # type: ignore
 
     def set_api_token(self, token: str) -> None:
         raise NotImplementedError(
@@ -775,6 +1023,26 @@ class Model:
             "stream_chat method is not implemented for this model"
         )
 
+    async def acompletion(self, prompt: str, **kwargs):
+        """Async text completion API, by default runs ``completion`` in a worker thread. Subclass to use native async
+        clients."""
+        return await asyncio.to_thread(self.completion, prompt, **kwargs)
+
+    async def achat(self, chat: T.Thread, **kwargs):
+        """Async chat API, by default runs ``chat`` in a worker thread. Subclass to use native async clients."""
+        return await asyncio.to_thread(self.chat, chat, **kwargs)
+
+    async def astream_chat(self, chat: T.Thread, **kwargs):
+        """Async streaming chat API, by default pulls each chunk of ``stream_chat`` in a worker thread. Subclass to use
+        native async clients."""
+        _end = object()
+        gen = await asyncio.to_thread(self.stream_chat, chat, **kwargs)
+        while True:
+            chunk = await asyncio.to_thread(next, gen, _end)
+            if chunk is _end:
+                break
+            yield chunk
+
 
 #
 # Node: Each box that is drag and dropped in the UI is a Node, it will tell what kind of things are
@@ -790,6 +1058,10 @@ class NodeType:
     """constant for the AI node type"""
     MEMORY = "memory"
     """constant for the memory node type"""
+    MAP = "map"
+    """constant for the map node type, runs an inner node for every item of a list"""
+    ROUTER = "router"
+    """constant for the router node type, only the downstream nodes of the routes it picks are run"""
 
 
 class Node:
@@ -805,6 +1077,10 @@ class Node:
         description: str = "",
         tags: List[str] = [],
         allow_callback: bool = False,
+        cache: Optional[CacheBackend] = None,
+        side_effect: bool = False,
+        timeout: Optional[float] = None,
+        executor: str = "thread",
     ):
         """Node is a single unit of computation in a Dag. All the actions are considered as nodes.
 
@@ -816,6 +1092,15 @@ class Node:
             outputs (List[Var]): The outputs of the node.
             description (str, optional): The description of the node. Defaults to "".
             tags (List[str], optional): The tags for the node. Defaults to [].
+            cache (Optional[CacheBackend], optional): Memoize the outputs of the node by a hash of its inputs, only use
+                this when ``fn`` is pure ie. the same inputs always give the same outputs. Defaults to None.
+            side_effect (bool, optional): The node does something outside the chain (eg. writes to a DB) so it is
+                never pruned, see ``Chain(prune=...)``. Defaults to False.
+            timeout (Optional[float], optional): Seconds this node is allowed to run for, the models called by it get
+                the time that is left as the ``timeout`` of their requests. Defaults to None.
+            executor (str, optional): Where ``fn`` runs, ``"thread"`` runs it on the thread of the chain and
+                ``"process"`` runs it in the shared process pool so CPU heavy programatic nodes do not hold the GIL of
+                the server. A ``fn`` that cannot be pickled runs on the thread. Defaults to "thread".
         """
         # some basic checks
         _valid_types = [
@@ -826,6 +1111,10 @@ class Node:
         for name, cnt in Counter([x.name for x in outputs]).most_common():
             if cnt > 1:
                 raise ValueError(f"Duplicate output name: {name} in node: {id}")
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Invalid executor: {executor}, ['thread', 'process']")
+        if executor == "process" and type != NodeType.PROGRAMATIC:
+            raise ValueError(f"Only programatic nodes can run in a process: {id}")
 
         # set the values
         self.id = id
@@ -836,6 +1125,10 @@ class Node:
         self.fn = fn
         self.tags = tags
         self.allow_callback = allow_callback
+        self.cache = cache
+        self.side_effect = side_effect
+        self.timeout = timeout
+        self.executor = executor
         self.templates = []
 
     def __repr__(self) -> str:
@@ -868,14 +1161,14 @@ class Node:
         Returns:
             Dict[str, Any]: The dictionary representation of the node.
         """
-        from chainfury.core import AIAction, Memory
+        from chainfury.core import AIAction, Memory, MapAction, RouterAction
 
         fn = {}
         name = self.id
         if isinstance(self.fn, AIAction):
             fn = self.fn.to_dict(no_vars=True)
             name = fn.pop("action_name")
-        elif isinstance(self.fn, Memory):
+        elif isinstance(self.fn, (Memory, MapAction, RouterAction)):
             fn = self.fn.to_dict()
         elif callable(self.fn):
             fn = {
@@ -892,6 +1185,10 @@ class Node:
             "fields": [field.to_dict() for field in self.fields],
             "outputs": [o.to_dict() for o in self.outputs],
             "allow_callback": self.allow_callback,
+            "pure": self.cache is not None,
+            "side_effect": self.side_effect,
+            "timeout": self.timeout,
+            "executor": self.executor,
         }
 
     @classmethod
@@ -913,16 +1210,25 @@ class Node:
         if not fn:
             raise ValueError(f"Invalid fn: {fn}")
 
-        from chainfury.core import AIAction, Memory
+        from chainfury.core import AIAction, Memory, MapAction, RouterAction
 
         node_type = data["type"]
         if node_type == NodeType.AI:
             fn = AIAction.from_dict(fn)
         elif node_type == NodeType.MEMORY:
             fn = Memory.from_dict(fn)
+        elif node_type == NodeType.MAP:
+            fn = MapAction.from_dict(fn)
+        elif node_type == NodeType.ROUTER:
+            fn = RouterAction.from_dict(fn)
         elif node_type == NodeType.PROGRAMATIC and isinstance(fn, dict):
             fn = getattr(importlib.import_module(fn["fn_module"]), fn["fn_name"])
 
+        side_effect = data.get("side_effect", False)
+        if node_type == NodeType.MEMORY:
+            # the writes always change the DB, this also covers the DAGs saved before side_effect was stored
+            side_effect = side_effect or not fn.read_mode
+
         return cls(
             id=data["id"],
             type=node_type,
@@ -931,6 +1237,10 @@ class Node:
             fields=fields,
             outputs=outputs,
             allow_callback=data.get("allow_callback", False),
+            cache=InMemoryCache() if data.get("pure", False) else None,
+            side_effect=side_effect,
+            timeout=data.get("timeout", None),
+            executor=data.get("executor", "thread"),
         )
 
     def to_json(self, indent=None) -> str:
@@ -956,53 +1266,184 @@ class Node:
         """
         return cls.from_dict(json.loads(data))
 
+    def _check_inputs(self, data: Dict[str, Any], print_thoughts: bool = False):
+        data_keys = set(data.keys())
+        template_keys = set([x.name for x in self.fields])
+        if not data_keys.issubset(template_keys):
+            raise ValueError(
+                f"Invalid keys passed to node '{self.id}': {data_keys - template_keys}"
+            )
+        if print_thoughts:
+            print(f"Node: {self.id}")
+            print("Inputs:\n------")
+            print(pformat(data))
+
+    def _polish_outputs(
+        self, _out: Any, print_thoughts: bool = False
+    ) -> Dict[str, Any]:
+        out = _out[0] if isinstance(_out, tuple) else _out
+        err = _out[1] if isinstance(_out, tuple) and len(_out) > 1 else None
+        if err:
+            raise err
+
+        # this is where we have to polish this outgoing result into the structure as configured in self.outputs
+        # the values are never written back on the ``Var`` objects, so a node can be called from many threads
+        logger.debug(f"> fn_out: {out}")
+        logger.debug(f"> OUTPUTS: {self.outputs}")
+        fout = {}
+        for o in self.outputs:
+            if self.type == NodeType.ROUTER and o.name not in out:
+                continue  # route that was not taken
+            _value = get_value_by_keys(out, o.loc)
+            logger.debug(f"  OP: {o.name}, {o.loc}, {_value}")
+            fout[o.name] = _value
+
+        if print_thoughts:
+            print("Outputs:\n-------")
+            print(pformat(fout))
+        return fout
+
+    def _cache_get(self, data: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict]]:
+        # outputs are copied in and out of the cache so a downstream node mutating its inputs does not poison it
+        if self.cache is None:
+            return None, None
+        cache_key = hash_key(self.id, data)
+        found, fout = self.cache.get(cache_key)
+        return cache_key, copy.deepcopy(fout) if found else None
+
+    def _cache_set(self, cache_key: Optional[str], fout: Dict[str, Any]) -> None:
+        if cache_key is not None:
+            self.cache.set(cache_key, copy.deepcopy(fout))  # type: ignore
+
+    def deadline(self, deadline: Optional[float] = None) -> Optional[float]:
+        """The ``time.monotonic()`` by which this node has to finish if it was started now, ie. the tighter of
+        ``deadline`` and the node's own ``timeout``.
+
+        Args:
+            deadline (Optional[float], optional): The deadline of the caller. Defaults to None.
+
+        Returns:
+            Optional[float]: The deadline or ``None`` if there is none.
+        """
+        if self.timeout is None:
+            return deadline
+        own = time.monotonic() + self.timeout
+        return own if deadline is None else min(own, deadline)
+
     def __call__(
-        self, data: Dict[str, Any], print_thoughts: bool = False
+        self,
+        data: Dict[str, Any],
+        print_thoughts: bool = False,
+        deadline: Optional[float] = None,
     ) -> Tuple[Any, Optional[Exception]]:
-        """Calls the node with the given data.
+        """Calls the node with the given data. If the node has a ``cache`` the outputs for the same ``data`` are served
+        from it instead of calling ``fn`` again.
 
         Args:
             data (Dict[str, Any]): The data to pass to the node.
             print_thoughts (bool, optional): Whether to print the thoughts of the node, useful for debugging. Defaults to False.
+            deadline (Optional[float], optional): The ``time.monotonic()`` by which the node has to finish, it is
+                available to ``fn`` through ``remaining_time``. Defaults to None.
 
         Returns:
             Tuple[Any, Optional[Exception]]: The result of the node and the exception if any.
         """
-        data_keys = set(data.keys())
-        template_keys = set([x.name for x in self.fields])
         try:
-            if not data_keys.issubset(template_keys):
-                raise ValueError(
-                    f"Invalid keys passed to node '{self.id}': {data_keys - template_keys}"
-                )
-            if print_thoughts:
-                print(f"Node: {self.id}")
-                print("Inputs:\n------")
-                print(pformat(data))
-
-            _out = self.fn(**data)  # type: ignore
-            out = _out[0] if isinstance(_out, tuple) else _out
-            err = _out[1] if isinstance(_out, tuple) and len(_out) > 1 else None
-            if err:
-                raise err
-
-            # this is where we have to polish this outgoing result into the structure as configured in self.outputs
-            logger.debug(f"> fn_out: {out}")
-            logger.debug(f"> OUTPUTS: {self.outputs}")
-            for o in self.outputs:
-                _value = get_value_by_keys(out, o.loc)
-                logger.debug(f"  OP: {o.name}, {o.loc}, {_value}")
-                o.set_value(_value)
-
-            fout = {o.name: o.value for o in self.outputs}
-            if print_thoughts:
-                print("Outputs:\n-------")
-                print(pformat(fout))
+            self._check_inputs(data, print_thoughts=print_thoughts)
+            cache_key, fout = self._cache_get(data)
+            if fout is not None:
+                return fout, None
+            with deadline_scope(self.deadline(deadline)):
+                if self.executor == "process":
+                    _out = run_in_process(self.fn, data)
+                else:
+                    _out = self.fn(**data)  # type: ignore
+            fout = self._polish_outputs(_out, print_thoughts=print_thoughts)
+            self._cache_set(cache_key, fout)
+            return fout, None
+        except Exception as e:
+            tb = traceback.format_exc()
+            return tb, e
+
+    async def acall(
+        self,
+        data: Dict[str, Any],
+        print_thoughts: bool = False,
+        deadline: Optional[float] = None,
+    ) -> Tuple[Any, Optional[Exception]]:
+        """Async version of ``__call__``. If the underlying ``fn`` has an ``acall`` method (like ``AIAction``) it is
+        awaited on the event loop, otherwise ``fn`` is run in a worker thread.
+
+        Args:
+            data (Dict[str, Any]): The data to pass to the node.
+            print_thoughts (bool, optional): Whether to print the thoughts of the node, useful for debugging. Defaults to False.
+            deadline (Optional[float], optional): The ``time.monotonic()`` by which the node has to finish. Defaults to None.
+
+        Returns:
+            Tuple[Any, Optional[Exception]]: The result of the node and the exception if any.
+        """
+        try:
+            self._check_inputs(data, print_thoughts=print_thoughts)
+            cache_key, fout = self._cache_get(data)
+            if fout is not None:
+                return fout, None
+            afn = getattr(self.fn, "acall", None)
+            with deadline_scope(self.deadline(deadline)):
+                # to_thread copies the context so the deadline is seen in the worker thread as well
+                if afn is not None:
+                    _out = await afn(**data)
+                elif self.executor == "process":
+                    _out = await arun_in_process(self.fn, data)
+                else:
+                    _out = await asyncio.to_thread(self.fn, **data)  # type: ignore
+            fout = self._polish_outputs(_out, print_thoughts=print_thoughts)
+            self._cache_set(cache_key, fout)
+            return fout, None
+        except Exception as e:
+            tb = traceback.format_exc()
+            return tb, e
+
+    def stream(
+        self,
+        data: Dict[str, Any],
+        print_thoughts: bool = False,
+        deadline: Optional[float] = None,
+    ) -> Generator[str, None, Tuple[Any, Optional[Exception]]]:
+        """Calls the node token by token, only for AI nodes whose ``fn`` has a ``stream`` method. The generator yields
+        the text deltas and returns the same ``(outputs, exception)`` tuple as ``__call__``.
+
+        Args:
+            data (Dict[str, Any]): The data to pass to the node.
+            print_thoughts (bool, optional): Whether to print the thoughts of the node, useful for debugging. Defaults to False.
+            deadline (Optional[float], optional): The ``time.monotonic()`` by which the node has to finish. Defaults to None.
+
+        Yields:
+            str: The text deltas.
+        """
+        try:
+            self._check_inputs(data, print_thoughts=print_thoughts)
+            deadline = self.deadline(deadline)
+            chunks = []
+            stream = self.fn.stream(**data)  # type: ignore
+            while True:
+                # same as the span in Chain._stream_step, the deadline is set around each step and not across the yield
+                with deadline_scope(deadline):
+                    chunk = next(stream, _STREAM_END)
+                if chunk is _STREAM_END:
+                    break
+                chunks.append(chunk)
+                yield chunk
+            fout = self._polish_outputs("".join(chunks), print_thoughts=print_thoughts)
             return fout, None
         except Exception as e:
             tb = traceback.format_exc()
             return tb, e
 
+    @property
+    def can_stream(self) -> bool:
+        """True if the node can be called with ``stream``"""
+        return self.type == NodeType.AI and getattr(self.fn, "can_stream", False)
+
     @classmethod
     def from_chat(
         cls,
@@ -1025,13 +1466,26 @@ class Node:
                 )
             templates.append((obj, jinja2.Template(obj), field[0]))
 
-        def fn(**data: Dict[str, Any]):
+        def _render(data: Dict[str, Any]) -> Dict[str, Any]:
             fn_out = copy.deepcopy(chat_dict)
             for raw, t, keys in templates:
                 value = t.render(data)
                 put_value_by_keys(fn_out, keys, value)
-            # print(fn_out)
-            return model(fn_out)
+            return fn_out
+
+        def fn(**data: Dict[str, Any]):
+            return model(_render(data), use_cache=fn.use_cache)  # type: ignore
+
+        async def afn(**data: Dict[str, Any]):
+            return await model.acall(_render(data), use_cache=fn.use_cache)  # type: ignore
+
+        def sfn(**data: Dict[str, Any]):
+            return model.stream(_render(data), use_cache=fn.use_cache)  # type: ignore
+
+        fn.acall = afn  # type: ignore
+        fn.stream = sfn  # type: ignore
+        fn.can_stream = model.can_stream  # type: ignore
+        fn.use_cache = True  # type: ignore
 
         self = cls(
             id=node_id,
@@ -1043,6 +1497,102 @@ class Node:
         )
         return self
 
+    @classmethod
+    def from_map(
+        cls,
+        node: "Node",
+        over: str,
+        node_id: str = "",
+        max_workers: int = 4,
+        description: str = "",
+    ) -> "Node":
+        """Creates a map node that runs ``node`` for every item of the list input ``over``, with at most
+        ``max_workers`` items running at the same time. The other inputs are passed to every call and each output of
+        ``node`` becomes a list with the value for each item in order.
+
+        Example:
+            >>> summarise = ai_actions_registry.to_action(...)  # has the field "document"
+            >>> summarise_all = Node.from_map(summarise, over="document", max_workers=8)
+            >>> summarise_all({"document": ["doc 1", "doc 2"]})
+            ({'summary': ['summary 1', 'summary 2']}, None)
+
+        Args:
+            node (Node): The node to run for each item.
+            over (str): The field of ``node`` that gets the items.
+            node_id (str, optional): The id of the map node. Defaults to ``"<node.id>-map"``.
+            max_workers (int, optional): The maximum number of items that are run at the same time. Defaults to 4.
+            description (str, optional): The description of the map node. Defaults to "".
+
+        Returns:
+            Node: The map node.
+        """
+        from chainfury.core import MapAction
+
+        node_id = node_id or f"{node.id}-map"
+        fn = MapAction(node_id=node_id, node=node, over=over, max_workers=max_workers)
+        return cls(
+            id=node_id,
+            type=NodeType.MAP,
+            fn=fn,
+            fields=fn.fields,
+            outputs=fn.outputs,
+            description=description or f"Runs '{node.id}' for every item of '{over}'",
+        )
+
+    @classmethod
+    def from_router(
+        cls,
+        node: "Node",
+        routes: List[str],
+        node_id: str = "",
+        passthrough: str = "",
+        default: str = "",
+        description: str = "",
+    ) -> "Node":
+        """Creates a router node. ``node`` picks the route, its first output must be the name of a route or a list of
+        names, and the router has one output per route. Only the routes that were picked get a value (the input
+        ``passthrough``), the nodes of a ``Chain`` whose inputs all come from routes that were not picked are skipped.
+
+        Example:
+            >>> def intent(message: str):
+            ...     return ("billing" if "invoice" in message else "support"), None
+            >>> classify = programatic_actions_registry.to_action(intent, {"route": (0,)}, "intent")
+            >>> router = Node.from_router(classify, routes=["billing", "support"])
+            >>> router({"message": "where is my invoice?"})
+            ({'billing': 'where is my invoice?'}, None)
+
+        Args:
+            node (Node): The node that picks the route.
+            routes (List[str]): The names of the routes, these are the outputs of the router.
+            node_id (str, optional): The id of the router node. Defaults to ``"<node.id>-router"``.
+            passthrough (str, optional): The field whose value is sent on the routes that were picked. Defaults to the
+                first field of ``node``.
+            default (str, optional): The route to take when ``node`` picks an unknown route, if not passed an unknown
+                route is an error. Defaults to "".
+            description (str, optional): The description of the router node. Defaults to "".
+
+        Returns:
+            Node: The router node.
+        """
+        from chainfury.core import RouterAction
+
+        node_id = node_id or f"{node.id}-router"
+        fn = RouterAction(
+            node_id=node_id,
+            node=node,
+            routes=routes,
+            passthrough=passthrough,
+            default=default,
+        )
+        return cls(
+            id=node_id,
+            type=NodeType.ROUTER,
+            fn=fn,
+            fields=node.fields,
+            outputs=fn.outputs,
+            description=description or f"Routes by '{node.id}' to {routes}",
+        )
+
 
 #
 # Edge: Each connection between two boxes on the UI is called an Edge, it is only a dataclass without any methods.
@@ -1110,6 +1660,213 @@ class Edge:
         )
 
 
+#
+# Plan: Compiled form of the Chain that is used by the executors, built once and shared by all the runs.
+#
+
+
+class NodePlan:
+    """Everything the executor needs to know about a node, precomputed from the nodes and edges of the chain.
+
+    Args:
+        node (Node): The node.
+        order (int): The position of the node in the topological order.
+        incoming (Tuple[Tuple[str, str], ...]): The ``(src_key, trg_var)`` pairs of all the incoming edges.
+        parents (Tuple[str, ...]): The ids of the upstream nodes.
+        children (Tuple[str, ...]): The ids of the downstream nodes.
+    """
+
+    __slots__ = (
+        "id",
+        "node",
+        "order",
+        "prefix",
+        "fields",
+        "prefixed_fields",
+        "incoming",
+        "parents",
+        "children",
+        "output_keys",
+    )
+
+    def __init__(
+        self,
+        node: Node,
+        order: int,
+        incoming: Tuple[Tuple[str, str], ...],
+        parents: Tuple[str, ...],
+        children: Tuple[str, ...],
+    ):
+        self.id = node.id
+        self.node = node
+        self.order = order
+        self.prefix = node.id + "/"
+        self.fields = frozenset(x.name for x in node.fields)
+        self.prefixed_fields = tuple((self.prefix + x, x) for x in self.fields)
+        self.incoming = incoming
+        self.parents = parents
+        self.children = children
+        self.output_keys = {o.name: self.prefix + o.name for o in node.outputs}
+
+    def __repr__(self) -> str:
+        return (
+            f"NodePlan('{self.id}', parents={self.parents}, children={self.children})"
+        )
+
+
+class ChainPlan:
+    """Compiled execution plan of a ``Chain``. This is immutable and does not hold any per-run state, so a single plan
+    is shared by all the (concurrent) runs of the chain.
+
+    Args:
+        nodes (Dict[str, Node]): The nodes of the chain.
+        edges (List[Edge]): The edges of the chain.
+        topo_order (List[str]): The topological order of the node ids.
+    """
+
+    __slots__ = ("order", "nodes", "indegree", "prefixed_inputs", "routers")
+
+    def __init__(
+        self,
+        nodes: Dict[str, Node],
+        edges: List[Edge],
+        topo_order: List[str],
+    ):
+        incoming = defaultdict(list)
+        parents = defaultdict(list)
+        children = defaultdict(list)
+        for edge in edges:
+            incoming[edge.trg_node_id].append((edge.source, edge.trg_node_var))
+            if edge.src_node_id not in parents[edge.trg_node_id]:
+                parents[edge.trg_node_id].append(edge.src_node_id)
+            if edge.trg_node_id not in children[edge.src_node_id]:
+                children[edge.src_node_id].append(edge.trg_node_id)
+
+        self.order: Tuple[str, ...] = tuple(topo_order)
+        self.nodes: Dict[str, NodePlan] = {
+            node_id: NodePlan(
+                node=nodes[node_id],
+                order=i,
+                incoming=tuple(incoming[node_id]),
+                parents=tuple(parents[node_id]),
+                children=tuple(children[node_id]),
+            )
+            for i, node_id in enumerate(topo_order)
+        }
+        self.indegree: Dict[str, int] = {
+            node_id: len(p.parents) for node_id, p in self.nodes.items()
+        }
+        self.prefixed_inputs = frozenset(
+            k for p in self.nodes.values() for k, _ in p.prefixed_fields
+        )
+        self.routers = frozenset(
+            node_id
+            for node_id, p in self.nodes.items()
+            if p.node.type == NodeType.ROUTER
+        )
+
+    def __repr__(self) -> str:
+        return f"ChainPlan({len(self.nodes)} nodes, order={list(self.order)})"
+
+    def remaining(self, only: Optional[Set[str]] = None) -> Dict[str, int]:
+        """Returns a fresh copy of the number of upstream nodes each node is waiting for, this is per-run state. If
+        ``only`` is passed then only the nodes in it are counted, the rest are considered done.
+        """
+        if only is None:
+            return dict(self.indegree)
+        return {
+            node_id: sum(1 for p in self.nodes[node_id].parents if p in only)
+            for node_id in only
+        }
+
+    def upstream(self, node_ids: Iterable[str]) -> Set[str]:
+        """Returns ``node_ids`` and all the nodes they (transitively) depend on."""
+        out = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in out:
+                out.add(node_id)
+                stack.extend(self.nodes[node_id].parents)
+        return out
+
+    def downstream(self, node_ids: Iterable[str]) -> Set[str]:
+        """Returns ``node_ids`` and all the nodes that (transitively) depend on them."""
+        out = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in out:
+                out.add(node_id)
+                stack.extend(self.nodes[node_id].children)
+        return out
+
+
+class OptimizeReport:
+    """What ``Chain.optimize`` changed in the chain.
+
+    Args:
+        merged (Dict[str, str]): The duplicate nodes that were removed and the node that now gives their outputs, ie.
+            ``full_ir["dup/out"]`` is now in ``full_ir[merged["dup"] + "/out"]``.
+        removed (List[str]): The nodes that were removed because nothing used their outputs.
+        edges_before (int): The number of edges before.
+        edges_after (int): The number of edges after.
+    """
+
+    __slots__ = ("merged", "removed", "edges_before", "edges_after")
+
+    def __init__(
+        self,
+        merged: Dict[str, str],
+        removed: List[str],
+        edges_before: int,
+        edges_after: int,
+    ):
+        self.merged = merged
+        self.removed = removed
+        self.edges_before = edges_before
+        self.edges_after = edges_after
+
+    def __repr__(self) -> str:
+        return (
+            f"OptimizeReport(merged={self.merged}, removed={self.removed}, "
+            f"edges={self.edges_before}->{self.edges_after})"
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.merged or self.removed)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "merged": self.merged,
+            "removed": self.removed,
+            "edges_before": self.edges_before,
+            "edges_after": self.edges_after,
+        }
+
+
+class TokenDelta:
+    """Event yielded by ``Chain.stream(..., stream_tokens=True)`` for every chunk of text the model streams for
+    ``main_out``, the full value still comes as a regular IR dict once the node completes.
+
+    Args:
+        key (str): The IR key this text is for, ie. the ``main_out`` of the chain.
+        delta (str): The new chunk of text.
+    """
+
+    __slots__ = ("key", "delta")
+
+    def __init__(self, key: str, delta: str):
+        self.key = key
+        self.delta = delta
+
+    def __repr__(self) -> str:
+        return f"TokenDelta('{self.key}', {self.delta!r})"
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"key": self.key, "delta": self.delta}
+
+
 #
 # Dag: An entire flow is called the Chain
 #
@@ -1118,12 +1875,27 @@ class Edge:
 class Chain:
     """A chain is a DAG with nodes and edges.
 
+    Thread safety: running a chain (``__call__``, ``stream``, ``acall``, ``astream`` and ``step`` with your own
+    ``pre_data`` and ``full_ir``) never mutates the chain, its nodes or their ``Var`` objects. All the per-run state
+    lives in the inputs and the IR buffer of that run, so a single ``Chain`` object can be built once, cached and
+    shared by any number of concurrent runs across threads or tasks. Building methods like ``add_thread`` or
+    ``compile`` are not safe to call while the chain is running.
+
     Args:
         nodes (List[Node], optional): The list of nodes in the chain. Defaults to [].
         edges (List[Edge], optional): The list of edges in the chain. Defaults to [].
         sample (Dict[str, Any], optional): The sample data to use for the chain. Defaults to {}.
         main_in (str, optional): The name of the input var for the chat input. Defaults to "".
         main_out (str, optional): The name of the output var for the chat output. Defaults to "".
+        llm_cache (bool, optional): When False the AI nodes of this chain bypass the response cache of their models,
+            use it for chains sampling with a non zero temperature where every call should be fresh. Defaults to True.
+        prune (bool, optional): Only run the nodes that ``main_out`` depends on, along with the nodes marked as
+            ``side_effect`` and their dependencies. Leftover nodes are skipped. Defaults to False.
+        spill_bytes (Optional[int], optional): Node outputs larger than this many bytes (as JSON) are stored with
+            ``store_blob`` and the IR only keeps a ``BlobRef``, which is loaded when a downstream node reads it. ``0``
+            keeps everything in memory. Defaults to ``CF_SPILL_BYTES``.
+        optimize (bool, optional): Run ``optimize`` on the chain once it is built, the duplicate nodes are merged
+            and the unused nodes are removed. What changed is in ``optimize_report``. Defaults to False.
     """
 
     def __init__(
@@ -1136,17 +1908,30 @@ class Chain:
         sample: Dict[str, Any] = {},
         main_in: str = "",
         main_out: str = "",
+        llm_cache: bool = True,
+        prune: bool = False,
+        spill_bytes: Optional[int] = None,
+        optimize: bool = False,
     ):
         # assign variables
         self.name = name
         self.description = description
         self.default_model = default_model
         self.chain_id: Optional[str] = None
+        self.llm_cache = llm_cache
+        self.prune = prune
+        self.spill_bytes = (
+            CFEnv.CF_SPILL_BYTES() if spill_bytes is None else spill_bytes
+        )
+        self.tracers: List[Tracer] = []
+        self.optimize_report: Optional[OptimizeReport] = None
+        self._merged: Dict[str, str] = {}
+        self._plan: Optional[ChainPlan] = None
 
         # perform checks and validations
         self.is_empty = not nodes and not edges
         self.nodes: Dict[str, Node] = {node.id: node for node in nodes}
-        self.edges = edges
+        self.edges = list(edges)  # own copy, add_thread appends to this
 
         if len(self.nodes) == 1:
             if len(self.edges) != 0:
@@ -1197,8 +1982,12 @@ class Chain:
         for node_id in self.topo_order:
             assert node_id in self.nodes, f"Missing node from an edge: {node_id}"
 
+        if optimize:
+            self.optimize()
+
         # to a dry run to validate everything
         self.to_dict()
+        self.compile()
 
     def __repr__(self) -> str:
         out = "Chain(\n  nodes: ["
@@ -1210,14 +1999,146 @@ class Chain:
         out += f"\n  ]\n  main_in: {self.main_in}\n  main_out: {self.main_out}\n)"
         return out
 
-    # building of chain
+    @property
+    def plan(self) -> ChainPlan:
+        """The compiled execution plan of this chain, built on first access. If you modify ``nodes`` or ``edges`` by
+        hand call ``compile`` again."""
+        if self._plan is None:
+            self._plan = ChainPlan(self.nodes, self.edges, self.topo_order)
+        return self._plan
 
-    def add_thread(
-        self,
-        node_id: str,
-        thread: T.Thread,
-        model: Optional[Model] = None,
-        description: str = "",
+    def compile(self) -> ChainPlan:
+        """(Re)build the execution plan from the current nodes and edges.
+
+        Returns:
+            ChainPlan: The compiled plan.
+        """
+        self._plan = ChainPlan(self.nodes, self.edges, self.topo_order)
+        return self._plan
+
+    def optimize(self) -> OptimizeReport:
+        """Clean up the graph, this is meant for the DAGs built in the UI and is not safe to call while the chain is
+        running. It makes two passes:
+
+        1. Dead nodes: the nodes that ``main_out`` does not depend on and that are not ``side_effect`` are removed.
+        2. Common subexpressions: nodes with the same action (same function or same model, prompt and parameters)
+           reading the same inputs are computed once. The duplicates are removed and their outgoing edges (and
+           ``main_out``) are moved to the node that is kept. Nodes with ``side_effect`` (like memory writes) and the
+           nodes with ``node_id/field`` values in ``sample`` are never merged. At run time the ``node_id/field``
+           inputs of a merged node are checked against the node that was kept, and a ``ValueError`` is raised if they
+           differ.
+
+        Returns:
+            OptimizeReport: What was changed, also stored in ``optimize_report``.
+        """
+        edges_before = len(self.edges)
+        nodes = self.nodes
+        edges = self.edges
+        main_node, _, main_var = self.main_out.partition("/")
+
+        # 1. remove what main_out does not need
+        removed = []
+        plan = self.compile()
+        if main_node in plan.nodes:
+            targets = [main_node] + [
+                k for k, n in nodes.items() if n.side_effect and k in plan.nodes
+            ]
+            needed = plan.upstream(targets)
+            # the nodes without any edges are not in topo_order, so they never run
+            order = self.topo_order + [k for k in nodes if k not in plan.nodes]
+            removed = [k for k in order if k not in needed]
+            nodes = {k: v for k, v in nodes.items() if k in needed}
+            edges = [e for e in edges if e.trg_node_id in needed]
+
+        # 2. merge the duplicates, in topological order so that the duplicates of the parents are resolved first
+        incoming = defaultdict(list)
+        for edge in edges:
+            incoming[edge.trg_node_id].append(edge)
+        prefixed = {k.split("/")[0] for k in self.sample if "/" in k}
+        merged: Dict[str, str] = {}
+        seen: Dict[str, str] = {}
+        for node_id in self.topo_order:
+            node = nodes.get(node_id)
+            if node is None or node.side_effect or node_id in prefixed:
+                continue
+            inputs = sorted(
+                (
+                    merged.get(e.src_node_id, e.src_node_id),
+                    e.src_node_var,
+                    e.trg_node_var,
+                )
+                for e in incoming[node_id]
+            )
+            sig = json.dumps(
+                [_action_signature(node), inputs], sort_keys=True, default=str
+            )
+            if sig in seen:
+                merged[node_id] = seen[sig]
+            else:
+                seen[sig] = node_id
+
+        if merged:
+            _edges = []
+            for edge in edges:
+                if edge.trg_node_id in merged:
+                    continue
+                if edge.src_node_id in merged:
+                    edge = Edge(
+                        merged[edge.src_node_id],
+                        edge.src_node_var,
+                        edge.trg_node_id,
+                        edge.trg_node_var,
+                    )
+                _edges.append(edge)
+            edges = _edges
+            nodes = {k: v for k, v in nodes.items() if k not in merged}
+            if main_node in merged:
+                self.main_out = f"{merged[main_node]}/{main_var}"
+            # the nodes merged by an earlier call now point to the node that is kept
+            self._merged = {k: merged.get(v, v) for k, v in self._merged.items()}
+            self._merged.update(merged)
+
+        self.nodes = nodes
+        self.edges = list(edges)
+        if len(self.nodes) == 1:
+            self.topo_order = [next(iter(self.nodes))]
+        else:
+            self.topo_order = topological_sort(self.edges)
+        self.optimize_report = OptimizeReport(
+            merged=merged,
+            removed=removed,
+            edges_before=edges_before,
+            edges_after=len(self.edges),
+        )
+        if self.optimize_report:
+            logger.info(f"Optimized chain {self.name or ''}: {self.optimize_report}")
+        self.compile()
+        return self.optimize_report
+
+    # building of chain
+
+    def add_tracer(self, tracer: Tracer) -> Tracer:
+        """Send a span for every node this chain runs and for every run to the ``tracer``, see ``chainfury.tracing``.
+
+        Args:
+            tracer (Tracer): The tracer, eg. ``SummaryTracer``, ``JSONLTracer`` or ``OTelTracer``.
+
+        Returns:
+            Tracer: The same tracer so you can keep a handle to it.
+        """
+        self.tracers.append(tracer)
+        return tracer
+
+    def remove_tracer(self, tracer: Tracer) -> None:
+        """Stop sending spans to the ``tracer``"""
+        self.tracers.remove(tracer)
+
+    def add_thread(
+        self,
+        node_id: str,
+        thread: T.Thread,
+        model: Optional[Model] = None,
+        description: str = "",
     ) -> "Chain":
         if self.default_model is None and model is None:
             logger.error(
@@ -1259,6 +2180,7 @@ class Chain:
             self.topo_order = [next(iter(self.nodes))]
         else:
             self.topo_order = topological_sort(self.edges)
+        self._plan = None
         return self
 
     # ser/deser
@@ -1424,11 +2346,20 @@ class Chain:
         return out
 
     @classmethod
-    def from_dag(cls, dag: T.Dag, check_server: bool = True):
+    def from_dag(
+        cls,
+        dag: T.Dag,
+        check_server: bool = True,
+        prune: bool = False,
+        optimize: bool = False,
+    ):
         """Loads the chain from the DAG object.
 
         Args:
             dag (T.Dag): The dag object to load from
+            prune (bool, optional): Skip the nodes ``main_out`` does not need, see ``Chain(prune=...)``. Defaults to False.
+            optimize (bool, optional): Merge the duplicate nodes and remove the unused ones, see ``Chain.optimize``.
+                Defaults to False.
         """
         from chainfury.core import programatic_actions_registry, ai_actions_registry
 
@@ -1504,6 +2435,8 @@ class Chain:
             sample=dag.sample,
             main_in=dag.main_in,
             main_out=dag.main_out,
+            prune=prune,
+            optimize=optimize,
         )
 
     @classmethod
@@ -1596,92 +2529,728 @@ class Chain:
 
     # execution of the DAG
 
+    def _prepare_data(
+        self, data: Union[str, Dict[str, Any]], print_thoughts: bool = False
+    ) -> Mapping[str, Any]:
+        """Layer the user ``data`` over ``self.sample`` to get the inputs for a single run. Nothing is copied, the run
+        only ever reads from this mapping so the values of ``sample`` are shared by all the runs and must not be
+        modified in place by the nodes."""
+        if not isinstance(data, dict):
+            assert isinstance(data, str), f"Invalid data type: {type(data)}"
+            assert self.main_in, "main_in not defined, pass dictionary input"
+            data = {self.main_in: data}
+        if self._merged:
+            self._check_merged(data)
+        data = ChainMap(data, self.sample)
+
+        if print_thoughts:
+            logger.info(
+                f"{terminal_top_with_text('Chain Starts')}\n"
+                f"Inputs:\n"
+                f"------\n"
+                f"{pformat(dict(data))}"
+            )
+        return data
+
+    def _check_merged(self, data: Dict[str, Any]) -> None:
+        """The nodes merged by ``optimize`` are computed by the node that was kept, so the ``node_id/field`` keys in
+        ``data`` must give both of them the same value."""
+        addressed = {k.split("/")[0] for k in data if "/" in k}
+        if not addressed:
+            return
+        for dup, kept in self._merged.items():
+            if dup not in addressed and kept not in addressed:
+                continue
+            for k in data:
+                node_id, _, name = k.partition("/")
+                if node_id not in (dup, kept):
+                    continue
+                default = data.get(name, self.sample.get(name))
+                if data.get(f"{dup}/{name}", default) != data.get(
+                    f"{kept}/{name}", default
+                ):
+                    raise ValueError(
+                        f"Node '{dup}' was merged into '{kept}' by Chain.optimize, they must get the same '{name}'. "
+                        "Pass the same value to both or do not optimize the chain"
+                    )
+
+    def _main_out(self, full_ir: Dict[str, Any], print_thoughts: bool = False) -> Any:
+        """Pick the ``main_out`` from the IR buffer at the end of a run."""
+        out = None
+        if self.main_out:
+            value = full_ir.get(self.main_out)
+            if value is not None or not self.plan.routers:
+                # main_out can be on a route that was not taken
+                out = load_value(value["value"])  # type: ignore
+
+        if print_thoughts:
+            logger.info(
+                f"{terminal_top_with_text('Chain Last')}\n"
+                f"Outputs ({'main: ' + self.main_out if self.main_out else ''}):\n"
+                f"------\n"
+                f"{pformat(out)}\n"
+                f"{terminal_top_with_text('Chain Ends')}"
+            )
+        return out
+
+    def _gather_inputs(
+        self,
+        node_id: str,
+        pre_data: Mapping[str, Any],
+        full_ir: Dict[str, Any],
+        inactive: Optional[Set[str]] = None,
+    ) -> Dict[str, Any]:
+        """Collect the inputs for ``node_id`` from the user data and the IR buffer. ``pre_data`` is only read, but
+        ``full_ir`` is being written by the run so this should be called from the thread that owns the run. The
+        ``inactive`` keys are the routes that were not taken, those inputs are left out.
+        """
+        plan = self.plan
+        node_plan = plan.nodes[node_id]
+        logger.debug(f">>> Processing node: {node_id}")
+
+        # first check if this node has any fields that are in the data, some things are shared between actions
+        # eg. openai_api_key
+        _data = {k: pre_data[k] for k in node_plan.fields if k in pre_data}
+
+        # then the values that were passed only for this node like 'node_id/field'
+        for k, name in node_plan.prefixed_fields:
+            if k in pre_data:
+                _data[name] = pre_data[k]
+
+        # then merge from the ir buffer
+        for req_key, trg_var in node_plan.incoming:
+            if inactive and req_key in inactive:
+                continue
+            # user data can override the IR, except the 'node_id/field' keys which are only inputs of that node
+            ir_value = None
+            if req_key not in plan.prefixed_inputs:
+                ir_value = pre_data.get(req_key, None)
+            if not ir_value:
+                record = full_ir.get(req_key)
+                ir_value = None if record is None else load_value(record["value"])
+            if ir_value is None:
+                raise ValueError(f"Missing value for {req_key}")
+            _data[trg_var] = ir_value
+        return _data
+
+    def _record_outputs(
+        self,
+        node_id: str,
+        out: Dict[str, Any],
+        full_ir: Dict[str, Any],
+        print_thoughts: bool = False,
+        thoughts_callback: Optional[Callable] = None,
+        start_ns: int = 0,
+    ) -> Dict[str, Any]:
+        """Write the outputs of a node in the IR buffer as ``IRRecord`` and fire the callbacks, returns the
+        ``yield_dict``. ``start_ns`` is the ``time.monotonic_ns`` when the node was started.
+        """
+        node_plan = self.plan.nodes[node_id]
+        node = node_plan.node
+        # if node has disabled the callback then do not run it
+        callback = thoughts_callback if node.allow_callback else None
+        end_ns = time.monotonic_ns()
+        yield_dict = {}
+        for k, v in out.items():
+            key = node_plan.output_keys.get(k) or f"{node_id}/{k}"
+            record = IRRecord(node_id, v, start_ns, end_ns)
+            full_ir[key] = record
+            yield_dict[key] = record
+            if callback is not None:
+                thought = {"key": key, **record.to_dict()}
+                callback(thought)
+                if print_thoughts:
+                    print(thought)
+        return yield_dict
+
+    def _needed_nodes(
+        self, outputs: Optional[Iterable[str]] = None
+    ) -> Optional[Set[str]]:
+        """The nodes to run when pruning, ``None`` means run everything. ``outputs`` can be IR keys like
+        ``node_id/var`` or node ids."""
+        if not self.prune and outputs is None:
+            return None
+        plan = self.plan
+        keys = set(outputs or [])
+        if self.main_out:
+            keys.add(self.main_out)
+        targets = []
+        for node_id, node_plan in plan.nodes.items():
+            if node_plan.node.side_effect or node_id in keys:
+                targets.append(node_id)
+                keys.discard(node_id)
+            for k in node_plan.output_keys.values():
+                if k in keys:
+                    targets.append(node_id)
+                    keys.discard(k)
+        if keys:
+            raise ValueError(f"Unknown outputs: {keys}")
+        needed = plan.upstream(targets)
+        if len(needed) < len(plan.nodes):
+            logger.debug(f"Pruned nodes: {set(plan.nodes) - needed}")
+        return needed
+
+    def _inactive_keys(
+        self, full_ir: Dict[str, Any], only: Optional[Set[str]]
+    ) -> Set[str]:
+        """The per-run set of the IR keys that will never get a value because their route was not taken. It starts
+        with the untaken routes of the routers that are not run again (eg. on ``rerun``) and grows as the routers and
+        skipped nodes complete."""
+        plan = self.plan
+        if not plan.routers or only is None:
+            return set()
+        return {
+            k
+            for node_id in plan.routers - only
+            for k in plan.nodes[node_id].output_keys.values()
+            if k not in full_ir
+        }
+
+    def _is_skipped(self, node_id: str, inactive: Set[str]) -> bool:
+        """A node is skipped when all of its inputs from other nodes are ``inactive``."""
+        if not inactive:
+            return False
+        incoming = self.plan.nodes[node_id].incoming
+        return bool(incoming) and all(k in inactive for k, _ in incoming)
+
+    def _deactivate(
+        self, node_id: str, out: Optional[Dict[str, Any]], inactive: Set[str]
+    ) -> None:
+        """Add the outputs of ``node_id`` that have no value in ``out`` to ``inactive``, ``None`` for a skipped node."""
+        for name, k in self.plan.nodes[node_id].output_keys.items():
+            if out is None or name not in out:
+                inactive.add(k)
+
     def step(
         self,
         node_id: str,
-        pre_data: Dict[str, Any],
+        pre_data: Mapping[str, Any],
         full_ir: Dict[str, Any],
         print_thoughts: bool = False,
         thoughts_callback: Optional[Callable] = None,
+        parent: Optional[Span] = None,
+        inactive: Optional[Set[str]] = None,
     ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """Performs a single step in the chain, useful for manual debugging.
 
         Args:
             node_id (str): The id of the node to step.
-            pre_data (Dict[str, Any]): The data to use for the step.
-            full_ir (Dict[str, Any]): The full IR to use for the step.
+            pre_data (Mapping[str, Any]): The data to use for the step, this is only read.
+            full_ir (Dict[str, Any]): The full IR to use for the step, the outputs are added to it as ``IRRecord``.
             print_thoughts (bool, optional): Whether to print the thoughts. Defaults to False.
             thoughts_callback (Optional[Callable], optional): A callback to call with the thoughts. Defaults to None.
+            parent (Optional[Span], optional): The span of the run when tracing. Defaults to None.
+            inactive (Optional[Set[str]], optional): The IR keys of the routes that were not taken in this run, the
+                untaken routes of a router node are added to it. Defaults to None.
 
         Returns:
-            Tuple[Dict[str, Any], Dict[str, Any]]: The currrent output and updated thoughts ir buffer.
+            Tuple[Dict[str, Any], Dict[str, Any]]: The currrent output and updated thoughts ir buffer, use
+            ``ir_to_dict`` to get plain dicts from them.
         """
-        node = self.nodes[node_id]
-        incoming_edges = list(
-            filter(lambda edge: edge.trg_node_id == node_id, self.edges)
-        )
-
-        # clear out all the nodes that this thing needs into a separate rep
-        logger.debug(f">>> Processing node: {node_id}")
-        logger.debug(f"Current full_ir: {set(full_ir.keys())}")
-        _data = {}
-
-        # first check if this node has any fields that are in the data
-        all_keys = list(pre_data.keys())
-        for k in all_keys:
-            if node.has_field(k):
-                _data[k] = pre_data[
-                    k
-                ]  # don't pop this, some things are shared between actions eg. openai_api_key
-            elif k.startswith(node.id):
-                _data[k.split("/", 1)[1]] = pre_data.pop(
-                    k
-                )  # pop this, it is not needed anymore
-
-        # then merge from the ir buffer
-        for edge in incoming_edges:
-            logger.debug(f"Incoming edge: {edge}")
-            req_key = f"{edge.src_node_id}/{edge.src_node_var}"
-            logger.debug(f"Looking for key: {req_key}")
-            # need to check if this information is available in the IR buffer, if it is not then this is an error
-            ir_value = pre_data.get(req_key, None) or full_ir.get(req_key, {}).get(
-                "value", None
-            )
-            if ir_value is None:
-                raise ValueError(f"Missing value for {req_key}")
-            _data[edge.trg_node_var] = ir_value
+        _data = self._gather_inputs(node_id, pre_data, full_ir, inactive)
 
         # then run the node
-        out, err = node(_data, print_thoughts=print_thoughts)
+        start_ns = time.monotonic_ns()
+        out, err = self._call_node(node_id, _data, print_thoughts, parent=parent)
         if err:
             logger.error(f"TRACE: {out}")
             raise err
+        if inactive is not None and node_id in self.plan.routers:
+            self._deactivate(node_id, out, inactive)
 
         # create the thoughts buffer
-        yield_dict = {}
-        for k, v in out.items():
-            key = f"{node_id}/{k}"
-            value = {
-                "value": v,
-                "timestamp": datetime.datetime.now().isoformat(),
-            }
-            full_ir[key] = value
-            thought = {"key": key, **value}
-            yield_dict[key] = value
+        yield_dict = self._record_outputs(
+            node_id=node_id,
+            out=out,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            start_ns=start_ns,
+        )
+        return yield_dict, full_ir
 
-            # if node has disabled the callback then do not run it
-            if thoughts_callback is not None and node.allow_callback:
-                thoughts_callback(thought)
-                if print_thoughts:
-                    print(thought)
+    def _call_node(
+        self,
+        node_id: str,
+        data: Dict[str, Any],
+        print_thoughts: bool = False,
+        deadline: Optional[float] = None,
+        parent: Optional[Span] = None,
+    ) -> Tuple[Any, Optional[Exception]]:
+        """Calls the node, inside a span when the chain has tracers. This runs on the worker threads."""
+        node = self.nodes[node_id]
+        with llm_cache_scope(self.llm_cache):
+            if not self.tracers:
+                out, err = node(data, print_thoughts=print_thoughts, deadline=deadline)
+            else:
+                with trace(self.tracers, node_id, node.type, data, parent) as span:
+                    out, err = node(
+                        data, print_thoughts=print_thoughts, deadline=deadline
+                    )
+                    if err:
+                        span.error = repr(err)
+                    else:
+                        span.output_bytes = nbytes(out)
+        if self.spill_bytes and not err:
+            out = self._spill(out)
+        return out, err
+
+    def _spill(self, out: Dict[str, Any]) -> Dict[str, Any]:
+        """Replace the large outputs with a ``BlobRef``, this does the blob IO so it is called on the worker threads."""
+        return {k: spill_to_blob(v, self.spill_bytes) for k, v in out.items()}
+
+    async def _acall_node(
+        self,
+        node_id: str,
+        data: Dict[str, Any],
+        print_thoughts: bool = False,
+        deadline: Optional[float] = None,
+        parent: Optional[Span] = None,
+    ) -> Tuple[Any, Optional[Exception]]:
+        """Async version of ``_call_node``, the CPU time is not measured since the event loop interleaves the nodes."""
+        node = self.nodes[node_id]
+        with llm_cache_scope(self.llm_cache):
+            if not self.tracers:
+                out, err = await node.acall(
+                    data, print_thoughts=print_thoughts, deadline=deadline
+                )
+            else:
+                with trace(
+                    self.tracers, node_id, node.type, data, parent, measure_cpu=False
+                ) as span:
+                    out, err = await node.acall(
+                        data, print_thoughts=print_thoughts, deadline=deadline
+                    )
+                    if err:
+                        span.error = repr(err)
+                    else:
+                        span.output_bytes = nbytes(out)
+        if self.spill_bytes and not err:
+            out = await asyncio.to_thread(self._spill, out)
+        return out, err
+
+    def _stream_step(
+        self,
+        node_id: str,
+        pre_data: Mapping[str, Any],
+        full_ir: Dict[str, Any],
+        print_thoughts: bool = False,
+        thoughts_callback: Optional[Callable] = None,
+        deadline: Optional[float] = None,
+        parent: Optional[Span] = None,
+        inactive: Optional[Set[str]] = None,
+    ) -> Generator[Tuple[str, Union[Dict[str, Any], TokenDelta]], None, None]:
+        """Same as ``step`` but runs the node with ``Node.stream`` and yields a ``TokenDelta`` for every chunk. The
+        deadline is checked between the chunks."""
+        _data = self._gather_inputs(node_id, pre_data, full_ir, inactive)
+        node = self.nodes[node_id]
+        deadline = node.deadline(deadline)
+        start_ns = time.monotonic_ns()
+        gen = node.stream(_data, print_thoughts=print_thoughts, deadline=deadline)
+        with (
+            trace(
+                self.tracers,
+                node_id,
+                node.type,
+                _data,
+                parent,
+                measure_cpu=False,
+                current=False,
+            )
+            if self.tracers
+            else nullcontext()
+        ) as span:
+            while True:
+                try:
+                    # the scopes are set around each step, the consumer may resume this generator from another context
+                    # and the code it runs in between must not see this span
+                    with span_scope(span), llm_cache_scope(self.llm_cache):
+                        chunk = next(gen)
+                except StopIteration as e:
+                    out, err = e.value
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    gen.close()
+                    raise ChainTimeoutError(full_ir, [node_id])
+                yield node_id, TokenDelta(self.main_out, chunk)
+            if span is not None:
+                span.error = repr(err) if err else None
+                span.output_bytes = None if err else nbytes(out)
+        if err:
+            logger.error(f"TRACE: {out}")
+            raise err
+        if self.spill_bytes:
+            out = self._spill(out)
+        yield_dict = self._record_outputs(
+            node_id=node_id,
+            out=out,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            start_ns=start_ns,
+        )
+        yield node_id, yield_dict
 
-        return yield_dict, full_ir
+    def _wait_timeout(
+        self,
+        pending: Iterable[str],
+        begun: Dict[str, Tuple[int, Optional[float]]],
+        deadline: Optional[float],
+    ) -> Optional[float]:
+        """Seconds the executors can wait on the ``pending`` nodes before one of them may be past its deadline. The
+        nodes that have not started yet are only bound by the chain's ``deadline``, the ones with a ``timeout`` are
+        looked at again every ``_QUEUE_POLL`` seconds to pick up their own deadline once they start.
+        """
+        now = time.monotonic()
+        nearest = [] if deadline is None else [deadline]
+        for node_id in pending:
+            if node_id in begun:
+                if begun[node_id][1] is not None:
+                    nearest.append(begun[node_id][1])
+            elif self.nodes[node_id].timeout is not None:
+                nearest.append(now + _QUEUE_POLL)
+        return max(min(nearest) - now, 0) if nearest else None
+
+    def _expired(
+        self,
+        pending: Iterable[str],
+        begun: Dict[str, Tuple[int, Optional[float]]],
+        deadline: Optional[float],
+    ) -> List[str]:
+        """The ``pending`` nodes that are past their deadline"""
+        now = time.monotonic()
+        expired = []
+        for node_id in pending:
+            node_deadline = begun[node_id][1] if node_id in begun else deadline
+            if node_deadline is not None and node_deadline <= now:
+                expired.append(node_id)
+        return expired
+
+    def _execute(
+        self, *args, **kwargs
+    ) -> Generator[Tuple[str, Union[Dict[str, Any], TokenDelta]], None, None]:
+        """Runs ``_execute_nodes`` inside a span for the whole run when the chain has tracers."""
+        if not self.tracers:
+            yield from self._execute_nodes(*args, **kwargs)
+            return
+        with trace(
+            self.tracers,
+            self.name or "chain",
+            "chain",
+            measure_cpu=False,
+            current=False,
+        ) as span:
+            yield from self._execute_nodes(*args, parent=span, **kwargs)
+
+    def _execute_nodes(
+        self,
+        data: Mapping[str, Any],
+        full_ir: Dict[str, Any],
+        print_thoughts: bool = False,
+        thoughts_callback: Optional[Callable] = None,
+        max_workers: int = 1,
+        only: Optional[Set[str]] = None,
+        stream_node: Optional[str] = None,
+        deadline: Optional[float] = None,
+        parent: Optional[Span] = None,
+    ) -> Generator[Tuple[str, Union[Dict[str, Any], TokenDelta]], None, None]:
+        """The dataflow engine shared by ``__call__`` and ``stream``, yields ``(node_id, yield_dict)`` each time a node
+        completes. With ``max_workers > 1`` every node whose incoming edges are satisfied is submitted to a bounded
+        thread pool, so independent branches overlap. Inputs are gathered and outputs are written to ``full_ir`` only
+        on the calling thread, which means ``thoughts_callback`` is never called concurrently and a node's thoughts
+        always come after the thoughts of all its upstream nodes. When ``only`` is passed the rest of the nodes are not
+        run and their outputs are expected to already be in ``full_ir``. The ``stream_node`` is run token by token on
+        the calling thread and a ``TokenDelta`` is yielded for every chunk before its ``yield_dict``.
+
+        When there is a ``deadline`` or any node has a ``timeout`` the nodes are always run on the pool so the calling
+        thread can stop waiting on them, a ``ChainTimeoutError`` is raised with whatever is in ``full_ir`` by then.
+
+        Nodes whose inputs all come from the routes a router did not take are skipped, nothing is yielded for them.
+        """
+        plan = self.plan
+        remaining = plan.remaining(only)
+        inactive = self._inactive_keys(full_ir, only)
+        timed = deadline is not None or any(
+            plan.nodes[n].node.timeout is not None for n in remaining
+        )
+        if not timed and (max_workers <= 1 or len(self.topo_order) == 1):
+            for node_id in plan.order:
+                if only is not None and node_id not in only:
+                    continue
+                if self._is_skipped(node_id, inactive):
+                    self._deactivate(node_id, None, inactive)
+                    continue
+                if node_id == stream_node:
+                    yield from self._stream_step(
+                        node_id,
+                        data,
+                        full_ir,
+                        print_thoughts,
+                        thoughts_callback,
+                        parent=parent,
+                        inactive=inactive,
+                    )
+                    continue
+                yield_dict, full_ir = self.step(
+                    node_id=node_id,
+                    pre_data=data,
+                    full_ir=full_ir,
+                    print_thoughts=print_thoughts,
+                    thoughts_callback=thoughts_callback,
+                    parent=parent,
+                    inactive=inactive,
+                )
+                yield node_id, yield_dict
+            return
+
+        exe = ThreadPoolExecutor(
+            max_workers=max(max_workers, 1), thread_name_prefix="cf-chain"
+        )
+        pending: Dict[Future, str] = {}
+        begun: Dict[str, Tuple[int, Optional[float]]] = {}
+        inline: List[str] = []
+        timed_out = False
+
+        def _run(node_id: str, _data: Dict[str, Any]):
+            # the node's own timeout starts when a worker picks it up, not while it waits in the queue
+            node_deadline = self.nodes[node_id].deadline(deadline)
+            begun[node_id] = (time.monotonic_ns(), node_deadline)
+            return self._call_node(
+                node_id,
+                _data,
+                print_thoughts=print_thoughts,
+                deadline=node_deadline,
+                parent=parent,
+            )
+
+        def _submit(node_id: str):
+            if node_id == stream_node:
+                inline.append(node_id)
+                return
+            if deadline is not None and time.monotonic() > deadline:
+                raise ChainTimeoutError(full_ir, [node_id])
+            _data = self._gather_inputs(node_id, data, full_ir, inactive)
+            pending[exe.submit(_run, node_id, _data)] = node_id
+
+        def _ready(node_id: str):
+            if self._is_skipped(node_id, inactive):
+                self._deactivate(node_id, None, inactive)
+                _release(node_id)
+            else:
+                _submit(node_id)
+
+        def _release(node_id: str):
+            ready = []
+            for child in plan.nodes[node_id].children:
+                if child not in remaining:
+                    continue
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    ready.append(child)
+            for child in sorted(ready, key=lambda n: plan.nodes[n].order):
+                _ready(child)
+
+        try:
+            for node_id in plan.order:
+                if remaining.get(node_id) == 0:
+                    _ready(node_id)
+
+            while pending or inline:
+                if inline:
+                    # the other nodes keep running in the pool while this one streams
+                    node_id = inline.pop()
+                    yield from self._stream_step(
+                        node_id,
+                        data,
+                        full_ir,
+                        print_thoughts,
+                        thoughts_callback,
+                        deadline=deadline,
+                        parent=parent,
+                        inactive=inactive,
+                    )
+                    _release(node_id)
+                    continue
+
+                timeout = self._wait_timeout(pending.values(), begun, deadline)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    expired = self._expired(pending.values(), begun, deadline)
+                    if expired:
+                        timed_out = True
+                        raise ChainTimeoutError(full_ir, expired)
+                    continue
+
+                for fut in sorted(done, key=lambda f: plan.nodes[pending[f]].order):
+                    node_id = pending.pop(fut)
+                    start_ns = begun.pop(node_id)[0]
+                    out, err = fut.result()
+                    if err:
+                        logger.error(f"TRACE: {out}")
+                        raise err
+                    if node_id in plan.routers:
+                        self._deactivate(node_id, out, inactive)
+                    yield_dict = self._record_outputs(
+                        node_id=node_id,
+                        out=out,
+                        full_ir=full_ir,
+                        print_thoughts=print_thoughts,
+                        thoughts_callback=thoughts_callback,
+                        start_ns=start_ns,
+                    )
+                    yield node_id, yield_dict
+                    _release(node_id)
+        except ChainTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            # do not start anything new if we are bailing out, and do not wait on the nodes that are stuck
+            for fut in pending:
+                fut.cancel()
+            exe.shutdown(wait=not timed_out)
+
+    async def _aexecute(
+        self,
+        data: Mapping[str, Any],
+        full_ir: Dict[str, Any],
+        print_thoughts: bool = False,
+        thoughts_callback: Optional[Callable] = None,
+        only: Optional[Set[str]] = None,
+        deadline: Optional[float] = None,
+        stream_node: Optional[str] = None,
+    ):
+        """Async counterpart of ``_execute``, every node whose incoming edges are satisfied is started as a task on the
+        running event loop. Same as the threaded executor inputs and outputs are handled by this coroutine only. The
+        ``stream_node`` is run with ``_stream_step`` whose chunks are pulled in a worker thread one at a time, the
+        other tasks keep running on the loop meanwhile.
+        """
+        run_trace = (
+            trace(
+                self.tracers,
+                self.name or "chain",
+                "chain",
+                measure_cpu=False,
+                current=False,
+            )
+            if self.tracers
+            else nullcontext()
+        )
+        with run_trace as parent:
+            plan = self.plan
+            remaining = plan.remaining(only)
+            inactive = self._inactive_keys(full_ir, only)
+            pending: Dict[asyncio.Task, str] = {}
+            begun: Dict[str, Tuple[int, Optional[float]]] = {}
+            inline: List[str] = []
+
+            async def _run(node_id: str, _data: Dict[str, Any]):
+                node_deadline = self.nodes[node_id].deadline(deadline)
+                begun[node_id] = (time.monotonic_ns(), node_deadline)
+                return await self._acall_node(
+                    node_id,
+                    _data,
+                    print_thoughts=print_thoughts,
+                    deadline=node_deadline,
+                    parent=parent,
+                )
+
+            def _submit(node_id: str):
+                if node_id == stream_node:
+                    inline.append(node_id)
+                    return
+                if deadline is not None and time.monotonic() > deadline:
+                    raise ChainTimeoutError(full_ir, [node_id])
+                _data = self._gather_inputs(node_id, data, full_ir, inactive)
+                pending[asyncio.ensure_future(_run(node_id, _data))] = node_id
+
+            def _ready(node_id: str):
+                if self._is_skipped(node_id, inactive):
+                    self._deactivate(node_id, None, inactive)
+                    _release(node_id)
+                else:
+                    _submit(node_id)
+
+            def _release(node_id: str):
+                ready = []
+                for child in plan.nodes[node_id].children:
+                    if child not in remaining:
+                        continue
+                    remaining[child] -= 1
+                    if remaining[child] == 0:
+                        ready.append(child)
+                for child in sorted(ready, key=lambda n: plan.nodes[n].order):
+                    _ready(child)
+
+            try:
+                for node_id in plan.order:
+                    if remaining.get(node_id) == 0:
+                        _ready(node_id)
+
+                while pending or inline:
+                    if inline:
+                        node_id = inline.pop()
+                        gen = self._stream_step(
+                            node_id,
+                            data,
+                            full_ir,
+                            print_thoughts,
+                            thoughts_callback,
+                            deadline=deadline,
+                            parent=parent,
+                            inactive=inactive,
+                        )
+                        while True:
+                            item = await asyncio.to_thread(next, gen, _STREAM_END)
+                            if item is _STREAM_END:
+                                break
+                            yield item
+                        _release(node_id)
+                        continue
+
+                    timeout = self._wait_timeout(pending.values(), begun, deadline)
+                    done, _ = await asyncio.wait(
+                        pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        expired = self._expired(pending.values(), begun, deadline)
+                        if expired:
+                            raise ChainTimeoutError(full_ir, expired)
+                        continue
+
+                    for task in sorted(
+                        done, key=lambda t: plan.nodes[pending[t]].order
+                    ):
+                        node_id = pending.pop(task)
+                        start_ns = begun.pop(node_id)[0]
+                        out, err = task.result()
+                        if err:
+                            logger.error(f"TRACE: {out}")
+                            raise err
+                        if node_id in plan.routers:
+                            self._deactivate(node_id, out, inactive)
+                        yield_dict = self._record_outputs(
+                            node_id=node_id,
+                            out=out,
+                            full_ir=full_ir,
+                            print_thoughts=print_thoughts,
+                            thoughts_callback=thoughts_callback,
+                            start_ns=start_ns,
+                        )
+                        yield node_id, yield_dict
+                        _release(node_id)
+            finally:
+                for task in pending:
+                    task.cancel()
 
     def __call__(
         self,
         data: Union[str, Dict[str, Any]],
         thoughts_callback: Optional[Callable] = None,
         print_thoughts: bool = False,
+        max_workers: int = 1,
+        outputs: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+        checkpoint: Optional[Checkpoint] = None,
     ) -> Tuple[Var, Dict[str, Any]]:
         """
         Runs the chain on the given data. In this function it will run a full dataflow engine along with thoughts buffer
@@ -1711,60 +3280,80 @@ class Chain:
             data (Union[str, Dict[str, Any]]): The data to run the chain on.
             thoughts_callback (Optional[Callable], optional): The callback function to call at each step. Defaults to None.
             print_thoughts (bool, optional): Whether to print the thoughts buffer at each step. Defaults to False.
-            stream (bool, optional): Whether to stream the output or not. Defaults to False.
+            max_workers (int, optional): When more than 1, nodes that do not depend on each other are run concurrently
+                on a thread pool of this size. Defaults to 1.
+            outputs (Optional[Iterable[str]], optional): Prune the chain for this call, only the nodes needed for
+                ``main_out`` and these IR keys (or node ids) are run, see ``Chain(prune=...)``. Defaults to None.
+            timeout (Optional[float], optional): Seconds the whole chain is allowed to run for, after which the nodes
+                still running are abandoned and a ``ChainTimeoutError`` with the partial ``full_ir`` is raised. It is
+                passed down to the models as the timeout of their requests. Defaults to None.
+            checkpoint (Optional[Checkpoint], optional): Save the outputs of each node here as soon as it completes,
+                if the checkpoint already has outputs from an earlier attempt of this run those nodes are not run
+                again, see ``resume``. Defaults to None.
 
         Returns:
             Tuple[Var, Dict[str, Any]]: The output of the chain and the thoughts buffer.
         """
-        if not isinstance(data, dict):
-            assert isinstance(data, str), f"Invalid data type: {type(data)}"
-            assert self.main_in, "main_in not defined, pass dictionary input"
-            data = {self.main_in: data}
-        _data = copy.deepcopy(self.sample)  # don't corrupt yourself over multiple calls
-        _data.update(data)
-        data = _data
-
-        if print_thoughts:
-            logger.info(
-                f"{terminal_top_with_text('Chain Starts')}\n"
-                f"Inputs:\n"
-                f"------\n"
-                f"{pformat(data)}"
-            )
-
-        full_ir = {}
-        out = None
-        for node_id in self.topo_order:
-            yield_dict, full_ir = self.step(
-                node_id=node_id,
-                pre_data=data,
-                full_ir=full_ir,
-                print_thoughts=print_thoughts,
-                thoughts_callback=thoughts_callback,
-            )
+        data = self._prepare_data(data, print_thoughts=print_thoughts)
+
+        full_ir, only = self._restore(checkpoint, self._needed_nodes(outputs))
+        for _, yield_dict in self._execute(
+            data=data,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            max_workers=max_workers,
+            only=only,
+            deadline=_deadline(timeout),
+        ):
+            if checkpoint is not None:
+                checkpoint.save(ir_to_dict(yield_dict))
+
+        out = self._main_out(full_ir, print_thoughts=print_thoughts)
+        return out, ir_to_dict(full_ir)  # type: ignore
+
+    def resume(
+        self,
+        data: Union[str, Dict[str, Any]],
+        checkpoint: Checkpoint,
+        **kwargs,
+    ) -> Tuple[Var, Dict[str, Any]]:
+        """
+        Continues a run that was interrupted, the ``full_ir`` saved in the ``checkpoint`` is loaded and only the nodes
+        whose outputs are missing (and the nodes downstream of them) are run. The new outputs are saved to the same
+        checkpoint so a run can be resumed any number of times. A checkpoint with nothing in it runs the full chain.
 
-        if self.main_out:
-            out = full_ir.get(self.main_out)["value"]  # type: ignore
+        Example:
+            >>> chain = Chain(...)
+            >>> checkpoint = FileCheckpoint("run_1.jsonl")
+            >>> out, thoughts = chain("Hello world", checkpoint=checkpoint)  # the process dies midway
+            >>> out, thoughts = chain.resume("Hello world", checkpoint)  # completed nodes are not called again
 
-        if print_thoughts:
-            logger.info(
-                f"{terminal_top_with_text('Chain Last')}\n"
-                f"Outputs ({'main: ' + self.main_out if self.main_out else ''}):\n"
-                f"------\n"
-                f"{pformat(out)}\n"
-                f"{terminal_top_with_text('Chain Ends')}"
-            )
+        Args:
+            data (Union[str, Dict[str, Any]]): The data the run was started with.
+            checkpoint (Checkpoint): The checkpoint of the run.
+            **kwargs: Passed to ``__call__``.
 
-        return out, full_ir  # type: ignore
+        Returns:
+            Tuple[Var, Dict[str, Any]]: The output of the chain and the thoughts buffer.
+        """
+        return self(data, checkpoint=checkpoint, **kwargs)
 
     def stream(
         self,
         data: Union[str, Dict[str, Any]],
         thoughts_callback: Optional[Callable] = None,
         print_thoughts: bool = False,
+        max_workers: int = 1,
+        stream_tokens: bool = False,
+        outputs: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+        checkpoint: Optional[Checkpoint] = None,
     ) -> Generator[Tuple[Union[Any, Dict[str, Any]], bool], None, None]:
         """
         This is a streaming version of __call__ method. It will yield the intermediate responses as they come in.
+        With ``stream_tokens`` the AI node that gives ``main_out`` streams its text and each chunk is yielded as a
+        ``TokenDelta`` event, the models that do not implement ``stream_chat`` are called as usual.
 
         Example:
             >>> chain = Chain(...)
@@ -1794,50 +3383,649 @@ class Chain:
             data (Union[str, Dict[str, Any]]): The data to run the chain on.
             thoughts_callback (Optional[Callable], optional): The callback function to call at each step. Defaults to None.
             print_thoughts (bool, optional): Whether to print the thoughts buffer at each step. Defaults to False.
+            max_workers (int, optional): When more than 1, nodes that do not depend on each other are run concurrently
+                on a thread pool of this size. Intermediate responses are then yielded in order of completion.
+                Defaults to 1.
+            stream_tokens (bool, optional): Yield ``TokenDelta`` events while the ``main_out`` is being generated.
+                Defaults to False.
+            outputs (Optional[Iterable[str]], optional): Prune the chain for this call, only the nodes needed for
+                ``main_out`` and these IR keys (or node ids) are run, see ``Chain(prune=...)``. Defaults to None.
+            timeout (Optional[float], optional): Seconds the whole chain is allowed to run for, after which the nodes
+                still running are abandoned and a ``ChainTimeoutError`` with the partial ``full_ir`` is raised. It is
+                passed down to the models as the timeout of their requests. Defaults to None.
+            checkpoint (Optional[Checkpoint], optional): Save the outputs of each node here as soon as it completes,
+                if the checkpoint already has outputs from an earlier attempt of this run those nodes are not run
+                again, see ``resume``. Defaults to None.
 
         Yields:
             Generator[Tuple[Union[Any, Dict[str, Any]], bool], None, None]: The intermediate responses and whether the
             response is the final response or not.
         """
-        if not isinstance(data, dict):
-            assert isinstance(data, str), f"Invalid data type: {type(data)}"
-            assert self.main_in, "main_in not defined, pass dictionary input"
-            data = {self.main_in: data}
-        _data = copy.deepcopy(self.sample)  # don't corrupt yourself over multiple calls
-        _data.update(data)
-        data = _data
+        data = self._prepare_data(data, print_thoughts=print_thoughts)
+        stream_node = self._stream_node() if stream_tokens else None
+        full_ir, only = self._restore(checkpoint, self._needed_nodes(outputs))
+        for _, yield_dict in self._execute(
+            data=data,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            max_workers=max_workers,
+            only=only,
+            deadline=_deadline(timeout),
+            stream_node=stream_node,
+        ):
+            if checkpoint is not None and not isinstance(yield_dict, TokenDelta):
+                checkpoint.save(ir_to_dict(yield_dict))
+            if not isinstance(yield_dict, TokenDelta):
+                yield_dict = ir_to_dict(yield_dict)
+            yield yield_dict, False
+        out = self._main_out(full_ir, print_thoughts=print_thoughts)
+        yield out, True
 
-        if print_thoughts:
-            logger.info(
-                f"{terminal_top_with_text('Chain Starts')}\n"
-                f"Inputs:\n"
-                f"------\n"
-                f"{pformat(data)}"
-            )
+    def _stream_node(self) -> Optional[str]:
+        """The AI node that gives ``main_out`` if it can be streamed token by token"""
+        if not self.main_out:
+            return None
+        for node_id, node_plan in self.plan.nodes.items():
+            if self.main_out in node_plan.output_keys.values():
+                return node_id if node_plan.node.can_stream else None
+        return None
+
+    def _restore(
+        self, checkpoint: Optional[Checkpoint], only: Optional[Set[str]]
+    ) -> Tuple[Dict[str, Any], Optional[Set[str]]]:
+        """Load the ``full_ir`` saved in the checkpoint and remove the nodes that already completed from ``only``."""
+        if checkpoint is None:
+            return {}, only
+        full_ir = ir_from_dict(checkpoint.load())
+        if not full_ir:
+            return full_ir, only
+        todo = self._dirty_nodes([], full_ir)
+        logger.info(
+            f"Resuming from {checkpoint}, {len(self.plan.nodes) - len(todo)} nodes already completed"
+        )
+        return full_ir, todo if only is None else todo & only
+
+    def _dirty_nodes(self, changed: Iterable[str], full_ir: Dict[str, Any]) -> Set[str]:
+        """The nodes that read any of the ``changed`` keys or whose outputs are missing in ``full_ir``, along with
+        everything downstream of them. The nodes that were skipped because their route was not taken are not dirty
+        unless the router is."""
+        changed = set(changed)
+        inactive: Set[str] = set()
+        dirty = []
+        for node_id, node_plan in self.plan.nodes.items():
+            if (
+                not node_plan.fields.isdisjoint(changed)
+                or any(k in changed for k, _ in node_plan.prefixed_fields)
+                or any(k in changed for k, _ in node_plan.incoming)
+            ):
+                dirty.append(node_id)
+                continue
+            missing = [k for k in node_plan.output_keys.values() if k not in full_ir]
+            if node_id in self.plan.routers:
+                # a router only has values for the routes it took
+                if len(missing) == len(node_plan.output_keys):
+                    dirty.append(node_id)
+                inactive.update(missing)
+            elif missing and self._is_skipped(node_id, inactive):
+                self._deactivate(node_id, None, inactive)
+            elif missing:
+                dirty.append(node_id)
+        return self.plan.downstream(dirty)
+
+    def frontier(
+        self, full_ir: Dict[str, Any], outputs: Optional[Iterable[str]] = None
+    ) -> Tuple[List[str], Set[str]]:
+        """The nodes of a run that can start now given the outputs already in ``full_ir``, this lets the nodes of a
+        single run be executed by different processes or machines. Run each returned node with ``step`` (passing the
+        returned ``inactive`` keys), merge its outputs in ``full_ir`` and call this again, the run is complete when no
+        nodes are returned.
 
-        full_ir = {}
-        out = None
-        for node_id in self.topo_order:
-            yield_dict, full_ir = self.step(
-                node_id=node_id,
-                pre_data=data,
-                full_ir=full_ir,
-                print_thoughts=print_thoughts,
-                thoughts_callback=thoughts_callback,
-            )
-            yield yield_dict, False
-        if self.main_out:
-            out = full_ir.get(self.main_out)["value"]  # type: ignore
+        Args:
+            full_ir (Dict[str, Any]): The IR of the run so far.
+            outputs (Optional[Iterable[str]], optional): Prune the run, same as ``__call__``. Defaults to None.
 
-        if print_thoughts:
-            logger.info(
-                f"{terminal_top_with_text('Chain Last')}\n"
-                f"Outputs ({'main: ' + self.main_out if self.main_out else ''}):\n"
-                f"------\n"
-                f"{pformat(out)}\n"
-                f"{terminal_top_with_text('Chain Ends')}"
+        Returns:
+            Tuple[List[str], Set[str]]: The ready node ids in the topological order and the IR keys of the routes that
+            were not taken.
+        """
+        plan = self.plan
+        needed = self._needed_nodes(outputs)
+        settled: Set[str] = set()
+        inactive: Set[str] = set()
+        ready = []
+        for node_id in plan.order:
+            if needed is not None and node_id not in needed:
+                continue
+            node_plan = plan.nodes[node_id]
+            keys = node_plan.output_keys.values()
+            if node_id in plan.routers:
+                # a router only has values for the routes it took
+                done = any(k in full_ir for k in keys)
+            else:
+                done = all(k in full_ir for k in keys)
+            if done:
+                settled.add(node_id)
+                inactive.update(k for k in keys if k not in full_ir)
+            elif self._is_skipped(node_id, inactive):
+                settled.add(node_id)
+                self._deactivate(node_id, None, inactive)
+            elif all(p in settled for p in node_plan.parents):
+                ready.append(node_id)
+        return ready, inactive
+
+    def rerun(
+        self,
+        data: Union[str, Dict[str, Any]],
+        full_ir: Dict[str, Any],
+        changed: Optional[Iterable[str]] = None,
+        thoughts_callback: Optional[Callable] = None,
+        print_thoughts: bool = False,
+        max_workers: int = 1,
+        outputs: Optional[Iterable[str]] = None,
+    ) -> Tuple[Var, Dict[str, Any]]:
+        """
+        Incrementally re-runs the chain after some inputs changed. Only the nodes that read a changed input and the
+        nodes downstream of them are run, the outputs of every other node are reused from the ``full_ir`` of the
+        previous run. Nodes whose outputs are missing in ``full_ir`` (eg. the previous run failed midway) are run too.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> out, thoughts = chain({"topic": "cats", "style": "haiku"})
+            >>> # only the nodes that read 'style' and their dependents are called again
+            >>> out, thoughts = chain.rerun({"topic": "cats", "style": "limerick"}, thoughts, changed=["style"])
+
+        Args:
+            data (Union[str, Dict[str, Any]]): The inputs of the new run, same as ``__call__``.
+            full_ir (Dict[str, Any]): The thoughts buffer of the previous run, this is not modified.
+            changed (Optional[Iterable[str]], optional): The input keys that changed, this can also be ``node_id/field``
+                keys. If not passed then all the keys in ``data`` are considered changed. Defaults to None.
+            thoughts_callback (Optional[Callable], optional): The callback function to call at each step. Defaults to None.
+            print_thoughts (bool, optional): Whether to print the thoughts buffer at each step. Defaults to False.
+            max_workers (int, optional): Same as ``__call__``. Defaults to 1.
+            outputs (Optional[Iterable[str]], optional): Same as ``__call__``, when the chain is pruned the nodes that
+                are not needed are not run even though their outputs are missing. Defaults to None.
+
+        Returns:
+            Tuple[Var, Dict[str, Any]]: The output of the chain and the new thoughts buffer.
+        """
+        if changed is None:
+            changed = data.keys() if isinstance(data, dict) else [self.main_in]
+        data = self._prepare_data(data, print_thoughts=print_thoughts)
+        dirty = self._dirty_nodes(changed, full_ir)
+        needed = self._needed_nodes(outputs)
+        if needed is not None:
+            dirty &= needed
+        logger.debug(f"Re-running {len(dirty)}/{len(self.plan.nodes)} nodes: {dirty}")
+
+        stale = set()
+        for node_id in dirty:
+            stale.update(self.plan.nodes[node_id].output_keys.values())
+        new_ir = {k: v for k, v in full_ir.items() if k not in stale}
+        for _ in self._execute(
+            data=data,
+            full_ir=new_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            max_workers=max_workers,
+            only=dirty,
+        ):
+            pass
+
+        out = self._main_out(new_ir, print_thoughts=print_thoughts)
+        return out, ir_to_dict(new_ir)  # type: ignore
+
+    def batch_iter(
+        self,
+        inputs: Iterable[Union[str, Dict[str, Any]]],
+        max_concurrency: int = 8,
+        return_exceptions: bool = False,
+        ordered: bool = True,
+    ) -> Generator[Tuple[int, Any], None, None]:
+        """
+        Runs the chain over many inputs with a single scheduler. Instead of running each input as a separate chain,
+        the ready nodes of all the inputs in flight share one thread pool of ``max_concurrency`` workers, so branches
+        of the same input overlap as well as different inputs. New inputs are only started when the pool runs out of
+        ready nodes which keeps the number of open runs (and memory) low and the results coming back early. Use
+        ``Model.set_concurrency_limit`` to cap the calls to any single model.
+
+        It is meant for offline jobs, so it does less than ``__call__`` for each input: the ``timeout`` of the nodes
+        and a chain ``timeout`` are not applied, every node of a run gets a root span instead of one under a span of
+        the run, and nothing is checkpointed. Use ``threaded_map`` over ``__call__`` when you need those.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> for i, (out, thoughts) in chain.batch_iter(["hello", "world"], max_concurrency=16):
+            ...     print(i, out)
+
+        Args:
+            inputs (Iterable[Union[str, Dict[str, Any]]]): The inputs, each is same as ``data`` in ``__call__``.
+            max_concurrency (int, optional): The number of nodes that can run at the same time. Defaults to 8.
+            return_exceptions (bool, optional): If True the exception of a failed input is yielded as its result,
+                otherwise the first failure is raised. Defaults to False.
+            ordered (bool, optional): If True the results are yielded in the order of ``inputs``, otherwise as soon
+                as they complete. Defaults to True.
+
+        Yields:
+            Tuple[int, Any]: The index of the input and its result ``(out, full_ir)`` or the exception.
+        """
+        plan = self.plan
+        needed = self._needed_nodes()
+        total_nodes = len(plan.order) if needed is None else len(needed)
+        source = enumerate(inputs)
+        runs: Dict[int, Dict[str, Any]] = {}
+        finished: Dict[int, Any] = {}
+        next_i = 0
+
+        with ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="cf-batch"
+        ) as exe:
+            pending: Dict[Future, Tuple[int, str, int]] = {}
+
+            def _finish(i: int, result: Any):
+                run = runs.pop(i)
+                if isinstance(result, Exception) and not return_exceptions:
+                    raise result
+                if result is None:
+                    result = (
+                        self._main_out(run["full_ir"]),
+                        ir_to_dict(run["full_ir"]),
+                    )
+                finished[i] = result
+
+            def _submit(i: int, node_id: str):
+                run = runs[i]
+                if self._is_skipped(node_id, run["inactive"]):
+                    self._deactivate(node_id, None, run["inactive"])
+                    run["done"] += 1
+                    _release(i, node_id)
+                    return
+                try:
+                    _data = self._gather_inputs(
+                        node_id, run["data"], run["full_ir"], run["inactive"]
+                    )
+                except Exception as e:
+                    run["error"] = e
+                    return
+                fut = exe.submit(self._call_node, node_id, _data)
+                pending[fut] = (i, node_id, time.monotonic_ns())
+                run["inflight"] += 1
+
+            def _release(i: int, node_id: str):
+                run = runs[i]
+                for child in plan.nodes[node_id].children:
+                    if child not in run["remaining"]:
+                        continue
+                    run["remaining"][child] -= 1
+                    if run["remaining"][child] == 0:
+                        _submit(i, child)
+
+            def _admit() -> bool:
+                nxt = next(source, None)
+                if nxt is None:
+                    return False
+                i, data = nxt
+                run = {
+                    "full_ir": {},
+                    "inactive": set(),
+                    "inflight": 0,
+                    "done": 0,
+                    "error": None,
+                }
+                runs[i] = run
+                try:
+                    run["data"] = self._prepare_data(data)
+                    run["remaining"] = plan.remaining(needed)
+                except Exception as e:
+                    _finish(i, e)
+                    return True
+                for node_id in plan.order:
+                    if run["remaining"].get(node_id) == 0 and not run["error"]:
+                        _submit(i, node_id)
+                if run["error"] is not None and not run["inflight"]:
+                    _finish(i, run["error"])
+                elif run["done"] == total_nodes:
+                    _finish(i, None)
+                return True
+
+            try:
+                while True:
+                    # keep the pool busy, only open a new run when there is not enough ready work
+                    while len(pending) < max_concurrency and _admit():
+                        pass
+
+                    if ordered:
+                        while next_i in finished:
+                            yield next_i, finished.pop(next_i)
+                            next_i += 1
+                    else:
+                        for i in list(finished):
+                            yield i, finished.pop(i)
+
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in sorted(
+                        done,
+                        key=lambda f: (pending[f][0], plan.nodes[pending[f][1]].order),
+                    ):
+                        i, node_id, start_ns = pending.pop(fut)
+                        run = runs[i]
+                        run["inflight"] -= 1
+                        out, err = fut.result()
+                        if err and run["error"] is None:
+                            logger.error(f"TRACE: {out}")
+                            run["error"] = err
+                        if run["error"] is not None:
+                            if not run["inflight"]:
+                                _finish(i, run["error"])
+                            continue
+
+                        if node_id in plan.routers:
+                            self._deactivate(node_id, out, run["inactive"])
+                        self._record_outputs(
+                            node_id, out, run["full_ir"], start_ns=start_ns
+                        )
+                        run["done"] += 1
+                        _release(i, node_id)
+                        if run["error"] is not None and not run["inflight"]:
+                            _finish(i, run["error"])
+                        elif run["done"] == total_nodes:
+                            _finish(i, None)
+            finally:
+                for fut in pending:
+                    fut.cancel()
+
+    def batch(
+        self,
+        inputs: Iterable[Union[str, Dict[str, Any]]],
+        max_concurrency: int = 8,
+        return_exceptions: bool = False,
+    ) -> List[Any]:
+        """
+        Runs the chain over many inputs and returns the results in order, see ``batch_iter`` for the details.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> results = chain.batch(["hello", "world"], max_concurrency=16)
+            >>> out, thoughts = results[0]
+
+        Args:
+            inputs (Iterable[Union[str, Dict[str, Any]]]): The inputs, each is same as ``data`` in ``__call__``.
+            max_concurrency (int, optional): The number of nodes that can run at the same time. Defaults to 8.
+            return_exceptions (bool, optional): If True the exception of a failed input is returned as its result,
+                otherwise the first failure is raised. Defaults to False.
+
+        Returns:
+            List[Any]: The ``(out, full_ir)`` for each input, or the exception if ``return_exceptions`` is True.
+        """
+        return [
+            result
+            for _, result in self.batch_iter(
+                inputs,
+                max_concurrency=max_concurrency,
+                return_exceptions=return_exceptions,
             )
+        ]
+
+    def pipeline(
+        self,
+        inputs: Iterable[Union[str, Dict[str, Any]]],
+        workers: Optional[Dict[str, int]] = None,
+        queue_size: Union[int, Dict[str, int]] = 8,
+        return_exceptions: bool = False,
+        ordered: bool = True,
+    ) -> Generator[Tuple[int, Any], None, None]:
+        """
+        Runs the chain over a stream of inputs as a pipeline. Every node is a stage with its own worker threads and a
+        bounded queue in front of it, an input goes through the stages in the topological order so all the stages work
+        on different inputs at the same time, eg. in ``fetch -> clean -> embed -> write`` the next item is fetched
+        while the last one is embedded. When a stage is slower than the ones before it its queue fills up and the
+        earlier stages block, and so does reading ``inputs``, so only a bounded number of inputs are in memory. Unlike
+        ``batch_iter`` the branches of a single input do not overlap, use it for long streams of small inputs.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> for i, (out, thoughts) in chain.pipeline(read_docs(), workers={"embed": 4}, queue_size=16):
+            ...     print(i, out)
+
+        Args:
+            inputs (Iterable[Union[str, Dict[str, Any]]]): The inputs, each is same as ``data`` in ``__call__``. This
+                is read lazily so it can be a generator over a large or endless source.
+            workers (Optional[Dict[str, int]], optional): The number of threads of the stage of a node, the nodes that
+                are not in it get 1. Defaults to None.
+            queue_size (Union[int, Dict[str, int]], optional): The number of inputs that can wait in front of a stage,
+                pass a dict to set it for each node. Defaults to 8.
+            return_exceptions (bool, optional): If True the exception of a failed input is yielded as its result,
+                otherwise the first failure is raised. Defaults to False.
+            ordered (bool, optional): If True the results are yielded in the order of ``inputs``, otherwise as soon
+                as they leave the last stage. Defaults to True.
+
+        Yields:
+            Tuple[int, Any]: The index of the input and its result ``(out, full_ir)`` or the exception.
+        """
+        plan = self.plan
+        needed = self._needed_nodes()
+        stages = [n for n in plan.order if needed is None or n in needed]
+        workers = workers or {}
+        sizes = queue_size if isinstance(queue_size, dict) else {}
+        for node_id in list(workers) + list(sizes):
+            if node_id not in plan.nodes:
+                raise ValueError(f"Unknown node: {node_id}")
+
+        def _size(node_id: Optional[str] = None) -> int:
+            if isinstance(queue_size, dict):
+                return max(queue_size.get(node_id, 8), 1)  # type: ignore
+            return max(queue_size, 1)
+
+        # queues[k] is in front of stages[k] and the last one has the results
+        queues = [queue.Queue(maxsize=_size(n)) for n in stages]
+        queues.append(queue.Queue(maxsize=_size()))
+        alive = [max(workers.get(n, 1), 1) for n in stages]
+        lock = threading.Lock()
+        stop = threading.Event()
+        done = object()
+
+        def _put(q: queue.Queue, item: Any):
+            # the stop is checked so that nothing is stuck when the consumer stops early
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def _get(q: queue.Queue) -> Any:
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return done
+
+        def _feed():
+            try:
+                for i, data in enumerate(inputs):
+                    if stop.is_set():
+                        return
+                    run = {"i": i, "full_ir": {}, "inactive": set(), "error": None}
+                    try:
+                        run["data"] = self._prepare_data(data)
+                    except Exception as e:
+                        run["error"] = e
+                    _put(queues[0], run)
+            except Exception as e:
+                # reading the inputs failed, this is raised by the consumer
+                _put(queues[0], {"i": None, "error": e})
+            finally:
+                _put(queues[0], done)
+
+        def _stage(k: int, node_id: str):
+            while True:
+                run = _get(queues[k])
+                if run is done:
+                    # every worker of the stage has to see it, the last one passes it on
+                    with lock:
+                        alive[k] -= 1
+                        last = alive[k] == 0
+                    _put(queues[k + 1] if last else queues[k], done)
+                    return
+                if run["error"] is None:
+                    try:
+                        if self._is_skipped(node_id, run["inactive"]):
+                            self._deactivate(node_id, None, run["inactive"])
+                        else:
+                            self.step(
+                                node_id,
+                                run["data"],
+                                run["full_ir"],
+                                inactive=run["inactive"],
+                            )
+                    except Exception as e:
+                        run["error"] = e
+                _put(queues[k + 1], run)
+
+        exe = ThreadPoolExecutor(
+            max_workers=sum(alive) + 1, thread_name_prefix="cf-pipeline"
+        )
+        try:
+            exe.submit(_feed)
+            for k, node_id in enumerate(stages):
+                for _ in range(alive[k]):
+                    exe.submit(_stage, k, node_id)
+
+            finished: Dict[int, Any] = {}
+            next_i = 0
+            while True:
+                run = queues[-1].get()
+                if run is done:
+                    break
+                if run["i"] is None:
+                    raise run["error"]
+                result = run["error"]
+                if result is None:
+                    result = (
+                        self._main_out(run["full_ir"]),
+                        ir_to_dict(run["full_ir"]),
+                    )
+                elif not return_exceptions:
+                    raise result
+                if not ordered:
+                    yield run["i"], result
+                    continue
+                finished[run["i"]] = result
+                while next_i in finished:
+                    yield next_i, finished.pop(next_i)
+                    next_i += 1
+        finally:
+            stop.set()
+            exe.shutdown(wait=True)
+
+    async def acall(
+        self,
+        data: Union[str, Dict[str, Any]],
+        thoughts_callback: Optional[Callable] = None,
+        print_thoughts: bool = False,
+        outputs: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+        checkpoint: Optional[Checkpoint] = None,
+    ) -> Tuple[Var, Dict[str, Any]]:
+        """
+        Async version of ``__call__``, nodes are awaited on the running event loop and independent nodes run
+        concurrently. Models are awaited through ``Model.acall``, the rest of the nodes are run in worker threads.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> out, thoughts = await chain.acall("Hello world")
+
+        Args:
+            data (Union[str, Dict[str, Any]]): The data to run the chain on.
+            thoughts_callback (Optional[Callable], optional): The callback function to call at each step. Defaults to None.
+            print_thoughts (bool, optional): Whether to print the thoughts buffer at each step. Defaults to False.
+            outputs (Optional[Iterable[str]], optional): Prune the chain for this call, only the nodes needed for
+                ``main_out`` and these IR keys (or node ids) are run, see ``Chain(prune=...)``. Defaults to None.
+            timeout (Optional[float], optional): Seconds the whole chain is allowed to run for, after which the nodes
+                still running are abandoned and a ``ChainTimeoutError`` with the partial ``full_ir`` is raised. It is
+                passed down to the models as the timeout of their requests. Defaults to None.
+            checkpoint (Optional[Checkpoint], optional): Same as ``__call__``, the outputs are saved in a worker thread.
+                Defaults to None.
+
+        Returns:
+            Tuple[Var, Dict[str, Any]]: The output of the chain and the thoughts buffer.
+        """
+        data = self._prepare_data(data, print_thoughts=print_thoughts)
+        full_ir, only = self._restore(checkpoint, self._needed_nodes(outputs))
+        async for _, yield_dict in self._aexecute(
+            data=data,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            only=only,
+            deadline=_deadline(timeout),
+        ):
+            if checkpoint is not None:
+                await asyncio.to_thread(checkpoint.save, ir_to_dict(yield_dict))
+        out = self._main_out(full_ir, print_thoughts=print_thoughts)
+        return out, ir_to_dict(full_ir)  # type: ignore
+
+    async def astream(
+        self,
+        data: Union[str, Dict[str, Any]],
+        thoughts_callback: Optional[Callable] = None,
+        print_thoughts: bool = False,
+        stream_tokens: bool = False,
+        outputs: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+        checkpoint: Optional[Checkpoint] = None,
+    ):
+        """
+        Async version of ``stream``, yields the same ``(ir, done)`` tuples as the nodes complete. With
+        ``stream_tokens`` the chunks of the ``main_out`` node are read from ``Node.stream`` in a worker thread.
+
+        Example:
+            >>> chain = Chain(...)
+            >>> async for ir, done in chain.astream("Hello world"):
+            ...     print(ir, done)
+
+        Args:
+            data (Union[str, Dict[str, Any]]): The data to run the chain on.
+            thoughts_callback (Optional[Callable], optional): The callback function to call at each step. Defaults to None.
+            print_thoughts (bool, optional): Whether to print the thoughts buffer at each step. Defaults to False.
+            stream_tokens (bool, optional): Yield ``TokenDelta`` events while the ``main_out`` is being generated.
+                Defaults to False.
+            outputs (Optional[Iterable[str]], optional): Prune the chain for this call, only the nodes needed for
+                ``main_out`` and these IR keys (or node ids) are run, see ``Chain(prune=...)``. Defaults to None.
+            timeout (Optional[float], optional): Seconds the whole chain is allowed to run for, after which the nodes
+                still running are abandoned and a ``ChainTimeoutError`` with the partial ``full_ir`` is raised. It is
+                passed down to the models as the timeout of their requests. Defaults to None.
+            checkpoint (Optional[Checkpoint], optional): Same as ``stream``, the outputs are saved in a worker thread.
+                Defaults to None.
 
+        Yields:
+            Tuple[Union[Any, Dict[str, Any]], bool]: The intermediate responses and whether the response is the final
+            response or not.
+        """
+        data = self._prepare_data(data, print_thoughts=print_thoughts)
+        stream_node = self._stream_node() if stream_tokens else None
+        full_ir, only = self._restore(checkpoint, self._needed_nodes(outputs))
+        async for _, yield_dict in self._aexecute(
+            data=data,
+            full_ir=full_ir,
+            print_thoughts=print_thoughts,
+            thoughts_callback=thoughts_callback,
+            only=only,
+            deadline=_deadline(timeout),
+            stream_node=stream_node,
+        ):
+            if isinstance(yield_dict, TokenDelta):
+                yield yield_dict, False
+                continue
+            yield_dict = ir_to_dict(yield_dict)
+            if checkpoint is not None:
+                await asyncio.to_thread(checkpoint.save, yield_dict)
+            yield yield_dict, False
+        out = self._main_out(full_ir, print_thoughts=print_thoughts)
         yield out, True
 
 
@@ -2079,6 +4267,49 @@ class NotDAGError(Exception):
     pass
 
 
+class ChainTimeoutError(TimeoutError):
+    """Raised when a chain or one of its nodes runs past its deadline. The outputs of the nodes that did complete are
+    in ``full_ir`` and ``node_ids`` are the nodes that were still running.
+
+    Args:
+        full_ir (Dict[str, Any]): The IR of the nodes that completed before the deadline.
+        node_ids (List[str]): The nodes that did not complete in time.
+    """
+
+    def __init__(self, full_ir: Dict[str, Any], node_ids: List[str]):
+        super().__init__(f"Deadline exceeded while running nodes: {node_ids}")
+        self.full_ir = ir_to_dict(full_ir)
+        self.node_ids = node_ids
+
+
+def _action_signature(node: Node) -> Dict[str, Any]:
+    """The definition of the action of a node without anything that depends on the id of the node"""
+    sig = node.to_dict()
+    sig.pop("id")
+    sig.pop("description")
+    if sig["name"] == node.id:
+        sig.pop("name")
+    if node.type == NodeType.PROGRAMATIC:
+        # the name and module do not tell closures and lambdas apart, only the same function is the same action
+        sig["fn"] = id(node.fn)
+    elif isinstance(sig["fn"], dict):
+        sig["fn"] = {k: v for k, v in sig["fn"].items() if k != "node_id"}
+        if node.type in (NodeType.MAP, NodeType.ROUTER):
+            sig["fn"]["node"] = _action_signature(node.fn.node)  # type: ignore
+    return sig
+
+
+# marks the end of Node.stream
+_STREAM_END = object()
+
+# how often the executors look at the nodes that are waiting for a worker to start their timeout
+_QUEUE_POLL = 0.05
+
+
+def _deadline(timeout: Optional[float]) -> Optional[float]:
+    return None if timeout is None else time.monotonic() + timeout
+
+
 def edge_array_to_adjacency_list(edges: List[Edge]):
     adjacency_lists = {}
     for edge in edges:
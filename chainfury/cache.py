@@ -0,0 +1,225 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+Cache
+=====
+
+Small key value caches that are used to skip repeated work, like calling a model with the exact same parameters. All
+the backends are thread safe and count their hits and misses so you can size them.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+from chainfury.utils import logger
+
+
+def hash_key(*parts: Any) -> str:
+    """Canonical hash of any JSON-ish objects, dictionaries are hashed with sorted keys so the order in which the
+    parameters were built does not matter.
+
+    Args:
+        *parts (Any): The objects to hash.
+
+    Returns:
+        str: The hex digest of the hash.
+    """
+    blob = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+_llm_cache: ContextVar[bool] = ContextVar("cf_llm_cache", default=True)
+
+
+@contextmanager
+def llm_cache_scope(enabled: bool):
+    """Turn the model response caches off for all the code in this block, this is how ``Chain(llm_cache=False)``
+    reaches the models of its nodes without changing the nodes. Nested scopes can not turn it back on.
+
+    Args:
+        enabled (bool): When False the models neither read nor write their ``cache``.
+    """
+    if enabled or not _llm_cache.get():
+        yield
+        return
+    token = _llm_cache.set(False)
+    try:
+        yield
+    finally:
+        _llm_cache.reset(token)
+
+
+def llm_cache_enabled() -> bool:
+    """False inside a ``llm_cache_scope(False)``"""
+    return _llm_cache.get()
+
+
+class CacheBackend:
+    """Base class for all the caches, subclass this and implement ``_get``, ``_set``, ``clear`` and ``__len__``."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(size={len(self)}, hits={self.hits}, misses={self.misses})"
+
+    def __len__(self) -> int:
+        raise NotImplementedError(f"__len__ is not implemented for {self}")
+
+    def __deepcopy__(self, memo) -> "CacheBackend":
+        # caches are shared, copying a node or a model should not give it an empty cache
+        return self
+
+    def _get(self, key: str) -> Tuple[bool, Any]:
+        raise NotImplementedError(f"_get is not implemented for {self}")
+
+    def _set(self, key: str, value: Any) -> None:
+        raise NotImplementedError(f"_set is not implemented for {self}")
+
+    def clear(self) -> None:
+        """Remove everything from the cache"""
+        raise NotImplementedError(f"clear is not implemented for {self}")
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Get the value for the key.
+
+        Args:
+            key (str): The key, see ``hash_key``.
+
+        Returns:
+            Tuple[bool, Any]: Whether the key was found and the value.
+        """
+        found, value = self._get(key)
+        with self._stats_lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store the value for the key.
+
+        Args:
+            key (str): The key, see ``hash_key``.
+            value (Any): The value to store.
+        """
+        self._set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the hits, misses and size of the cache"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self),
+        }
+
+
+class InMemoryCache(CacheBackend):
+    """LRU cache in the memory of the process.
+
+    Args:
+        maxsize (int, optional): Maximum number of items in the cache. Defaults to 1024.
+        ttl (Optional[float], optional): Seconds after which an item expires, ``None`` means never. Defaults to None.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return False, None
+            created, value = item
+            if self.ttl is not None and time.monotonic() - created > self.ttl:
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            return True, value
+
+    def _set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class SQLiteCache(CacheBackend):
+    """On disk cache backed by SQLite, values must be JSON serialisable. This survives restarts and can be shared by
+    processes on the same machine.
+
+    Args:
+        fp (str): The path to the SQLite file.
+        ttl (Optional[float], optional): Seconds after which an item expires, ``None`` means never. Defaults to None.
+    """
+
+    def __init__(self, fp: str, ttl: Optional[float] = None):
+        super().__init__()
+        self.fp = fp
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(fp, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def _get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False, None
+            if self.ttl is not None and time.time() - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return False, None
+        return True, json.loads(row[0])
+
+    def _set(self, key: str, value: Any) -> None:
+        try:
+            blob = json.dumps(value)
+        except TypeError:
+            logger.warning(f"Cannot cache value of type {type(value)} in {self.fp}")
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
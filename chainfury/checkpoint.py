@@ -0,0 +1,89 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+Checkpoint
+==========
+
+A checkpoint stores the outputs of every node of a single chain run as soon as the node completes. When the run is
+interrupted (the process died, a timeout, an error) calling the chain again with the same checkpoint resumes it, the
+nodes whose outputs are in the checkpoint are not run again.
+
+    >>> from chainfury import Chain, FileCheckpoint
+    >>> chain = Chain(...)
+    >>> out, thoughts = chain.resume("hello", FileCheckpoint("run_1.jsonl"))
+"""
+
+import os
+import json
+import threading
+from typing import Any, Dict
+
+from chainfury.utils import logger
+
+
+class Checkpoint:
+    """Base class for the checkpoints of a run, subclass this and implement ``load``, ``save`` and ``clear``."""
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+    def load(self) -> Dict[str, Any]:
+        """Get the ``full_ir`` of everything saved so far, empty if nothing is saved"""
+        raise NotImplementedError(f"load is not implemented for {self}")
+
+    def save(self, ir: Dict[str, Any]) -> None:
+        """Store the outputs of a node that completed.
+
+        Args:
+            ir (Dict[str, Any]): The ``yield_dict`` of the node, ie. ``{"node_id/var": {"value": ..., ...}}``.
+        """
+        raise NotImplementedError(f"save is not implemented for {self}")
+
+    def clear(self) -> None:
+        """Remove everything from the checkpoint"""
+        raise NotImplementedError(f"clear is not implemented for {self}")
+
+
+class FileCheckpoint(Checkpoint):
+    """Checkpoint in a JSON lines file on the local disk, one line per completed node. Values must be JSON
+    serialisable, the nodes with other outputs are not saved and will run again on resume.
+
+    Args:
+        fp (str): The path to the file, it is created if it does not exist.
+    """
+
+    def __init__(self, fp: str):
+        self.fp = fp
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"FileCheckpoint('{self.fp}')"
+
+    def load(self) -> Dict[str, Any]:
+        full_ir = {}
+        if not os.path.exists(self.fp):
+            return full_ir
+        with self._lock, open(self.fp, "r") as f:
+            for line in f:
+                try:
+                    full_ir.update(json.loads(line))
+                except json.JSONDecodeError:
+                    # the process died while writing this line
+                    logger.warning(f"Skipping a broken line in checkpoint {self.fp}")
+        return full_ir
+
+    def save(self, ir: Dict[str, Any]) -> None:
+        try:
+            line = json.dumps(ir)
+        except TypeError:
+            logger.warning(f"Cannot checkpoint {list(ir)} in {self.fp}")
+            return
+        with self._lock, open(self.fp, "a") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self) -> None:
+        with self._lock:
+            if os.path.exists(self.fp):
+                os.remove(self.fp)
@@ -10,7 +10,7 @@ import json
 from fire import Fire
 from typing import Optional
 
-from chainfury import Chain
+from chainfury import Chain, ir_to_dict
 from chainfury.version import __version__
 from chainfury.core import model_registry
 from chainfury.types import Thread, Message
@@ -93,10 +93,10 @@ cf_version: {__version__}
             cf_response_gen = chain_obj.stream(inp, print_thoughts=print_thoughts)
             for ir, done in cf_response_gen:
                 if not done:
-                    f.write(json.dumps(ir) + "\n")
+                    f.write(json.dumps(ir_to_dict(ir)) + "\n")
         else:
             out, buffer = chain_obj(inp, print_thoughts=print_thoughts)
-            for k, v in buffer.items():
+            for k, v in ir_to_dict(buffer).items():
                 f.write(json.dumps({k: v}) + "\n")
 
         # close file
@@ -11,7 +11,7 @@ import json
 import requests
 from typing import Any, List, Dict, Tuple, Optional, Union
 
-from chainfury import programatic_actions_registry, exponential_backoff
+from chainfury import programatic_actions_registry, exponential_backoff, remaining_time
 from chainfury.base import get_value_by_keys
 from chainfury import types as T
 
@@ -45,7 +45,7 @@ def call_api_requests(
         headers (Dict[str, str], optional): The headers to send. Defaults to {}.
         cookies (Dict[str, str], optional): The cookies to send. Defaults to {}.
         auth (Dict[str, str], optional): The auth to send. Defaults to {}.
-        timeout (float, optional): The timeout in seconds. Defaults to 0.
+        timeout (float, optional): The timeout in seconds, capped by the deadline of the chain. Defaults to 0.
         max_retries (int, optional): The number of times to retry the request. Defaults to 3.
         retry_delay (int, optional): The number of seconds to wait between retries. Defaults to 1.
 
@@ -66,7 +66,7 @@ def call_api_requests(
                 headers=headers,
                 cookies=cookies,
                 auth=auth,  # type: ignore
-                timeout=None if not timeout else timeout,
+                timeout=remaining_time(timeout or None),
                 allow_redirects=True,
                 json=json,
             )
@@ -86,6 +86,7 @@ programatic_actions_registry.register(
     },
     node_id="call_api_requests",
     description="Call an API using the requests library",
+    side_effect=True,
 )
 
 
@@ -117,6 +118,7 @@ programatic_actions_registry.register(
     },
     node_id="regex_search",
     description="Perform a regex search on the text and get items in an array",
+    pure=True,
 )
 
 
@@ -148,6 +150,7 @@ programatic_actions_registry.register(
     },
     node_id="regex_substitute",
     description="Perform a regex substitution on the text and get the result",
+    pure=True,
 )
 
 
@@ -228,6 +231,7 @@ programatic_actions_registry.register(
     },
     node_id="json_translator",
     description="Extract a value from a JSON object using a list of keys",
+    pure=True,
 )
 
 
@@ -11,7 +11,9 @@ from chainfury import (
     exponential_backoff,
     Model,
     UnAuthException,
+    remaining_time,
 )
+from chainfury.tracing import add_usage
 from chainfury.components.const import Env
 from chainfury.types import Thread
 
@@ -102,7 +104,7 @@ class OpenaiGPTModel(Model):
                     "user": user,
                     **kwargs,
                 },
-                timeout=(5, 30),
+                timeout=(5, remaining_time(30)),
             )
             if r.status_code == 401:
                 raise UnAuthException(r.text)
@@ -110,7 +112,9 @@ class OpenaiGPTModel(Model):
                 raise Exception(
                     f"OpenAI API returned status code {r.status_code}: {r.text}"
                 )
-            return r.json()["choices"][0]["message"]["content"]
+            out = r.json()
+            add_usage(out.get("usage"))
+            return out["choices"][0]["message"]["content"]
 
         return exponential_backoff(
             _fn, max_retries=retry_count, retry_delay=retry_delay
@@ -163,6 +167,7 @@ def openai_embedding(
                 "input": input_strings,
                 "user": user,
             },
+            timeout=remaining_time(),
         )
         if r.status_code == 401:
             raise UnAuthException(r.text)
@@ -9,6 +9,7 @@ from chainfury import (
     exponential_backoff,
     Secret,
     UnAuthException,
+    remaining_time,
 )
 from chainfury.components.const import Env
 
@@ -192,6 +193,7 @@ def serper_api(
                 "page": page,
                 "type": search_type,
             },
+            timeout=remaining_time(),
         )
         if r.status_code == 401:
             raise UnAuthException(r.text)
@@ -5,7 +5,14 @@ import json
 from pydantic import BaseModel
 from typing import Any, List, Union, Dict, Optional
 
-from chainfury import Secret, model_registry, exponential_backoff, Model
+from chainfury import (
+    Secret,
+    model_registry,
+    exponential_backoff,
+    Model,
+    remaining_time,
+)
+from chainfury.tracing import add_usage
 from chainfury.components.const import Env
 from chainfury.types import Thread
 
@@ -72,12 +79,16 @@ class TuneModel(Model):
             "stream": False,
             "max_tokens": max_tokens,
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = requests.post(
+            url, headers=headers, json=data, timeout=remaining_time()
+        )
         try:
             response.raise_for_status()
         except Exception as e:
             raise e
-        return response.json()["choices"][0]["message"]["content"]
+        out = response.json()
+        add_usage(out.get("usage"))
+        return out["choices"][0]["message"]["content"]
 
     def stream_chat(
         self,
@@ -132,6 +143,7 @@ class TuneModel(Model):
             headers=headers,
             json=data,
             stream=True,
+            timeout=remaining_time(),
         )
         try:
             response.raise_for_status()
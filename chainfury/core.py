@@ -9,8 +9,12 @@ All actions that the AI can do.
 
 import copy
 import random
+import asyncio
+import threading
+import contextvars
 from uuid import uuid4
-from typing import Any, List, Optional, Dict, Tuple
+from typing import Any, List, Optional, Dict, Tuple, Generator
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
 
@@ -24,6 +28,8 @@ from chainfury.base import (
     get_value_by_keys,
     put_value_by_keys,
 )
+from chainfury.cache import CacheBackend, InMemoryCache
+from chainfury.hedging import HedgePolicy, LatencyWindow
 from chainfury.utils import logger
 
 
@@ -50,9 +56,16 @@ class ProgramaticActionsRegistry:
         node_id: str = "",
         description: str = "",
         tags: List[str] = [],
+        pure: bool = False,
+        cache: Optional[CacheBackend] = None,
+        side_effect: bool = False,
+        timeout: Optional[float] = None,
+        executor: str = "thread",
     ) -> Node:
         node_id = node_id or str(uuid4())
         ops = func_to_return_vars(func=fn, returns=outputs)
+        if pure and cache is None:
+            cache = InMemoryCache()
         node = Node(
             id=node_id,
             type=Node.types.PROGRAMATIC,
@@ -61,6 +74,10 @@ class ProgramaticActionsRegistry:
             fields=func_to_vars(fn),
             outputs=ops,
             tags=tags,
+            cache=cache,
+            side_effect=side_effect,
+            timeout=timeout,
+            executor=executor,
         )
         return node
 
@@ -71,6 +88,11 @@ class ProgramaticActionsRegistry:
         node_id: str = "",
         description: str = "",
         tags: List[str] = [],
+        pure: bool = False,
+        cache: Optional[CacheBackend] = None,
+        side_effect: bool = False,
+        timeout: Optional[float] = None,
+        executor: str = "thread",
     ) -> Node:
         """Register a programatic action in the registry
 
@@ -80,6 +102,15 @@ class ProgramaticActionsRegistry:
             description (str): Description of the node
             outputs ([type], optional): [description]. Defaults to None.
             tags (List[str], optional): List of tags. Defaults to [].
+            pure (bool, optional): The function always gives the same outputs for the same inputs, its outputs are
+                memoized in an ``InMemoryCache``. Defaults to False.
+            cache (Optional[CacheBackend], optional): Memoize in this cache instead, implies ``pure``. The cache is
+                shared by all the copies returned by ``get``. Defaults to None.
+            side_effect (bool, optional): The function changes something outside the chain, such nodes are never
+                pruned. Defaults to False.
+            timeout (Optional[float], optional): Seconds the node is allowed to run for in a chain. Defaults to None.
+            executor (str, optional): Use ``"process"`` for CPU heavy functions so they run in a process pool, the
+                function must be defined at the top level of a module. Defaults to "thread".
 
         Raises:
             Exception: If the node is already registered
@@ -100,6 +131,11 @@ class ProgramaticActionsRegistry:
             description=description,
             outputs=outputs,
             tags=tags,
+            pure=pure,
+            cache=cache,
+            side_effect=side_effect,
+            timeout=timeout,
+            executor=executor,
         )
         self.nodes[node_id] = node
         for tag in tags:
@@ -170,6 +206,10 @@ class AIAction:
         model (Model): The model that is used for this action
         model_params (Dict[str, Any]): The parameters for the model
         fn (object): The function that is used for this action
+        use_cache (bool, optional): Whether the model call can be served from the response cache of the model, see
+            ``Model.set_cache``. Defaults to True.
+        hedging (Optional[HedgePolicy], optional): Hedge the model calls of this action with this policy instead of
+            the one of the model, see ``Model.set_hedging``. Defaults to None.
     """
 
     FNTYPE = "cf_aifn_type"
@@ -188,6 +228,8 @@ class AIAction:
         model_params: Dict[str, Any],
         fn: object,
         action_name: str,
+        use_cache: bool = True,
+        hedging: Optional[HedgePolicy] = None,
     ):
         # do some basic checks that we can do before anything else like checking if model_params
         # is a subset of the model.vars
@@ -233,6 +275,8 @@ class AIAction:
         self.action_name = action_name
         self.action_source = action_source
         self.fields = fields
+        self.use_cache = use_cache
+        self.hedging = hedging
 
     def to_dict(self, no_vars: bool = False) -> Dict[str, Any]:
         """Serialize the AIAction object to a dict."""
@@ -243,6 +287,7 @@ class AIAction:
             "fn": self.fn,
             "action_name": self.action_name,
             "action_source": self.action_source,
+            "hedging": self.hedging.to_dict() if self.hedging else None,
         }
 
     @classmethod
@@ -254,18 +299,13 @@ class AIAction:
             model_params=data["model_params"],
             fn=data["fn"],
             action_name=data.get("action_name", data["node_id"]),
+            hedging=(
+                HedgePolicy.from_dict(data["hedging"]) if data.get("hedging") else None
+            ),
         )
 
-    def __call__(self, **data: Dict[str, Any]) -> Tuple[Any, Optional[Exception]]:
-        """This is a callable that takes in all the arguments that the underlying models take.
-
-        Args:
-            **data (Dict[str, Any]): The data that is passed to the model
-
-        Returns:
-            Tuple[Any, Optional[Exception]]: The output of the model and the exception if any
-        """
-
+    def _model_params(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Run the preprocessor over ``data`` and build the final parameters that are passed to the model."""
         # check for keys even before calling any API or something
         # we need to create a sub dict that only contains the fields that are needed by the preprocessor
         # function and pass the rest of the data to the model call
@@ -279,14 +319,11 @@ class AIAction:
                 _data[f.name] = data.pop(f.name)
 
         if self.action_source == AIAction.FUNC:
-            try:
-                fn_out = self.fn(**_data)  # type: ignore
-                if self.action_source == AIAction.FUNC and not type(fn_out) == dict:
-                    raise Exception(
-                        f"AI Action preprocessor for {self.node_id} did not return a dict but {type(fn_out)}"
-                    )
-            except Exception as e:
-                return "", e
+            fn_out = self.fn(**_data)  # type: ignore
+            if self.action_source == AIAction.FUNC and not type(fn_out) == dict:
+                raise Exception(
+                    f"AI Action preprocessor for {self.node_id} did not return a dict but {type(fn_out)}"
+                )
         elif self.action_source == AIAction.JTYPE:
             fn_out = copy.deepcopy(self.fn)
             for raw, t, keys in self.templates:
@@ -298,13 +335,68 @@ class AIAction:
         model_final_params = {**self.model_params}
         model_final_params.update(data)
         model_final_params.update(fn_out)  # type: ignore
-        print("--->>> model_final_params:", model_final_params)
-        out, err = self.model(model_final_params)
+        logger.debug(f"model_final_params: {model_final_params}")
+        return model_final_params
+
+    def __call__(self, **data: Dict[str, Any]) -> Tuple[Any, Optional[Exception]]:
+        """This is a callable that takes in all the arguments that the underlying models take.
+
+        Args:
+            **data (Dict[str, Any]): The data that is passed to the model
+
+        Returns:
+            Tuple[Any, Optional[Exception]]: The output of the model and the exception if any
+        """
+        try:
+            model_final_params = self._model_params(data)
+        except Exception as e:
+            return "", e
+        out, err = self.model(
+            model_final_params, use_cache=self.use_cache, hedging=self.hedging
+        )
         if err != None:
             return "", err
 
         return out, err
 
+    async def acall(self, **data: Dict[str, Any]) -> Tuple[Any, Optional[Exception]]:
+        """Async version of ``__call__``, the preprocessor runs inline and the model is awaited with ``Model.acall``.
+
+        Args:
+            **data (Dict[str, Any]): The data that is passed to the model
+
+        Returns:
+            Tuple[Any, Optional[Exception]]: The output of the model and the exception if any
+        """
+        try:
+            model_final_params = self._model_params(data)
+        except Exception as e:
+            return "", e
+        out, err = await self.model.acall(
+            model_final_params, use_cache=self.use_cache, hedging=self.hedging
+        )
+        if err != None:
+            return "", err
+
+        return out, err
+
+    @property
+    def can_stream(self) -> bool:
+        """True if the model of this action can stream its response, see ``Model.can_stream``"""
+        return self.model.can_stream
+
+    def stream(self, **data: Dict[str, Any]) -> Generator[str, None, None]:
+        """Streaming version of ``__call__``, yields the text deltas of the model. Errors are raised.
+
+        Args:
+            **data (Dict[str, Any]): The data that is passed to the model
+
+        Yields:
+            str: The text deltas
+        """
+        model_final_params = self._model_params(data)
+        yield from self.model.stream(model_final_params, use_cache=self.use_cache)
+
 
 class AIActionsRegistry:
     """This class is a registry for all the AI actions."""
@@ -323,6 +415,7 @@ class AIActionsRegistry:
         outputs: Dict[str, Any],
         node_id: str = "",
         description: str = "",
+        hedging: Optional[HedgePolicy] = None,
     ) -> Node:
         """
         function to create an "Action" aka. `chainfury.Node`.
@@ -338,6 +431,7 @@ class AIActionsRegistry:
               and value automatically extracted from the model output at location `(-1, 'b', 'c')`.
             node_id (str, optional): The node id for this action. Defaults to "".
             description (str, optional): The description for this action. Defaults to "".
+            hedging (Optional[HedgePolicy], optional): Hedge the model calls of this action. Defaults to None.
 
         Returns:
             Node: The node object that can be used to create a chain
@@ -352,6 +446,7 @@ class AIActionsRegistry:
             model_params=model_params,
             fn=fn,
             action_name=action_name,
+            hedging=hedging,
         )
         if not outputs:
             output_field = func_to_return_vars(
@@ -381,6 +476,7 @@ class AIActionsRegistry:
         action_name: str = "",
         description: str = "",
         tags: List[str] = [],
+        hedging: Optional[HedgePolicy] = None,
     ) -> Node:
         """
         This function will register this action in the local AI registry so it is accesible everywhere. Use this when
@@ -400,6 +496,7 @@ class AIActionsRegistry:
                 and value automatically extracted from the model output at location `(-1, 'b', 'c')`.
             description (str, optional): The description for this action. Defaults to "".
             tags (List[str], optional): The tags for this action. Defaults to [].
+            hedging (Optional[HedgePolicy], optional): Hedge the model calls of this action. Defaults to None.
         """
         logger.debug(f"Registering ai-node '{node_id}'")
         if node_id in self.nodes:
@@ -412,6 +509,7 @@ class AIActionsRegistry:
             fn=fn,
             outputs=outputs,
             description=description,
+            hedging=hedging,
         )
 
         # this is just the server instance register
@@ -673,6 +771,7 @@ class MemoryRegistry:
             outputs=output_fields,
             description=description,
             tags=tags,
+            side_effect=True,
         )
         self._memories[node_id] = node
         return node
@@ -717,6 +816,263 @@ class MemoryRegistry:
         return {k: v.to_dict() for k, v in self._memories.items()}
 
 
+# Map Actions
+# -----------
+# A map action runs an inner node once for every item of a list input and gathers the outputs into lists. The items
+# are run concurrently so the per-item model calls of a chain (eg. summarise each retrieved document) overlap.
+
+
+class MapAction:
+    """This class is a callable that runs ``node`` over every item of the list input ``over``, the other inputs are
+    passed as is to every call. Each output of ``node`` becomes a list output with one value per item, in order.
+
+    Args:
+        node_id (str): The id of the map node
+        node (Node): The node to run for each item
+        over (str): The field of ``node`` that gets the items, the map node takes a list for it
+        max_workers (int, optional): The maximum number of items that are run at the same time. Defaults to 4.
+    """
+
+    def __init__(self, node_id: str, node: Node, over: str, max_workers: int = 4):
+        if not node.has_field(over):
+            raise ValueError(f"Node '{node.id}' has no field '{over}' to map over")
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+        self.node_id = node_id
+        self.node = node
+        self.over = over
+        self.max_workers = max_workers
+
+        self.fields: List[Var] = []
+        for f in node.fields:
+            if f.name != over:
+                self.fields.append(f)
+                continue
+            item = f.to_dict()
+            for k in ("name", "required", "loc"):
+                item.pop(k, None)
+            self.fields.append(
+                Var(
+                    type="array",
+                    items=[Var.from_dict(item)],
+                    name=over,
+                    required=True,
+                    description=f.description,
+                )
+            )
+        self.outputs: List[Var] = [
+            Var(
+                type="array",
+                items=[Var(type=o.type)],
+                name=o.name,
+                loc=(o.name,),
+            )
+            for o in node.outputs
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the MapAction object to a dict."""
+        return {
+            "node_id": self.node_id,
+            "node": self.node.to_dict(),
+            "over": self.over,
+            "max_workers": self.max_workers,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        """Deserialize the MapAction object from a dict."""
+        return cls(
+            node_id=data["node_id"],
+            node=Node.from_dict(data["node"]),
+            over=data["over"],
+            max_workers=data.get("max_workers", 4),
+        )
+
+    def _items(self, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        items = data.pop(self.over)
+        if not isinstance(items, (list, tuple)):
+            raise ValueError(
+                f"'{self.over}' of map node '{self.node_id}' must be a list, got {type(items)}"
+            )
+        return [{**data, self.over: x} for x in items]
+
+    def _gather(self, fouts: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        return {o.name: [fout[o.name] for fout in fouts] for o in self.node.outputs}
+
+    def __call__(self, **data: Dict[str, Any]) -> Dict[str, List[Any]]:
+        """Runs the node for all the items on a thread pool, the first error is raised and the items that did not
+        start yet are cancelled.
+
+        Args:
+            **data (Dict[str, Any]): The inputs of the map node
+
+        Returns:
+            Dict[str, List[Any]]: The list of values for each output of the node
+        """
+        items = self._items(data)
+        if self.max_workers == 1 or len(items) < 2:
+            fouts = []
+            for x in items:
+                fout, err = self.node(x)
+                if err is not None:
+                    raise err
+                fouts.append(fout)
+            return self._gather(fouts)
+
+        # each item runs in a copy of this context so the deadline and the trace of the map node are seen in the
+        # worker threads
+        exe = ThreadPoolExecutor(min(self.max_workers, len(items)))
+        try:
+            futures = [
+                exe.submit(contextvars.copy_context().run, self.node, x) for x in items
+            ]
+            fouts = []
+            for fut in futures:
+                fout, err = fut.result()
+                if err is not None:
+                    raise err
+                fouts.append(fout)
+        finally:
+            exe.shutdown(wait=False, cancel_futures=True)
+        return self._gather(fouts)
+
+    async def acall(self, **data: Dict[str, Any]) -> Dict[str, List[Any]]:
+        """Async version of ``__call__``, at most ``max_workers`` items are awaited at the same time and the rest are
+        cancelled on the first error.
+
+        Args:
+            **data (Dict[str, Any]): The inputs of the map node
+
+        Returns:
+            Dict[str, List[Any]]: The list of values for each output of the node
+        """
+        items = self._items(data)
+        sem = asyncio.Semaphore(self.max_workers)
+
+        async def _one(x: Dict[str, Any]) -> Dict[str, Any]:
+            async with sem:
+                fout, err = await self.node.acall(x)
+            if err is not None:
+                raise err
+            return fout
+
+        tasks = [asyncio.ensure_future(_one(x)) for x in items]
+        try:
+            fouts = await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+        return self._gather(list(fouts))
+
+
+# Router Actions
+# --------------
+# A router action asks an inner node which route to take and only sends a value on the routes that were picked. The
+# chain skips the nodes that only read from the other routes, so an intent routing bot runs a single branch.
+
+
+class RouterAction:
+    """This class is a callable that runs ``node`` to pick one or more of the ``routes``. The outputs are the routes and
+    only the ones that were picked are returned, with the value of the ``passthrough`` input.
+
+    Args:
+        node_id (str): The id of the router node
+        node (Node): The node that picks the route, its first output is the route name or a list of route names
+        routes (List[str]): The names of the routes
+        passthrough (str, optional): The field of ``node`` that is sent on the routes. Defaults to the first field.
+        default (str, optional): The route for unknown picks, if empty an unknown pick is an error. Defaults to "".
+    """
+
+    def __init__(
+        self,
+        node_id: str,
+        node: Node,
+        routes: List[str],
+        passthrough: str = "",
+        default: str = "",
+    ):
+        if not routes:
+            raise ValueError(f"Router '{node_id}' needs at least one route")
+        if not node.outputs:
+            raise ValueError(f"Node '{node.id}' has no output to route by")
+        if default and default not in routes:
+            raise ValueError(f"Default route '{default}' is not in {routes}")
+        passthrough = passthrough or (node.fields[0].name if node.fields else "")
+        if not node.has_field(passthrough):
+            raise ValueError(f"Node '{node.id}' has no field '{passthrough}'")
+        self.node_id = node_id
+        self.node = node
+        self.routes = list(routes)
+        self.passthrough = passthrough
+        self.default = default
+
+        field = [f for f in node.fields if f.name == passthrough][0]
+        self.outputs: List[Var] = [
+            Var(type=field.type, name=r, loc=(r,)) for r in self.routes
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the RouterAction object to a dict."""
+        return {
+            "node_id": self.node_id,
+            "node": self.node.to_dict(),
+            "routes": self.routes,
+            "passthrough": self.passthrough,
+            "default": self.default,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        """Deserialize the RouterAction object from a dict."""
+        return cls(
+            node_id=data["node_id"],
+            node=Node.from_dict(data["node"]),
+            routes=data["routes"],
+            passthrough=data.get("passthrough", ""),
+            default=data.get("default", ""),
+        )
+
+    def _route(self, fout: Dict[str, Any], value: Any) -> Dict[str, Any]:
+        picked = fout[self.node.outputs[0].name]
+        picked = picked if isinstance(picked, (list, tuple)) else [picked]
+        out = {}
+        for route in picked:
+            route = str(route).strip()
+            if route not in self.routes:
+                if not self.default:
+                    raise ValueError(
+                        f"Router '{self.node_id}' got unknown route '{route}', expected one of {self.routes}"
+                    )
+                route = self.default
+            out[route] = value
+        return out
+
+    def __call__(self, **data: Dict[str, Any]) -> Dict[str, Any]:
+        """Runs the node and returns the value for each route that was picked.
+
+        Args:
+            **data (Dict[str, Any]): The inputs of the node
+
+        Returns:
+            Dict[str, Any]: The ``passthrough`` value keyed by the routes that were picked
+        """
+        value = data.get(self.passthrough)
+        fout, err = self.node(dict(data))
+        if err is not None:
+            raise err
+        return self._route(fout, value)
+
+    async def acall(self, **data: Dict[str, Any]) -> Dict[str, Any]:
+        """Async version of ``__call__``"""
+        value = data.get(self.passthrough)
+        fout, err = await self.node.acall(dict(data))
+        if err is not None:
+            raise err
+        return self._route(fout, value)
+
+
 # Models Registry
 # ---------------
 # All the things below are for the models that are registered in the model registry, so that they can be used as inputs
@@ -730,6 +1086,8 @@ class ModelRegistry:
         self.models: Dict[str, Model] = {}
         self.counter: Dict[str, int] = {}
         self.tags_to_models: Dict[str, List[str]] = {}
+        self.latencies: Dict[str, LatencyWindow] = {}
+        self._latency_lock = threading.Lock()
 
     def has(self, id: str):
         """A helper function to check if a model is registered or not"""
@@ -801,6 +1159,30 @@ class ModelRegistry:
     def get_any_model(self) -> Model:
         return random.choice(list(self.models.values()))
 
+    def latency(self, id: str) -> LatencyWindow:
+        """Get the recent latency of a model, every call to the model is recorded here. The model need not be
+        registered.
+
+        Args:
+            id (str): Id of the model
+
+        Returns:
+            LatencyWindow: The latency window
+        """
+        window = self.latencies.get(id)
+        if window is None:
+            with self._latency_lock:
+                window = self.latencies.setdefault(id, LatencyWindow())
+        return window
+
+    def get_latency_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the latency percentiles and the hedging counts of all the models that were called
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The stats keyed by the model id
+        """
+        return {k: v.stats() for k, v in self.latencies.items()}
+
 
 # Initialise Registries
 # ---------------------
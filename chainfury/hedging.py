@@ -0,0 +1,256 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+Hedging
+=======
+
+The latency of the LLM APIs has a long tail, a few calls take many times the median. Hedging sends a duplicate of a
+call that is slower than most recent calls and takes whichever response comes first. The latency of every model is
+tracked in ``model_registry`` and a ``HedgePolicy`` decides after how long a call is hedged.
+
+    >>> from chainfury import model_registry, HedgePolicy
+    >>> model_registry.get("openai-chat").set_hedging(HedgePolicy(percentile=95))
+    >>> model_registry.get_latency_stats()["openai-chat"]
+    {'count': 256, 'p50': 1.2, 'p90': 2.7, 'p99': 9.8, 'hedges': 13, 'hedge_wins': 9}
+"""
+
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from chainfury.utils import CFEnv
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class LatencyWindow:
+    """Latency in seconds of the most recent calls, used to find the percentiles.
+
+    Args:
+        size (int, optional): The number of calls to remember. Defaults to 256.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._items: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"LatencyWindow(count={len(self)}, p50={self.percentile(50)}, p99={self.percentile(99)})"
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __deepcopy__(self, memo) -> "LatencyWindow":
+        # same as the caches, the window belongs to the model id and not to any single copy
+        return self
+
+    def record(self, seconds: float) -> None:
+        """Add the latency of a call.
+
+        Args:
+            seconds (float): The time the call took.
+        """
+        with self._lock:
+            self._items.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """The nearest rank percentile of the recent latencies.
+
+        Args:
+            q (float): The percentile between 0 and 100.
+
+        Returns:
+            Optional[float]: The latency in seconds, ``None`` if there are no calls yet.
+        """
+        with self._lock:
+            items = sorted(self._items)
+        if not items:
+            return None
+        idx = min(max(int(len(items) * q / 100 + 0.5) - 1, 0), len(items) - 1)
+        return items[idx]
+
+    def count_hedge(self, won: bool = False) -> None:
+        """Count a hedged call, or with ``won`` a hedge that returned before the original call."""
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedges += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the number of calls, the p50, p90 and p99 latencies and how often the calls were hedged"""
+        return {
+            "count": len(self),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class HedgePolicy:
+    """Decides when a call to a model is hedged. Once there are ``min_samples`` calls in the latency window, a call that
+    has not returned after the ``percentile`` latency (clamped to ``[min_delay, max_delay]``) gets a duplicate.
+
+    Hedging with ``percentile=95`` sends about 5% more requests, so only use it for calls that are safe to repeat.
+
+    Args:
+        percentile (float, optional): The percentile of the recent latency after which to hedge. Defaults to 95.
+        min_samples (int, optional): Do not hedge until this many calls were seen. Defaults to 20.
+        min_delay (float, optional): Never hedge sooner than this many seconds. Defaults to 0.0.
+        max_delay (Optional[float], optional): Always hedge after this many seconds, also used before there are
+            ``min_samples`` calls. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        min_samples: int = 20,
+        min_delay: float = 0.0,
+        max_delay: Optional[float] = None,
+    ):
+        if not 0 < percentile <= 100:
+            raise ValueError(f"percentile must be in (0, 100], got {percentile}")
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def __repr__(self) -> str:
+        return (
+            f"HedgePolicy(percentile={self.percentile}, min_samples={self.min_samples})"
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "percentile": self.percentile,
+            "min_samples": self.min_samples,
+            "min_delay": self.min_delay,
+            "max_delay": self.max_delay,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "HedgePolicy":
+        return cls(**data)
+
+    def delay(self, window: LatencyWindow) -> Optional[float]:
+        """The seconds after which a call is hedged.
+
+        Args:
+            window (LatencyWindow): The recent latency of the model.
+
+        Returns:
+            Optional[float]: The delay or ``None`` if the call should not be hedged.
+        """
+        latency = window.percentile(self.percentile)
+        if latency is None or len(window) < self.min_samples:
+            return self.max_delay
+        delay = max(latency, self.min_delay)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # the pool is shared by all the models, size it with CF_HEDGE_WORKERS when the sync calls to the
+                # models are more than about half of it, or the calls queue here before their hedge timer starts
+                _executor = ThreadPoolExecutor(
+                    max_workers=CFEnv.CF_HEDGE_WORKERS(), thread_name_prefix="cf-hedge"
+                )
+    return _executor
+
+
+def hedged_call(
+    fn: Callable[[], Any], delay: float, window: Optional[LatencyWindow] = None
+) -> Any:
+    """Call ``fn`` and if it has not returned after ``delay`` seconds call it again, the first successful result is
+    returned and the other call is cancelled. A call that is already running in a thread cannot be stopped, so its
+    result is simply dropped. If both the calls fail the first error is raised.
+
+    Args:
+        fn (Callable[[], Any]): The call to make, it must be safe to run twice.
+        delay (float): Seconds to wait before sending the duplicate.
+        window (Optional[LatencyWindow], optional): Count the hedges and the wins in this window. Defaults to None.
+
+    Returns:
+        Any: The result of ``fn``.
+    """
+    exe = _get_executor()
+    # the calls run in other threads, so they get a copy of the context with the deadline of the chain
+    first = exe.submit(contextvars.copy_context().run, fn)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    second = exe.submit(contextvars.copy_context().run, fn)
+    if window is not None:
+        window.count_hedge()
+    pending: List[Future] = [first, second]
+    error: Optional[BaseException] = None
+    while pending:
+        done, rest = wait(pending, return_when=FIRST_COMPLETED)
+        pending = list(rest)
+        for fut in done:
+            if fut.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                if window is not None and fut is second:
+                    window.count_hedge(won=True)
+                return fut.result()
+            error = error or fut.exception()
+    raise error  # type: ignore
+
+
+async def ahedged_call(
+    fn: Callable[[], Awaitable[Any]],
+    delay: float,
+    window: Optional[LatencyWindow] = None,
+) -> Any:
+    """Async version of ``hedged_call``, here the losing call is cancelled for real.
+
+    Args:
+        fn (Callable[[], Awaitable[Any]]): Creates the coroutine to await, it must be safe to run twice.
+        delay (float): Seconds to wait before sending the duplicate.
+        window (Optional[LatencyWindow], optional): Count the hedges and the wins in this window. Defaults to None.
+
+    Returns:
+        Any: The result of ``fn``.
+    """
+    first = asyncio.ensure_future(fn())
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+
+        second = asyncio.ensure_future(fn())
+        pending.add(second)
+        if window is not None:
+            window.count_hedge()
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    if window is not None and task is second:
+                        window.count_hedge(won=True)
+                    return task.result()
+                error = error or task.exception()
+        raise error  # type: ignore
+    finally:
+        for task in pending:
+            task.cancel()
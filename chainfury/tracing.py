@@ -0,0 +1,395 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+"""
+Tracing
+=======
+
+Every node that a ``Chain`` runs can be recorded as a ``Span`` with its wall time, CPU time, the size of its inputs
+and outputs, the model it called, the retries and the tokens used. Add a ``Tracer`` to the chain to get them:
+
+    >>> from chainfury import Chain, SummaryTracer
+    >>> chain = Chain(...)
+    >>> summary = chain.add_tracer(SummaryTracer())
+    >>> chain("hello")
+    >>> print(summary.table())
+
+When a chain has no tracers nothing is measured, the nodes are called directly.
+"""
+
+import json
+import time
+import threading
+from uuid import uuid4
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from tabulate import tabulate
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("cf_span", default=None)
+_span_lock = threading.Lock()
+
+
+class Span:
+    """A single timed operation, either a node or the whole run of a chain (``kind="chain"``). All the times are in
+    seconds and the sizes are the bytes of the JSON of the inputs and outputs.
+
+    Args:
+        name (str): The node id, or the chain name for a chain span.
+        kind (str): The type of the node or ``"chain"``.
+        parent (Optional[Span], optional): The span of the chain run this node belongs to. Defaults to None.
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "kind",
+        "start_ns",
+        "end_ns",
+        "wall",
+        "cpu",
+        "input_bytes",
+        "output_bytes",
+        "model_id",
+        "retries",
+        "usage",
+        "error",
+    )
+
+    def __init__(self, name: str, kind: str, parent: Optional["Span"] = None):
+        self.trace_id = parent.trace_id if parent else uuid4().hex
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.wall: Optional[float] = None
+        self.cpu: Optional[float] = None
+        self.input_bytes: Optional[int] = None
+        self.output_bytes: Optional[int] = None
+        self.model_id: Optional[str] = None
+        self.retries = 0
+        self.usage: Dict[str, int] = {}
+        self.error: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"Span('{self.name}', kind='{self.kind}', wall={self.wall})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Converts the span to a flat dictionary"""
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def to_otel(self) -> Dict[str, Any]:
+        """Converts the span to the OTLP JSON format of OpenTelemetry, it goes in ``scopeSpans[].spans[]``"""
+        attributes = {
+            "chainfury.kind": self.kind,
+            "chainfury.wall_s": self.wall,
+            "chainfury.cpu_s": self.cpu,
+            "chainfury.input_bytes": self.input_bytes,
+            "chainfury.output_bytes": self.output_bytes,
+            "chainfury.model_id": self.model_id,
+            "chainfury.retries": self.retries,
+        }
+        for k, v in self.usage.items():
+            attributes[f"llm.usage.{k}"] = v
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [
+                {"key": k, "value": _otel_value(v)}
+                for k, v in attributes.items()
+                if v is not None
+            ],
+            "status": (
+                {"code": 2, "message": self.error} if self.error else {"code": 1}
+            ),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Tracer:
+    """Base class for the tracing hooks of a ``Chain``, subclass this and implement ``on_start`` and ``on_end``. The
+    hooks are called from the thread that runs the node, so with ``max_workers > 1`` they must be thread safe.
+    """
+
+    def on_start(self, span: Span) -> None:
+        """Called right before the node starts, only the name, kind, ids and input size are set"""
+        pass
+
+    def on_end(self, span: Span) -> None:
+        """Called when the node is done, with all the measurements set"""
+        pass
+
+
+class SummaryTracer(Tracer):
+    """Aggregates the spans in memory per node, use ``summary`` or ``table`` to see where the time goes."""
+
+    def __init__(self):
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span) -> None:
+        with self._lock:
+            row = self._rows.setdefault(
+                span.name,
+                {
+                    "kind": span.kind,
+                    "count": 0,
+                    "errors": 0,
+                    "wall": 0.0,
+                    "wall_max": 0.0,
+                    "cpu": 0.0,
+                    "input_bytes": 0,
+                    "output_bytes": 0,
+                    "retries": 0,
+                    "tokens": 0,
+                },
+            )
+            row["count"] += 1
+            row["errors"] += span.error is not None
+            row["wall"] += span.wall or 0.0
+            row["wall_max"] = max(row["wall_max"], span.wall or 0.0)
+            row["cpu"] += span.cpu or 0.0
+            row["input_bytes"] += span.input_bytes or 0
+            row["output_bytes"] += span.output_bytes or 0
+            row["retries"] += span.retries
+            row["tokens"] += span.usage.get("total_tokens", 0)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Get the totals keyed by the node id"""
+        with self._lock:
+            return {k: dict(v) for k, v in self._rows.items()}
+
+    def table(self) -> str:
+        """The summary as a table sorted by the total wall time"""
+        rows = []
+        for name, r in sorted(self.summary().items(), key=lambda x: -x[1]["wall"]):
+            rows.append(
+                [
+                    name,
+                    r["kind"],
+                    r["count"],
+                    r["errors"],
+                    f"{r['wall'] * 1000:.1f}",
+                    f"{r['wall'] / r['count'] * 1000:.1f}",
+                    f"{r['wall_max'] * 1000:.1f}",
+                    f"{r['cpu'] * 1000:.1f}",
+                    r["input_bytes"],
+                    r["output_bytes"],
+                    r["retries"],
+                    r["tokens"],
+                ]
+            )
+        headers = [
+            "name",
+            "kind",
+            "count",
+            "errors",
+            "wall ms",
+            "mean ms",
+            "max ms",
+            "cpu ms",
+            "in bytes",
+            "out bytes",
+            "retries",
+            "tokens",
+        ]
+        return tabulate(rows, headers=headers)
+
+    def reset(self) -> None:
+        """Forget all the spans"""
+        with self._lock:
+            self._rows.clear()
+
+
+class JSONLTracer(Tracer):
+    """Appends every finished span as a line of JSON to a file.
+
+    Args:
+        fp (str): The path to the file.
+    """
+
+    def __init__(self, fp: str):
+        self.fp = fp
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span) -> None:
+        line = json.dumps(span.to_dict())
+        with self._lock, open(self.fp, "a") as f:
+            f.write(line + "\n")
+
+
+class OTelTracer(Tracer):
+    """Collects the spans in the OTLP JSON format of OpenTelemetry, ``export`` gives the payload that can be posted to
+    the ``/v1/traces`` endpoint of any OpenTelemetry collector.
+
+    Args:
+        service_name (str, optional): The ``service.name`` of the resource. Defaults to "chainfury".
+        max_spans (int, optional): Keep at most these many spans, the oldest are dropped. Defaults to 10000.
+    """
+
+    def __init__(self, service_name: str = "chainfury", max_spans: int = 10000):
+        self.service_name = service_name
+        self.max_spans = max_spans
+        self._spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span) -> None:
+        otel = span.to_otel()
+        with self._lock:
+            self._spans.append(otel)
+            if len(self._spans) > self.max_spans:
+                del self._spans[: len(self._spans) - self.max_spans]
+
+    def export(self, clear: bool = True) -> Dict[str, Any]:
+        """Get the collected spans as an OTLP ``ExportTraceServiceRequest``.
+
+        Args:
+            clear (bool, optional): Forget the spans that were exported. Defaults to True.
+
+        Returns:
+            Dict[str, Any]: The JSON payload.
+        """
+        with self._lock:
+            spans = self._spans
+            if clear:
+                self._spans = []
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "chainfury"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+# helpers
+
+
+def current_span() -> Optional[Span]:
+    """The span of the node that is running in this context, ``None`` when tracing is off"""
+    return _current_span.get()
+
+
+@contextmanager
+def span_scope(span: Optional[Span]):
+    """Make ``span`` the ``current_span`` inside this block, ``None`` keeps the current one. Use it around each step of
+    a generator instead of holding the span across the ``yield``.
+
+    Args:
+        span (Optional[Span]): The span.
+    """
+    if span is None:
+        yield
+        return
+    token = _current_span.set(span)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+
+
+def add_usage(usage: Optional[Dict[str, Any]]) -> None:
+    """Add the token usage of a model call to the current span, models call this with the ``usage`` of the response.
+
+    Args:
+        usage (Optional[Dict[str, Any]]): Like ``{"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30}``.
+    """
+    span = _current_span.get()
+    if span is None or not usage:
+        return
+    with _span_lock:
+        for k, v in usage.items():
+            if isinstance(v, int):
+                span.usage[k] = span.usage.get(k, 0) + v
+
+
+def add_retry() -> None:
+    """Count a retry in the current span"""
+    span = _current_span.get()
+    if span is not None:
+        with _span_lock:
+            span.retries += 1
+
+
+def nbytes(obj: Any) -> int:
+    """Size of the JSON of the object in bytes, this is what is reported as the input and output sizes"""
+    try:
+        return len(json.dumps(obj, default=str).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+@contextmanager
+def trace(
+    tracers: List[Tracer],
+    name: str,
+    kind: str,
+    data: Any = None,
+    parent: Optional[Span] = None,
+    measure_cpu: bool = True,
+    current: bool = True,
+):
+    """Time the code in this block as a span and send it to the ``tracers``. The caller sets ``output_bytes`` or
+    ``error`` on the yielded span.
+
+    Args:
+        tracers (List[Tracer]): The tracers, must not be empty.
+        name (str): The name of the span.
+        kind (str): The kind of the span.
+        data (Any, optional): The inputs, used for ``input_bytes``. Defaults to None.
+        parent (Optional[Span], optional): The parent span. Defaults to None.
+        measure_cpu (bool, optional): Measure the CPU time of this thread, turn it off when other work is interleaved
+            on the thread (eg. asyncio or generators). Defaults to True.
+        current (bool, optional): Make this the ``current_span`` inside the block, so models can add usage and
+            retries to it. Defaults to True.
+    """
+    span = Span(name, kind, parent)
+    if data is not None:
+        span.input_bytes = nbytes(data)
+    for t in tracers:
+        t.on_start(span)
+    token = _current_span.set(span) if current else None
+    cpu = time.thread_time() if measure_cpu else None
+    wall = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span.error = span.error or repr(e)
+        raise
+    finally:
+        span.wall = time.perf_counter() - wall
+        if cpu is not None:
+            span.cpu = time.thread_time() - cpu
+        span.end_ns = time.time_ns()
+        if token is not None:
+            _current_span.reset(token)
+        for t in tracers:
+            t.on_end(span)
+
+
+def _otel_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
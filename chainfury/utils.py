@@ -5,15 +5,25 @@ import re
 import json
 import time
 import time
+import pickle
 import random
 import string
+import asyncio
 import logging
+import threading
+import multiprocessing
 from uuid import uuid4
+from contextlib import contextmanager
+from contextvars import ContextVar
 from urllib.parse import quote
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Union, Tuple, Optional
 
 from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from chainfury.tracing import add_retry
 
 
 class CFEnv:
@@ -28,6 +38,14 @@ class CFEnv:
     * CF_BLOB_AWS_CLOUD_FRONT: blob storage cloud front url, if not provided defaults to primary S3 URL (only used for `s3` engine)
     * CF_URL: the URL of the chainfury server
     * CF_TOKEN: the token to use to authenticate with the chainfury server
+    * CF_PROCESS_WORKERS: number of workers in the process pool of the ``executor="process"`` nodes, defaults to the
+      number of CPUs
+    * CF_PROCESS_START_METHOD: how the workers of the process pool are started, can be one of `spawn` (default),
+      `forkserver` or `fork`
+    * CF_SPILL_BYTES: node outputs larger than this many bytes (as JSON) are stored in the blob storage and only a
+      ``BlobRef`` is kept in the IR, ``0`` (default) keeps everything in memory
+    * CF_HEDGE_WORKERS: number of threads that run the hedged model calls of the process, every hedged call takes up
+      to two of them, defaults to 64
     """
 
     CF_LOG_LEVEL = lambda: os.getenv("CF_LOG_LEVEL", "info")
@@ -39,6 +57,10 @@ class CFEnv:
     CF_BLOB_BUCKET = lambda: os.getenv("CF_BLOB_BUCKET", "")
     CF_BLOB_PREFIX = lambda: os.getenv("CF_BLOB_PREFIX", "")
     CF_BLOB_AWS_CLOUD_FRONT = lambda: os.getenv("CF_BLOB_AWS_CLOUD_FRONT", "")
+    CF_PROCESS_WORKERS = lambda: int(os.getenv("CF_PROCESS_WORKERS", 0)) or None
+    CF_PROCESS_START_METHOD = lambda: os.getenv("CF_PROCESS_START_METHOD", "spawn")
+    CF_SPILL_BYTES = lambda: int(os.getenv("CF_SPILL_BYTES", 0))
+    CF_HEDGE_WORKERS = lambda: int(os.getenv("CF_HEDGE_WORKERS", 64))
 
 
 def store_blob(key: str, value: bytes, engine: str = "", bucket: str = "") -> str:
@@ -217,12 +239,243 @@ def exponential_backoff(
                 raise e
             else:
                 delay = retry_delay * (2**attempt)  # Calculate the backoff delay
+                left = remaining_time()
+                if left is not None and left <= delay:
+                    logger.error("Deadline reached. Exiting...")
+                    raise e
                 logger.info(f"Retrying in {delay} seconds...")
+                add_retry()
                 time.sleep(delay)  # Wait for the calculated delay
 
     raise Exception("This should never happen")
 
 
+"""
+Deadlines
+"""
+
+_deadline: ContextVar[Optional[float]] = ContextVar("cf_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]):
+    """Set the deadline for all the code in this block, this is how ``Chain`` passes its timeouts down to the models.
+    Nested scopes can only make the deadline tighter.
+
+    Args:
+        deadline (Optional[float]): The deadline as ``time.monotonic()`` seconds, ``None`` keeps the current one.
+    """
+    current = _deadline.get()
+    if deadline is None or (current is not None and current <= deadline):
+        yield current
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time(default: Optional[float] = None) -> Optional[float]:
+    """Seconds left before the deadline of the current ``deadline_scope``, use it as the ``timeout`` of network calls.
+
+    Args:
+        default (Optional[float], optional): Returned when there is no deadline, and the result is never more than
+            this. Defaults to None.
+
+    Returns:
+        Optional[float]: The seconds left or ``default``.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = max(deadline - time.monotonic(), 0.001)
+    return left if default is None else min(left, default)
+
+
+"""
+IR Buffer
+"""
+
+# the wall clock at monotonic zero, this turns the monotonic timestamps of the IR into dates
+_MONOTONIC_EPOCH_NS = time.time_ns() - time.monotonic_ns()
+
+
+class IRRecord:
+    """One output of a node in the IR buffer of a run while it is running. The times are ``time.monotonic_ns`` so
+    recording an output is only a clock read and the record is a few slots instead of a dict. Reading ``record["value"]``
+    and ``record["timestamp"]`` works like on the old dicts, the ISO ``timestamp`` is formatted when it is read. The
+    ``full_ir`` handed back by ``Chain`` holds the plain dicts from ``to_dict`` (see ``ir_to_dict``).
+
+    Args:
+        node_id (str): The node that gave this output.
+        value (Any): The output.
+        start_ns (int, optional): When the node started, defaults to ``end_ns``.
+        end_ns (int, optional): When the node completed, defaults to now.
+    """
+
+    __slots__ = ("node_id", "value", "start_ns", "end_ns")
+
+    def __init__(self, node_id: str, value: Any, start_ns: int = 0, end_ns: int = 0):
+        self.node_id = node_id
+        self.value = value
+        self.end_ns = end_ns or time.monotonic_ns()
+        self.start_ns = start_ns or self.end_ns
+
+    def __repr__(self) -> str:
+        return f"IRRecord('{self.node_id}', {self.value!r})"
+
+    @property
+    def timestamp(self) -> str:
+        """When the node completed, as a local ISO string like ``datetime.now().isoformat()``"""
+        return datetime.fromtimestamp(
+            (_MONOTONIC_EPOCH_NS + self.end_ns) / 1e9
+        ).isoformat()
+
+    @property
+    def duration(self) -> float:
+        """Seconds the node took"""
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "value":
+            return self.value
+        if key == "timestamp":
+            return self.timestamp
+        raise KeyError(key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        value = self.value
+        if isinstance(value, BlobRef):
+            value = value.to_dict()
+        return {"value": value, "timestamp": self.timestamp}
+
+    @classmethod
+    def from_dict(cls, node_id: str, data: Dict[str, Any]) -> "IRRecord":
+        """Load the output of ``to_dict`` back, eg. from a checkpoint. A spilled value is a ``BlobRef`` again."""
+        value = data.get("value")
+        if BlobRef.is_ref(value):
+            value = BlobRef.from_dict(value)  # type: ignore
+        end_ns = 0
+        if data.get("timestamp"):
+            wall_ns = int(datetime.fromisoformat(data["timestamp"]).timestamp() * 1e9)
+            end_ns = wall_ns - _MONOTONIC_EPOCH_NS
+        return cls(node_id, value, end_ns, end_ns)
+
+
+def ir_to_dict(ir: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert the ``IRRecord`` values of an IR buffer or a ``yield_dict`` to plain dicts, this is what ``Chain``
+    returns. Values that are already dicts (like the records reused from the ``full_ir`` of an earlier run) are kept
+    as is.
+    """
+    return {k: v.to_dict() if isinstance(v, IRRecord) else v for k, v in ir.items()}
+
+
+def ir_from_dict(ir: Dict[str, Any]) -> Dict[str, IRRecord]:
+    """Inverse of ``ir_to_dict``, the values that are already ``IRRecord`` are kept as is."""
+    return {
+        k: v if isinstance(v, IRRecord) else IRRecord.from_dict(k.split("/")[0], v)
+        for k, v in ir.items()
+    }
+
+
+class BlobRef:
+    """Lazy reference to a node output that was spilled to the blob storage, see ``spill_to_blob``. The value is read
+    with ``get_blob`` every time ``load`` is called, so it does not stay in the memory of the run.
+
+    Args:
+        key (str): The key of the blob.
+        nbytes (int): Size of the JSON of the value.
+        engine (str, optional): The blob engine it was stored with. Defaults to "".
+        bucket (str, optional): The bucket it was stored in. Defaults to "".
+    """
+
+    __slots__ = ("key", "nbytes", "engine", "bucket")
+
+    def __init__(self, key: str, nbytes: int, engine: str = "", bucket: str = ""):
+        self.key = key
+        self.nbytes = nbytes
+        self.engine = engine
+        self.bucket = bucket
+
+    def __repr__(self) -> str:
+        return f"BlobRef('{self.key}', nbytes={self.nbytes})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BlobRef) and self.to_dict() == other.to_dict()
+
+    def load(self) -> Any:
+        """Read the value from the blob storage"""
+        return json.loads(get_blob(self.key, engine=self.engine, bucket=self.bucket))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "cf_blob": self.key,
+            "nbytes": self.nbytes,
+            "engine": self.engine,
+            "bucket": self.bucket,
+        }
+
+    @staticmethod
+    def is_ref(data: Any) -> bool:
+        """True if ``data`` is the ``to_dict`` of a ``BlobRef``"""
+        return isinstance(data, dict) and "cf_blob" in data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BlobRef":
+        return cls(
+            key=data["cf_blob"],
+            nbytes=data.get("nbytes", 0),
+            engine=data.get("engine", ""),
+            bucket=data.get("bucket", ""),
+        )
+
+
+def spill_to_blob(
+    value: Any, threshold: int, engine: str = "", bucket: str = ""
+) -> Any:
+    """Store ``value`` with ``store_blob`` if its JSON is larger than ``threshold`` bytes and return a ``BlobRef`` to
+    it, else return the ``value`` as is. Values that are not JSON serialisable are never spilled.
+
+    Args:
+        value (Any): The output of a node.
+        threshold (int): Size in bytes above which the value is spilled.
+        engine (str, optional): The blob engine, defaults to ``CF_BLOB_ENGINE``. Nothing is spilled with ``no``.
+        bucket (str, optional): The bucket, defaults to ``CF_BLOB_BUCKET``.
+
+    Returns:
+        Any: The ``value`` or a ``BlobRef``.
+    """
+    if value is None or isinstance(value, (bool, int, float, BlobRef)):
+        return value
+    if isinstance(value, str) and len(value) * 4 <= threshold:
+        # utf-8 is at most 4 bytes per character, skip encoding the small strings
+        return value
+    engine = engine or CFEnv.CF_BLOB_ENGINE()
+    if engine == "no":
+        return value
+    try:
+        data = json.dumps(value).encode("utf-8")
+    except (TypeError, ValueError):
+        return value
+    if len(data) <= threshold:
+        return value
+    if engine == "s3":
+        bucket = bucket or CFEnv.CF_BLOB_BUCKET()
+    key = f"cf-ir-{uuid4().hex}.json"
+    store_blob(key, data, engine=engine, bucket=bucket)
+    return BlobRef(key, len(data), engine=engine, bucket=bucket)
+
+
+def load_value(value: Any) -> Any:
+    """The actual value of an IR value, ie. ``BlobRef`` (or their ``to_dict``) are loaded from the blob storage"""
+    if isinstance(value, BlobRef):
+        return value.load()
+    if BlobRef.is_ref(value):
+        return BlobRef.from_dict(value).load()
+    return value
+
+
 """
 File System
 """
@@ -317,6 +570,119 @@ def threaded_map(
     return results
 
 
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_lock = threading.Lock()
+_unpicklable = set()
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """The process pool shared by all the nodes with ``executor="process"``, it is created on the first use with
+    ``CF_PROCESS_WORKERS`` workers and kept warm for the life of the process."""
+    global _process_pool
+    with _process_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=CFEnv.CF_PROCESS_WORKERS(),
+                mp_context=multiprocessing.get_context(CFEnv.CF_PROCESS_START_METHOD()),
+            )
+        return _process_pool
+
+
+def warm_process_pool() -> None:
+    """Start all the workers of the process pool now instead of on the first call, call this when the server starts so
+    the first requests do not wait on the workers to boot."""
+    pool = process_pool()
+    n = CFEnv.CF_PROCESS_WORKERS() or os.cpu_count() or 1
+    for f in [pool.submit(time.sleep, 0) for _ in range(n)]:
+        f.result()
+
+
+def shutdown_process_pool(wait: bool = True) -> None:
+    """Stop the workers of the process pool, it is created again on the next use."""
+    global _process_pool
+    with _process_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def _pickle_call(fn, kwargs: Dict[str, Any]) -> Optional[bytes]:
+    # the call is pickled once here, with the highest protocol so large bytes and buffers are not copied around, and
+    # any pickling error is found before anything is sent to the pool
+    name = f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', fn)}"
+    if name in _unpicklable:
+        return None
+    try:
+        return pickle.dumps((fn, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        try:
+            pickle.dumps(fn, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            _unpicklable.add(name)
+            logger.warning(f"{name} cannot be pickled, it will always run inline: {e}")
+        else:
+            logger.debug(f"Inputs of {name} cannot be pickled, running inline: {e}")
+        return None
+
+
+def _call_pickled(payload: bytes, timeout: Optional[float]) -> Any:
+    fn, kwargs = pickle.loads(payload)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with deadline_scope(deadline):
+        return fn(**kwargs)
+
+
+def _reset_broken_pool(pool: ProcessPoolExecutor) -> None:
+    global _process_pool
+    with _process_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    logger.error("A worker of the process pool died, starting a new pool")
+
+
+def run_in_process(fn, kwargs: Dict[str, Any]) -> Any:
+    """Call ``fn(**kwargs)`` in the process pool, it is called inline when ``fn`` or ``kwargs`` cannot be pickled. The
+    time left on the current deadline is passed to the worker and is also how long this waits for the result.
+
+    Args:
+        fn (Callable): A function that can be pickled, ie. defined at the top level of a module.
+        kwargs (Dict[str, Any]): The keyword arguments.
+
+    Returns:
+        Any: The result of the call.
+    """
+    payload = _pickle_call(fn, kwargs)
+    if payload is None:
+        return fn(**kwargs)
+    pool = process_pool()
+    timeout = remaining_time()
+    fut = pool.submit(_call_pickled, payload, timeout)
+    try:
+        return fut.result(timeout=timeout)
+    except BrokenProcessPool:
+        _reset_broken_pool(pool)
+        raise
+    except (TimeoutError, FutureTimeoutError):
+        fut.cancel()
+        raise TimeoutError(f"{fn} did not finish in {timeout:.3f}s")  # type: ignore
+
+
+async def arun_in_process(fn, kwargs: Dict[str, Any]) -> Any:
+    """Async version of ``run_in_process``, the event loop is not blocked while the worker runs. When ``fn`` cannot be
+    pickled it is run in a thread instead."""
+    payload = _pickle_call(fn, kwargs)
+    if payload is None:
+        return await asyncio.to_thread(fn, **kwargs)
+    pool = process_pool()
+    try:
+        return await asyncio.wrap_future(
+            pool.submit(_call_pickled, payload, remaining_time())
+        )
+    except BrokenProcessPool:
+        _reset_broken_pool(pool)
+        raise
+
+
 def batched(iterable, n):
     """Convert any ``iterable`` to a generator of batches of size ``n``, last one may be smaller.
     Python 3.12 has ``itertools.batched`` which does the same thing.
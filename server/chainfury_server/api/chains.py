@@ -10,9 +10,10 @@ from fastapi.responses import Response, StreamingResponse
 from fastapi import Depends, Header, Request, Response, HTTPException
 
 import chainfury.types as T
+from chainfury import TokenDelta, ir_to_dict
 import chainfury_server.database as DB
 from chainfury_server.utils import Env
-from chainfury_server.engine import FuryEngine
+from chainfury_server.engine import FuryEngine, chain_cache
 
 
 def create_chain(
@@ -127,6 +128,8 @@ def update_chain(
             chatbot.dag = chatbot_data.dag.dict()  # type: ignore
     db.commit()
     db.refresh(chatbot)
+    if "dag" in unq_keys:
+        chain_cache.invalidate(chatbot.id)
 
     # return
     return chatbot.to_ApiChain()
@@ -157,6 +160,7 @@ def delete_chain(
         return T.ApiResponse(message="ChatBot not found")
     chatbot.deleted_at = datetime.now()
     db.commit()
+    chain_cache.invalidate(chatbot.id)
 
     # return
     return T.ApiResponse(message=f"ChatBot: '{chatbot.name}' ({chatbot.id}) deleted")
@@ -199,12 +203,14 @@ def run_chain(
     as_task: bool = False,
     store_ir: bool = False,
     store_io: bool = False,
+    stream_tokens: bool = False,
     db: Session = Depends(DB.fastapi_db_session),
 ) -> Union[StreamingResponse, T.ChainResult, T.ApiResponse]:
     """
     This is the master function to run any chain over the API. This can behave in a bunch of different formats like:
     - (default) this will wait for the entire chain to execute and return the response
     - if ``stream`` is passed it will give a streaming response with line by line JSON and last response containing ``"done"`` key
+    - if ``stream_tokens`` is also passed then the text of the ``main_out`` is streamed as lines like ``{"key": ..., "delta": ...}``
     - if ``as_task`` is passed then a task ID is received and you can poll for the results at ``/chains/{id}/results`` this supercedes the ``stream``.
 
     ``as_task`` is not implemented.
@@ -260,12 +266,14 @@ def run_chain(
         def _get_streaming_response(result):
             for ir, done in result:
                 if done:
-                    ir.pop("result")
-                    result = {**ir, "done": done}
+                    line = {**ir.model_dump(exclude={"result"}), "done": done}
+                elif isinstance(ir, TokenDelta):
+                    line = ir.to_dict()
+                elif type(ir) == str:
+                    line = {"main_out": ir}
                 else:
-                    if type(ir) == str:
-                        result = {"main_out": ir}
-                yield json.dumps(result) + "\n"
+                    line = ir_to_dict(ir)
+                yield json.dumps(line) + "\n"
 
         streaming_result = engine.stream(
             chatbot=chatbot,
@@ -274,6 +282,7 @@ def run_chain(
             start=time.time(),
             store_ir=store_ir,
             store_io=store_io,
+            stream_tokens=stream_tokens,
         )
         return StreamingResponse(content=_get_streaming_response(streaming_result))
     else:
@@ -2,29 +2,221 @@
 
 import time
 import json
+import hashlib
+import threading
 import traceback
 from uuid import uuid4
+from collections import OrderedDict
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
-from typing import Tuple, Dict, Any, Generator, Union
+from typing import Tuple, Dict, Any, Generator, Union, List, Optional
 
 import chainfury.types as T
-from chainfury import Chain
-from chainfury.utils import SimplerTimes
+from chainfury import Chain, TokenDelta, ChainTimeoutError, Checkpoint
+from chainfury.utils import (
+    SimplerTimes,
+    deadline_scope,
+    ir_to_dict,
+    ir_from_dict,
+    load_value,
+)
 
 import chainfury_server.database as DB
-from chainfury_server.utils import logger
+from chainfury_server.utils import logger, Env
 
-from celery import Celery
+import requests
+from celery import Celery, chord, group
+from kombu.exceptions import OperationalError as BrokerError
 
 from sqlalchemy.pool import NullPool
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError as DBError
 
 
 app = Celery()
 
 
-@app.task(name="chainfury_server.engine.run_chain")
+class ChainCache:
+    """LRU cache of built ``Chain`` objects keyed by ``(chatbot.id, hash(dag))``. Building a chain validates the DAG,
+    deep copies the registry nodes and compiles the templates, this cache lets all the requests for a chatbot share one
+    chain (``Chain`` execution is reentrant). Since the key contains the hash of the DAG a chatbot that was updated
+    in another process (eg. the API server while this is a celery worker) gets a fresh chain, stale entries simply fall
+    out of the LRU.
+
+    The memory budget is approximate, each entry is charged with the size of the serialised DAG times
+    ``overhead_factor``.
+
+    Args:
+        max_bytes (int): The memory budget for the cache, ``0`` disables the cache.
+        overhead_factor (int, optional): Multiplier from the JSON size to the in-memory size. Defaults to 10.
+    """
+
+    def __init__(self, max_bytes: int, overhead_factor: int = 10):
+        self.max_bytes = max_bytes
+        self.overhead_factor = overhead_factor
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Tuple[str, str], Tuple[Chain, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"ChainCache({len(self._items)} chains, {self.size}/{self.max_bytes} bytes, hits={self.hits}, misses={self.misses})"
+
+    def get(self, chatbot: DB.ChatBot, dag: Optional[Dict[str, Any]] = None) -> Chain:
+        """Get the chain for this chatbot, building it if it is not in the cache.
+
+        Args:
+            chatbot (DB.ChatBot): The chatbot row.
+            dag (Optional[Dict[str, Any]], optional): Build from this DAG instead of ``chatbot.dag``, eg. the one a
+                distributed run was started with. Defaults to None.
+
+        Returns:
+            Chain: The chain, do not modify it since it is shared.
+        """
+        dag = chatbot.dag if dag is None else dag
+        dag_json = json.dumps(dag, sort_keys=True)
+        key = (str(chatbot.id), hashlib.sha1(dag_json.encode()).hexdigest())
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+
+        # build outside the lock, two requests may build the same chain but that is harmless
+        chain = Chain.from_dag(
+            T.Dag(**dag),  # type: ignore
+            check_server=False,
+            prune=Env.CFS_PRUNE_CHAINS(),
+            optimize=Env.CFS_OPTIMIZE_CHAINS(),
+        )
+        cost = len(dag_json) * self.overhead_factor
+        if not self.max_bytes or cost > self.max_bytes:
+            return chain
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (chain, cost)
+                self.size += cost
+            while self.size > self.max_bytes and self._items:
+                _, (_, _cost) = self._items.popitem(last=False)
+                self.size -= _cost
+        return chain
+
+    def invalidate(self, chatbot_id: str):
+        """Remove all the chains of a chatbot, call this when the chatbot is updated or deleted.
+
+        Args:
+            chatbot_id (str): The id of the chatbot.
+        """
+        with self._lock:
+            for key in [k for k in self._items if k[0] == str(chatbot_id)]:
+                _, cost = self._items.pop(key)
+                self.size -= cost
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hits, misses and size of the cache"""
+        return {
+            "chains": len(self._items),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+chain_cache = ChainCache(max_bytes=Env.CFS_CHAIN_CACHE_MB() * 1024 * 1024)
+"""
+Process wide cache of the compiled chains, shared by ``FuryEngine`` and the celery ``run_chain`` task.
+"""
+
+
+class ChainLogCheckpoint(Checkpoint):
+    """Checkpoint of a prompt in the ``ChainLog`` table, every completed node is a row with the message
+    ``"checkpoint"`` that is committed right away, so another worker can resume the prompt.
+
+    Args:
+        db (Session): The DB session.
+        prompt_id (int): The prompt that is being run.
+        worker_id (str): The worker that is running it.
+    """
+
+    MESSAGE = "checkpoint"
+
+    def __init__(self, db: Session, prompt_id: int, worker_id: str):
+        self.db = db
+        self.prompt_id = prompt_id
+        self.worker_id = worker_id
+
+    def __repr__(self) -> str:
+        return f"ChainLogCheckpoint(prompt_id={self.prompt_id})"
+
+    def _rows(self):
+        return self.db.query(DB.ChainLog).filter(
+            DB.ChainLog.prompt_id == self.prompt_id,
+            DB.ChainLog.message == self.MESSAGE,
+        )  # type: ignore
+
+    def load(self) -> Dict[str, Any]:
+        full_ir = {}
+        for row in self._rows().order_by(DB.ChainLog.created_at).all():  # type: ignore
+            full_ir.update(row.data or {})
+        return full_ir
+
+    def save(self, ir: Dict[str, Any]) -> None:
+        try:
+            json.dumps(ir)
+        except TypeError:
+            logger.warning(f"Cannot checkpoint {list(ir)} for prompt {self.prompt_id}")
+            return
+        db_chainlog = DB.ChainLog(
+            prompt_id=self.prompt_id,
+            created_at=SimplerTimes.get_now_datetime(),
+            node_id=next(iter(ir)).split("/")[0],
+            worker_id=self.worker_id,
+            message=self.MESSAGE,
+            data=ir,
+        )  # type: ignore
+        self.db.add(db_chainlog)
+        self.db.commit()
+
+    def clear(self) -> None:
+        self._rows().delete()
+        self.db.commit()
+
+
+def _task_db() -> Session:
+    sess = DB.get_local_session(
+        create_engine(
+            DB.db,
+            poolclass=NullPool,
+        )
+    )
+    return sess()
+
+
+# only the errors that can go away on their own are retried. A bad DAG, a validation error, a chain timeout or a 4xx
+# from a model would fail again, and every attempt bills the model calls that were not checkpointed. ChainTimeoutError
+# is a TimeoutError so the builtin one is not in here, requests wraps the socket timeouts in its own.
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    requests.ConnectionError,
+    requests.Timeout,
+    BrokerError,
+    DBError,
+)
+
+
+@app.task(
+    name="chainfury_server.engine.run_chain",
+    acks_late=True,
+    reject_on_worker_lost=True,
+    autoretry_for=TRANSIENT_ERRORS,
+    max_retries=2,
+    retry_backoff=True,
+)
 def run_chain(
     chatbot_id: str,
     prompt_id: str,
@@ -36,13 +228,7 @@ def run_chain(
     start = SimplerTimes.get_now_fp64()
 
     # create the DB session
-    sess = DB.get_local_session(
-        create_engine(
-            DB.db,
-            poolclass=NullPool,
-        )
-    )
-    db = sess()
+    db = _task_db()
 
     # get the db object
     chatbot = db.query(DB.ChatBot).filter(DB.ChatBot.id == chatbot_id).first()  # type: ignore
@@ -53,22 +239,34 @@ def run_chain(
         if prompt_row is None:
             raise RuntimeError(f"Prompt {prompt_id} not found")
 
-    # Create a Fury chain then run the chain while logging all the intermediate steps
-    dag = T.Dag(**chatbot.dag)  # type: ignore
-    chain = Chain.from_dag(dag, check_server=False)
+    # Get the Fury chain then run the chain while logging all the intermediate steps
+    chain = chain_cache.get(chatbot)
     callback = FuryThoughtsCallback(db, prompt_row.id)
 
+    # the task is acked late, so if a worker dies midway or the task is retried the next attempt resumes from here
+    checkpoint = ChainLogCheckpoint(db, prompt_row.id, worker_id)  # type: ignore
+
     # print(
     #     f"starting chain execution: [{prompt_row.meta.get('task_id')=}] [{worker_id=}]"
     # )
+    # finish before the soft_time_limit so the partial results can be logged
     iterator = chain.stream(
         data=prompt_data,
         thoughts_callback=callback,
         print_thoughts=False,
+        timeout=Env.CFS_CHAIN_TIMEOUT() or 55,
+        checkpoint=checkpoint,
     )
     mainline_out = "<placeholder>"
     last_db = 0
-    for ir, done in iterator:
+    message = "completed"
+    while True:
+        try:
+            ir, done = next(iterator)
+        except ChainTimeoutError as e:
+            logger.warning(f"Task for prompt {prompt_id} timed out: {e}")
+            message = f"timeout: {e.node_ids}"
+            break
         if done:
             mainline_out = ir
             break
@@ -81,7 +279,7 @@ def run_chain(
                         "name": k.split("/")[-1],
                         "data": v,
                     }
-                    for k, v in ir.items()
+                    for k, v in ir_to_dict(ir).items()
                 ]
             }
             k = next(iter(ir)).split("/")[0]
@@ -110,10 +308,13 @@ def run_chain(
         created_at=SimplerTimes.get_now_datetime(),
         node_id="end",
         worker_id=worker_id,
-        message="completed",
+        message=message,
     )  # type: ignore
     db.add(db_chainlog)
 
+    # the run is over, the outputs are kept only when the steps were asked for
+    checkpoint.clear()
+
     # commit the prompt to DB
     if store_io:
         prompt_row.response = result.result  # type: ignore
@@ -126,6 +327,162 @@ def run_chain(
     db.commit()
 
 
+# distributed mode, every node of the chain is a task
+
+
+@app.task(
+    name="chainfury_server.engine.run_node",
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def run_node(
+    chatbot_id: str,
+    prompt_id: str,
+    prompt_data: Dict,
+    node_id: str,
+    deadline: float,
+    dag: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Runs a single node of a prompt in the distributed mode. The inputs are read from the ``ChainLog`` checkpoint
+    of the prompt and the outputs are returned through the result backend to ``advance_chain``, set ``CF_SPILL_BYTES``
+    so that large outputs go through the blob storage instead. The chain is built from ``dag``, the DAG of the
+    chatbot when the prompt was submitted.
+
+    Returns:
+        Dict[str, Any]: ``{"node_id": ..., "ir": ...}`` or ``{"node_id": ..., "error": ...}`` if the node failed.
+    """
+    db = _task_db()
+    try:
+        chatbot = db.query(DB.ChatBot).filter(DB.ChatBot.id == chatbot_id).first()  # type: ignore
+        chain = chain_cache.get(chatbot, dag)
+        full_ir = ir_from_dict(ChainLogCheckpoint(db, prompt_id, "").load())  # type: ignore
+        ready, inactive = chain.frontier(full_ir)
+        if node_id not in ready:
+            # the task was delivered again after the node completed
+            return {"node_id": node_id, "ir": {}}
+        with deadline_scope(time.monotonic() + deadline - time.time()):
+            yield_dict, _ = chain.step(
+                node_id=node_id,
+                pre_data={**chain.sample, **prompt_data},
+                full_ir=full_ir,
+                thoughts_callback=FuryThoughtsCallback(db, prompt_id),
+                inactive=inactive,
+            )
+        return {"node_id": node_id, "ir": ir_to_dict(yield_dict)}
+    except Exception as e:
+        logger.exception(e)
+        return {"node_id": node_id, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        db.close()
+
+
+@app.task(
+    name="chainfury_server.engine.advance_chain",
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def advance_chain(
+    results: Optional[List[Dict[str, Any]]],
+    chatbot_id: str,
+    prompt_id: str,
+    prompt_data: Dict,
+    store_ir: bool,
+    store_io: bool,
+    worker_id: str,
+    start: float,
+    deadline: float,
+    dag: Optional[Dict[str, Any]] = None,
+):
+    """Coordinator of a prompt in the distributed mode. It stores the outputs of the nodes that completed (``results``
+    of the ``run_node`` tasks) in the checkpoint of the prompt, then schedules all the nodes that are ready as a group
+    of ``run_node`` tasks on the ``cfs`` queue with itself as the chord callback. Independent branches run on
+    different workers and a slow chain never holds a worker slot while it waits on a model. When nothing is left the
+    result is written to the prompt, same as ``run_chain``.
+
+    The DAG of the chatbot is pinned in the payload (``dag``) when the prompt is submitted, so every step runs the
+    same chain even if the chatbot is updated in the middle of the run.
+    """
+    db = _task_db()
+    chatbot = db.query(DB.ChatBot).filter(DB.ChatBot.id == chatbot_id).first()  # type: ignore
+    prompt_row: DB.Prompt = db.query(DB.Prompt).filter(DB.Prompt.id == prompt_id).first()  # type: ignore
+    if prompt_row is None:
+        raise RuntimeError(f"Prompt {prompt_id} not found")
+    chain = chain_cache.get(chatbot, dag)
+    checkpoint = ChainLogCheckpoint(db, prompt_row.id, worker_id)  # type: ignore
+
+    errors = []
+    for res in results or []:
+        if "error" in res:
+            errors.append(f"{res['node_id']}: {res['error']}")
+            continue
+        if not res["ir"]:
+            continue
+        checkpoint.save(res["ir"])
+        if store_ir:
+            db.add(
+                DB.ChainLog(
+                    prompt_id=prompt_row.id,
+                    created_at=SimplerTimes.get_now_datetime(),
+                    node_id=res["node_id"],
+                    worker_id=worker_id,
+                    message="step",
+                    data={
+                        "outputs": [
+                            {"name": k.split("/")[-1], "data": v}
+                            for k, v in res["ir"].items()
+                        ]
+                    },
+                )  # type: ignore
+            )
+
+    full_ir = ir_from_dict(checkpoint.load())
+    ready, _ = chain.frontier(full_ir)
+    message = "completed"
+    if errors:
+        message = f"error: {errors}"
+    elif ready and time.time() > deadline:
+        message = f"timeout: {ready}"
+    elif ready:
+        kwargs = {
+            "chatbot_id": chatbot_id,
+            "prompt_id": prompt_id,
+            "prompt_data": prompt_data,
+            "store_ir": store_ir,
+            "store_io": store_io,
+            "worker_id": worker_id,
+            "start": start,
+            "deadline": deadline,
+            "dag": dag,
+        }
+        nodes = group(
+            run_node.si(chatbot_id, prompt_id, prompt_data, node_id, deadline, dag).set(
+                queue="cfs"
+            )
+            for node_id in ready
+        )
+        chord(nodes)(advance_chain.s(**kwargs).set(queue="cfs"))
+        db.commit()
+        return
+
+    mainline_out = None
+    if chain.main_out in full_ir:
+        mainline_out = load_value(full_ir[chain.main_out]["value"])
+    db.add(
+        DB.ChainLog(
+            prompt_id=prompt_row.id,
+            created_at=SimplerTimes.get_now_datetime(),
+            node_id="end",
+            worker_id=worker_id,
+            message=message,
+        )  # type: ignore
+    )
+    checkpoint.clear()
+    if store_io:
+        prompt_row.response = str(mainline_out)  # type: ignore
+    prompt_row.time_taken = float(time.time() - start)  # type: ignore
+    db.commit()
+
+
 class FuryEngine:
     def run(
         self,
@@ -144,9 +501,8 @@ class FuryEngine:
             logger.debug("Adding prompt to database")
             prompt_row = create_prompt(db, chatbot.id, prompt.new_message if store_io else "", prompt.session_id)  # type: ignore
 
-            # Create a Fury chain then run the chain while logging all the intermediate steps
-            dag = T.Dag(**chatbot.dag)  # type: ignore
-            chain = Chain.from_dag(dag, check_server=False)
+            # Get the Fury chain then run the chain while logging all the intermediate steps
+            chain = chain_cache.get(chatbot)
             callback = FuryThoughtsCallback(db, prompt_row.id)
             if prompt.new_message:
                 prompt.data = {chain.main_in: prompt.new_message}
@@ -156,13 +512,14 @@ class FuryEngine:
                 data=prompt.data,
                 thoughts_callback=callback,
                 print_thoughts=False,
+                timeout=Env.CFS_CHAIN_TIMEOUT() or None,
             )
 
             # store the full_ir in the DB.ChainLog
             if store_ir:
                 # group the logs by node_id
                 chain_logs_by_node = {}
-                for k, v in full_ir.items():
+                for k, v in ir_to_dict(full_ir).items():
                     node_id, varname = k.split("/")
                     chain_logs_by_node.setdefault(node_id, {"outputs": []})
                     chain_logs_by_node[node_id]["outputs"].append(
@@ -205,6 +562,9 @@ class FuryEngine:
             # result["prompt_id"] = prompt_row.id
             logger.debug("Processed graph")
             return result
+        except ChainTimeoutError as e:
+            logger.warning(f"Chain {chatbot.id} timed out: {e}")
+            raise HTTPException(status_code=504, detail=str(e)) from e
         except Exception as e:
             traceback.print_exc()
             logger.exception(e)
@@ -218,7 +578,10 @@ class FuryEngine:
         start: float,
         store_ir: bool,
         store_io: bool,
-    ) -> Generator[Tuple[Union[T.ChainResult, Dict[str, Any]], bool], None, None]:
+        stream_tokens: bool = False,
+    ) -> Generator[
+        Tuple[Union[T.ChainResult, TokenDelta, Dict[str, Any]], bool], None, None
+    ]:
         if prompt.new_message and prompt.data:
             raise HTTPException(
                 status_code=400, detail="prompt cannot have both new_message and data"
@@ -227,9 +590,8 @@ class FuryEngine:
             logger.debug("Adding prompt to database")
             prompt_row = create_prompt(db, chatbot.id, prompt.new_message if store_io else "", prompt.session_id)  # type: ignore
 
-            # Create a Fury chain then run the chain while logging all the intermediate steps
-            dag = T.Dag(**chatbot.dag)  # type: ignore
-            chain = Chain.from_dag(dag, check_server=False)
+            # Get the Fury chain then run the chain while logging all the intermediate steps
+            chain = chain_cache.get(chatbot)
             callback = FuryThoughtsCallback(db, prompt_row.id)
             if prompt.new_message:
                 prompt.data = {chain.main_in: prompt.new_message}
@@ -239,10 +601,16 @@ class FuryEngine:
                 data=prompt.data,
                 thoughts_callback=callback,
                 print_thoughts=False,
+                stream_tokens=stream_tokens,
+                timeout=Env.CFS_CHAIN_TIMEOUT() or None,
             )
             # full_ir = {}
             mainline_out = ""
             for ir, done in iterator:
+                if isinstance(ir, TokenDelta):
+                    # token deltas are forwarded as is and never stored
+                    yield ir, False
+                    continue
                 if not done:
                     # full_ir.update(ir)
                     yield ir, False
@@ -250,7 +618,7 @@ class FuryEngine:
                     mainline_out = ir
                     yield ir, False
 
-                if store_ir:
+                if store_ir and not done:
                     # in case of stream, every item is a fundamentally a step
                     data = {
                         "outputs": [
@@ -258,7 +626,7 @@ class FuryEngine:
                                 "name": k.split("/")[-1],
                                 "data": v,
                             }
-                            for k, v in ir.items()
+                            for k, v in ir_to_dict(ir).items()
                         ]
                     }
                     k = next(iter(ir)).split("/")[0]
@@ -286,6 +654,9 @@ class FuryEngine:
             logger.debug("Processed graph")
             yield result, True
 
+        except ChainTimeoutError as e:
+            logger.warning(f"Chain {chatbot.id} timed out: {e}")
+            raise HTTPException(status_code=504, detail=str(e)) from e
         except Exception as e:
             traceback.print_exc()
             logger.exception(e)
@@ -308,9 +679,8 @@ class FuryEngine:
             logger.debug("Adding prompt to database")
             prompt_row = create_prompt(db, chatbot.id, prompt.new_message if store_io else "", prompt.session_id)  # type: ignore
 
-            # Create a Fury chain then run the chain while logging all the intermediate steps
-            dag = T.Dag(**chatbot.dag)  # type: ignore
-            chain = Chain.from_dag(dag, check_server=False)
+            # Get the Fury chain then run the chain while logging all the intermediate steps
+            chain = chain_cache.get(chatbot)
             if prompt.new_message:
                 prompt.data = {chain.main_in: prompt.new_message}
 
@@ -337,22 +707,40 @@ class FuryEngine:
             prompt_row.time_taken = float(time.time() - start)  # type: ignore
             prompt_row.meta = {"task_id": task_id}  # type: ignore
 
-            app.send_task(
-                "chainfury_server.engine.run_chain",
-                queue="cfs",
-                kwargs={
-                    "chatbot_id": chatbot.id,
-                    "prompt_id": prompt_row.id,
-                    "prompt_data": prompt.data,
-                    "store_ir": store_ir,
-                    "store_io": store_io,
-                    "worker_id": worker_id,
-                },
-                task_id=task_id,
-                expires=600,  # 10 mins
-                time_limit=240,  # 4 mins
-                soft_time_limit=60,  # 1 min
-            )
+            kwargs = {
+                "chatbot_id": chatbot.id,
+                "prompt_id": prompt_row.id,
+                "prompt_data": prompt.data,
+                "store_ir": store_ir,
+                "store_io": store_io,
+                "worker_id": worker_id,
+            }
+            if Env.CFS_DISTRIBUTED():
+                # the nodes are scheduled by the coordinator as they become ready
+                timeout = Env.CFS_CHAIN_TIMEOUT() or 55
+                kwargs.update(
+                    results=None,
+                    start=start,
+                    deadline=start + timeout,
+                    dag=chatbot.dag,
+                )
+                app.send_task(
+                    "chainfury_server.engine.advance_chain",
+                    queue="cfs",
+                    kwargs=kwargs,
+                    task_id=task_id,
+                    expires=600,  # 10 mins
+                )
+            else:
+                app.send_task(
+                    "chainfury_server.engine.run_chain",
+                    queue="cfs",
+                    kwargs=kwargs,
+                    task_id=task_id,
+                    expires=600,  # 10 mins
+                    time_limit=240,  # 4 mins
+                    soft_time_limit=60,  # 1 min
+                )
 
             db.commit()
             return result
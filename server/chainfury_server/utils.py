@@ -37,6 +37,11 @@ class Env:
         x.strip() for x in os.getenv("CFS_ALLOW_HEADERS", "*").split(",")
     ]
     CFS_DISABLE_UI = lambda: os.getenv("CFS_DISABLE_UI", "0") == "1"
+    CFS_CHAIN_CACHE_MB = lambda: int(os.getenv("CFS_CHAIN_CACHE_MB", 64))
+    CFS_PRUNE_CHAINS = lambda: os.getenv("CFS_PRUNE_CHAINS", "0") == "1"
+    CFS_OPTIMIZE_CHAINS = lambda: os.getenv("CFS_OPTIMIZE_CHAINS", "0") == "1"
+    CFS_CHAIN_TIMEOUT = lambda: float(os.getenv("CFS_CHAIN_TIMEOUT", 0))
+    CFS_DISTRIBUTED = lambda: os.getenv("CFS_DISTRIBUTED", "0") == "1"
     CFS_DISABLE_DOCS = lambda: os.getenv("CFS_DISABLE_DOCS", "0") == "1"
 
 
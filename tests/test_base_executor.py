@@ -0,0 +1,701 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import sys
+import json
+import asyncio
+import datetime
+import time
+import threading
+import unittest
+from typing import List, Tuple, Optional
+from unittest.mock import ANY
+from concurrent.futures import ThreadPoolExecutor
+
+from chainfury import (
+    programatic_actions_registry,
+    Chain,
+    ChainTimeoutError,
+    Edge,
+    IRRecord,
+    Model,
+    Node,
+    Thread,
+    TokenDelta,
+    human,
+    ir_to_dict,
+    memory_registry,
+    remaining_time,
+)
+from chainfury.utils import threaded_map, ir_from_dict
+
+# both the branches wait on this barrier, so they can only finish if they are running at the same time
+_branch_barrier = threading.Barrier(2, timeout=5)
+
+
+def branch_upper(text: str) -> Tuple[str, Optional[Exception]]:
+    _branch_barrier.wait()
+    return text.upper(), None
+
+
+def branch_reverse(text: str) -> Tuple[str, Optional[Exception]]:
+    _branch_barrier.wait()
+    return text[::-1], None
+
+
+def join_texts(left: str, right: str) -> Tuple[str, Optional[Exception]]:
+    return f"{left}|{right}", None
+
+
+def plain_upper(text: str) -> Tuple[str, Optional[Exception]]:
+    return text.upper(), None
+
+
+def plain_reverse(text: str) -> Tuple[str, Optional[Exception]]:
+    return text[::-1], None
+
+
+for _fn in [branch_upper, branch_reverse, join_texts, plain_upper, plain_reverse]:
+    programatic_actions_registry.register(
+        fn=_fn,
+        outputs={"out": (0,)},
+        node_id=f"test-{_fn.__name__}",
+    )
+
+
+_debug_calls = []
+
+
+def debug_log(text: str) -> Tuple[str, Optional[Exception]]:
+    _debug_calls.append(text)
+    return text, None
+
+
+programatic_actions_registry.register(
+    fn=debug_log,
+    outputs={"out": (0,)},
+    node_id="test-debug_log",
+)
+programatic_actions_registry.register(
+    fn=debug_log,
+    outputs={"out": (0,)},
+    node_id="test-debug_sink",
+    side_effect=True,
+)
+
+
+def debug_memory(items: list) -> Tuple[List[str], Optional[Exception]]:
+    return items, None
+
+
+_read_memory = memory_registry.register_read(
+    "testmemory", debug_memory, {"items": ()}, vector_key="items"
+)
+_write_memory = memory_registry.register_write(
+    "testmemory", debug_memory, {"items": ()}, vector_key="items"
+)
+
+
+# the stuck nodes are released at the end of each test so the abandoned threads do not pile up
+_stuck = threading.Event()
+
+
+def stuck_reverse(text: str) -> Tuple[str, Optional[Exception]]:
+    _stuck.wait(5)
+    return text[::-1], None
+
+
+def timed_reverse(text: str) -> Tuple[str, Optional[Exception]]:
+    left = remaining_time()
+    return "none" if left is None else f"{left:.0f}", None
+
+
+def slow_upper(text: str) -> Tuple[str, Optional[Exception]]:
+    time.sleep(0.3)
+    return text.upper(), None
+
+
+def slow_reverse(text: str) -> Tuple[str, Optional[Exception]]:
+    time.sleep(0.2)
+    return text[::-1], None
+
+
+for _fn in [slow_upper, slow_reverse]:
+    programatic_actions_registry.register(
+        fn=_fn, outputs={"out": (0,)}, node_id=f"test-{_fn.__name__}"
+    )
+programatic_actions_registry.register(
+    fn=stuck_reverse,
+    outputs={"out": (0,)},
+    node_id="test-stuck_reverse",
+)
+programatic_actions_registry.register(
+    fn=timed_reverse,
+    outputs={"out": (0,)},
+    node_id="test-timed_reverse",
+    timeout=30,
+)
+
+
+def get_chain(left: str, right: str) -> Chain:
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get(f"test-{left}"),  # type: ignore
+            programatic_actions_registry.get(f"test-{right}"),  # type: ignore
+            programatic_actions_registry.get("test-join_texts"),  # type: ignore
+        ],
+        edges=[
+            Edge(f"test-{left}", "out", "test-join_texts", "left"),
+            Edge(f"test-{right}", "out", "test-join_texts", "right"),
+        ],
+        sample={"text": "hello"},
+        main_in="text",
+        main_out="test-join_texts/out",
+    )
+
+
+class TestParallelExecutor(unittest.TestCase):
+    """Testing the level parallel execution of the Chain"""
+
+    def test_parallel_call(self):
+        chain = get_chain("branch_upper", "branch_reverse")
+        out, full_ir = chain("hello", max_workers=2)
+        self.assertEqual(out, "HELLO|olleh")
+        self.assertEqual(len(full_ir), 3)
+
+    def test_parallel_stream_order(self):
+        chain = get_chain("branch_upper", "branch_reverse")
+        seen = []
+        for ir, done in chain.stream("hello", max_workers=2):
+            if done:
+                self.assertEqual(ir, "HELLO|olleh")
+            else:
+                seen.extend(ir.keys())
+        self.assertEqual(seen[-1], "test-join_texts/out")
+        self.assertEqual(len(seen), 3)
+
+    def test_parallel_matches_serial(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        serial_out, serial_ir = chain("world")
+        parallel_out, parallel_ir = chain("world", max_workers=4)
+        self.assertEqual(serial_out, parallel_out)
+        self.assertEqual(
+            {k: v["value"] for k, v in serial_ir.items()},
+            {k: v["value"] for k, v in parallel_ir.items()},
+        )
+
+
+class TestIRRecord(unittest.TestCase):
+    """Testing the records of the IR buffer"""
+
+    def test_records(self):
+        end_ns = time.monotonic_ns()
+        record = IRRecord("test-join_texts", "AB|ba", end_ns - 15, end_ns)
+        self.assertEqual(record.node_id, "test-join_texts")
+        self.assertAlmostEqual(record.duration, 15e-9)
+        self.assertEqual(record["value"], "AB|ba")
+        self.assertEqual(record.to_dict(), {"value": "AB|ba", "timestamp": ANY})
+        ts = datetime.datetime.fromisoformat(record["timestamp"])
+        self.assertTrue(abs((datetime.datetime.now() - ts).total_seconds()) < 60)
+        with self.assertRaises(AttributeError):
+            record.extra = 1
+
+        # the chain hands back plain dicts
+        chain = get_chain("plain_upper", "plain_reverse")
+        thoughts = []
+        for max_workers in [1, 2]:
+            _, full_ir = chain("ab", max_workers=max_workers)
+            record = full_ir["test-join_texts/out"]
+            self.assertEqual(record, {"value": "AB|ba", "timestamp": ANY})
+        self.assertEqual(json.loads(json.dumps(full_ir)), full_ir)
+
+        chain.nodes["test-join_texts"].allow_callback = True
+        chain("ab", thoughts_callback=thoughts.append)
+        self.assertEqual(
+            thoughts[-1],
+            {"key": "test-join_texts/out", "value": "AB|ba", "timestamp": ANY},
+        )
+
+    def test_mutation(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        _, full_ir = chain("ab")
+        full_ir["test-plain_upper/out"]["value"] = "XY"
+        full_ir["test-plain_upper/out"]["note"] = 1
+        self.assertEqual(full_ir["test-plain_upper/out"]["value"], "XY")
+        self.assertEqual(json.loads(json.dumps(full_ir)), full_ir)
+        # a rerun reads the edited value back
+        out, _ = chain.rerun({"text": "ab"}, full_ir, ["test-join_texts/left"])
+        self.assertEqual(out, "XY|ba")
+        with self.assertRaises(TypeError):
+            IRRecord("test-join_texts", "AB|ba")["value"] = "edited"
+
+    def test_size(self):
+        record = IRRecord("test-join_texts", "AB|ba", 10, 25)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertLess(sys.getsizeof(record), sys.getsizeof(record.to_dict()))
+
+
+class TestChainPlan(unittest.TestCase):
+    """Testing the compiled execution plan of the Chain"""
+
+    def test_plan_graph(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        plan = chain.plan
+        self.assertEqual(plan.order, tuple(chain.topo_order))
+        join = plan.nodes["test-join_texts"]
+        self.assertEqual(set(join.parents), {"test-plain_upper", "test-plain_reverse"})
+        self.assertEqual(plan.nodes["test-plain_upper"].children, ("test-join_texts",))
+        self.assertEqual(plan.remaining()["test-join_texts"], 2)
+
+    def test_node_specific_inputs(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        out, _ = chain({"text": "abc", "test-plain_upper/text": "xyz"})
+        self.assertEqual(out, "XYZ|cba")
+
+
+class TestReentrantChain(unittest.TestCase):
+    """Testing that a single Chain object can serve concurrent runs"""
+
+    def test_concurrent_runs(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        inputs = [f"input-{i}" for i in range(64)]
+        outputs = threaded_map(
+            lambda x: chain(x, max_workers=2)[0],
+            [(x,) for x in inputs],
+            max_threads=16,
+        )
+        self.assertEqual(outputs, [f"{x.upper()}|{x[::-1]}" for x in inputs])
+
+    def test_no_state_on_graph(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        chain("hello")
+        for node in chain.nodes.values():
+            for o in node.outputs:
+                self.assertIsNone(o.value)
+        self.assertEqual(chain.sample, {"text": "hello"})
+
+    def test_sample_not_copied(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        chain.sample = {"text": "hello", "shots": [1, 2, 3]}
+        data = chain._prepare_data({"test-plain_upper/text": "xyz"})
+        self.assertIs(data["shots"], chain.sample["shots"])
+        self.assertEqual(chain(dict(data))[0], "XYZ|olleh")
+        self.assertEqual(data["test-plain_upper/text"], "xyz")
+
+
+def get_debug_chain(prune: bool) -> Chain:
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get("test-plain_upper"),  # type: ignore
+            programatic_actions_registry.get("test-plain_reverse"),  # type: ignore
+            programatic_actions_registry.get("test-join_texts"),  # type: ignore
+            programatic_actions_registry.get("test-debug_log"),  # type: ignore
+            programatic_actions_registry.get("test-debug_sink"),  # type: ignore
+        ],
+        edges=[
+            Edge("test-plain_upper", "out", "test-join_texts", "left"),
+            Edge("test-plain_reverse", "out", "test-join_texts", "right"),
+            Edge("test-plain_upper", "out", "test-debug_log", "text"),
+            Edge("test-plain_reverse", "out", "test-debug_sink", "text"),
+        ],
+        sample={"text": "hello"},
+        main_in="text",
+        main_out="test-join_texts/out",
+        prune=prune,
+    )
+
+
+class TestPruning(unittest.TestCase):
+    """Testing that only the nodes needed for main_out are run"""
+
+    def setUp(self):
+        _debug_calls.clear()
+
+    def test_no_pruning_by_default(self):
+        _, ir = get_debug_chain(prune=False)("abc")
+        self.assertIn("test-debug_log/out", ir)
+        self.assertEqual(sorted(_debug_calls), ["ABC", "cba"])
+
+    def test_prune(self):
+        chain = get_debug_chain(prune=True)
+        for max_workers in [1, 3]:
+            _debug_calls.clear()
+            out, ir = chain("abc", max_workers=max_workers)
+            self.assertEqual(out, "ABC|cba")
+            self.assertNotIn("test-debug_log/out", ir)
+            self.assertEqual(_debug_calls, ["cba"])  # side effects are kept
+
+    def test_requested_outputs(self):
+        chain = get_debug_chain(prune=False)
+        _, ir = chain("abc", outputs=["test-debug_log/out"])
+        self.assertIn("test-debug_log/out", ir)
+        with self.assertRaises(ValueError):
+            chain("abc", outputs=["missing/out"])
+
+    def test_prune_rerun(self):
+        chain = get_debug_chain(prune=True)
+        _, ir = chain("abc")
+        _debug_calls.clear()
+        out, new_ir = chain.rerun("xyz", ir)
+        self.assertEqual(out, "XYZ|zyx")
+        self.assertNotIn("test-debug_log/out", new_ir)
+        self.assertEqual(_debug_calls, ["zyx"])
+
+        # nothing changed, the missing output of the pruned node is not a reason to run it
+        _debug_calls.clear()
+        chain.rerun("xyz", new_ir, changed=[])
+        self.assertEqual(_debug_calls, [])
+        _, new_ir = chain.rerun("xyz", new_ir, changed=[], outputs=["test-debug_log"])
+        self.assertEqual(new_ir["test-debug_log/out"]["value"], "XYZ")
+
+    def test_memory_side_effect(self):
+        self.assertFalse(_read_memory.side_effect)
+        self.assertTrue(_write_memory.side_effect)
+        for mem in [_read_memory, _write_memory]:
+            data = mem.to_dict()
+            data.pop("side_effect")  # saved before the flag existed
+            node = Node.from_dict(data)
+            self.assertEqual(node.side_effect, mem.side_effect)
+
+        # a read that was marked by hand keeps the flag
+        data = _read_memory.to_dict()
+        data["side_effect"] = True
+        self.assertTrue(Node.from_dict(data).side_effect)
+
+    def test_prune_batch(self):
+        chain = get_debug_chain(prune=True)
+        results = chain.batch(["a", "b"])
+        self.assertEqual([r[0] for r in results], ["A|a", "B|b"])
+        self.assertEqual(sorted(_debug_calls), ["a", "b"])
+
+
+class TestRerun(unittest.TestCase):
+    """Testing the incremental re-execution of the Chain"""
+
+    def test_only_dirty_nodes(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        _, ir = chain({"text": "abc"})
+        out, new_ir = chain.rerun(
+            {"text": "abc", "test-plain_upper/text": "xyz"},
+            ir,
+            changed=["test-plain_upper/text"],
+        )
+        self.assertEqual(out, "XYZ|cba")
+        self.assertIs(new_ir["test-plain_reverse/out"], ir["test-plain_reverse/out"])
+        self.assertIsNot(new_ir["test-plain_upper/out"], ir["test-plain_upper/out"])
+        self.assertEqual(ir["test-join_texts/out"]["value"], "ABC|cba")
+
+    def test_shared_input(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        _, ir = chain("abc")
+        for max_workers in [1, 2]:
+            out, new_ir = chain.rerun("xyz", ir, max_workers=max_workers)
+            self.assertEqual(out, "XYZ|zyx")
+            self.assertEqual(new_ir.keys(), ir.keys())
+
+    def test_missing_outputs(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        _, ir = chain("abc")
+        ir.pop("test-join_texts/out")
+        out, new_ir = chain.rerun("abc", ir, changed=[])
+        self.assertEqual(out, "ABC|cba")
+        self.assertIs(new_ir["test-plain_upper/out"], ir["test-plain_upper/out"])
+
+
+class TestFrontier(unittest.TestCase):
+    """Testing the stepping of a run one node at a time, like the distributed mode of the server"""
+
+    def test_frontier(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        full_ir = {}
+        waves = []
+        while True:
+            ready, inactive = chain.frontier(full_ir)
+            if not ready:
+                break
+            waves.append(ready)
+            for node_id in ready:
+                yield_dict, _ = chain.step(node_id, {"text": "ab"}, {**full_ir})
+                full_ir.update(
+                    ir_from_dict(json.loads(json.dumps(ir_to_dict(yield_dict))))
+                )
+        self.assertEqual(
+            waves, [["test-plain_upper", "test-plain_reverse"], ["test-join_texts"]]
+        )
+        self.assertEqual(full_ir["test-join_texts/out"]["value"], "AB|ba")
+
+
+class TestBatch(unittest.TestCase):
+    """Testing the shared scheduler of Chain.batch"""
+
+    def test_batch_matches_call(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        inputs = [f"input-{i}" for i in range(32)]
+        results = chain.batch(inputs, max_concurrency=4)
+        self.assertEqual([r[0] for r in results], [chain(x)[0] for x in inputs])
+        self.assertEqual(len(results[0][1]), 3)
+
+    def test_batch_branches_overlap(self):
+        # the barrier in the branches only opens if both run at the same time
+        chain = get_chain("branch_upper", "branch_reverse")
+        results = chain.batch(["ab", "cd"], max_concurrency=2)
+        self.assertEqual([r[0] for r in results], ["AB|ba", "CD|dc"])
+
+    def test_batch_iter_unordered(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        seen = {i: r[0] for i, r in chain.batch_iter(["a", "b", "c"], ordered=False)}
+        self.assertEqual(seen, {0: "A|a", 1: "B|b", 2: "C|c"})
+
+    def test_batch_exceptions(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        inputs = ["ok", {"test-plain_upper/text": None}, "fine"]
+        results = chain.batch(inputs, return_exceptions=True)
+        self.assertEqual(results[0][0], "OK|ko")
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(results[2][0], "FINE|enif")
+        with self.assertRaises(Exception):
+            chain.batch(inputs)
+
+
+class ShoutModel(Model):
+    """Model that shouts back the last message, ``achat`` is native so the async path never touches threads"""
+
+    def __init__(self):
+        super().__init__(id="test-shout", description="shouts back")
+
+    def chat(self, chats, **kwargs):
+        return chats[-1]["content"].upper()
+
+    async def achat(self, chats, **kwargs):
+        await asyncio.sleep(0)
+        return self.chat(chats)
+
+    def stream_chat(self, chats, **kwargs):
+        for word in self.chat(chats).split(" "):
+            yield word + " "
+
+
+def get_thread_chain() -> Chain:
+    chain = Chain(
+        main_in="name",
+        main_out="greet/greet",
+        default_model=ShoutModel(),
+        sample={"name": "fury"},
+    )
+    chain.add_thread("hello", Thread(human("hello {{ name }}")))
+    chain.add_thread("greet", Thread(human("{{ hello }}, how are you?")))
+    return chain
+
+
+class TestAsyncExecutor(unittest.IsolatedAsyncioTestCase):
+    """Testing the asyncio execution path of the Chain"""
+
+    async def test_acall(self):
+        chain = get_thread_chain()
+        out, full_ir = await chain.acall("fury")
+        self.assertEqual(out, "HELLO FURY, HOW ARE YOU?")
+        self.assertEqual(out, chain("fury")[0])
+
+    async def test_astream(self):
+        chain = get_thread_chain()
+        keys = []
+        async for ir, done in chain.astream("fury"):
+            if done:
+                self.assertEqual(ir, "HELLO FURY, HOW ARE YOU?")
+            else:
+                keys.extend(ir.keys())
+        self.assertEqual(keys, ["hello/hello", "greet/greet"])
+
+    async def test_acall_prune(self):
+        _debug_calls.clear()
+        out, ir = await get_debug_chain(prune=True).acall("abc")
+        self.assertEqual(out, "ABC|cba")
+        self.assertEqual(len(ir), 4)
+        self.assertEqual(_debug_calls, ["cba"])
+
+    async def test_acall_programatic(self):
+        chain = get_chain("branch_upper", "branch_reverse")
+        out, _ = await chain.acall("hello")
+        self.assertEqual(out, "HELLO|olleh")
+
+
+class TestTokenStream(unittest.TestCase):
+    """Testing the token level streaming of main_out"""
+
+    def test_stream_tokens(self):
+        chain = get_thread_chain()
+        deltas = []
+        ir_keys = []
+        for ir, done in chain.stream("fury", stream_tokens=True, max_workers=2):
+            if done:
+                out = ir
+            elif isinstance(ir, TokenDelta):
+                self.assertEqual(ir.key, "greet/greet")
+                deltas.append(ir.delta)
+            else:
+                ir_keys.extend(ir.keys())
+        self.assertEqual(deltas, ["HELLO ", "FURY, ", "HOW ", "ARE ", "YOU? "])
+        self.assertEqual(out, "".join(deltas))
+        self.assertEqual(ir_keys, ["hello/hello", "greet/greet"])
+
+    def test_no_stream_support(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        events = list(chain.stream("abc", stream_tokens=True))
+        self.assertFalse(any(isinstance(ir, TokenDelta) for ir, _ in events))
+        self.assertEqual(events[-1], ("ABC|cba", True))
+
+
+class TestAsyncTokenStream(unittest.IsolatedAsyncioTestCase):
+    async def test_astream_tokens(self):
+        chain = get_thread_chain()
+        deltas = []
+        ir_keys = []
+        async for ir, done in chain.astream("fury", stream_tokens=True):
+            if done:
+                out = ir
+            elif isinstance(ir, TokenDelta):
+                self.assertEqual(ir.key, "greet/greet")
+                deltas.append(ir.delta)
+            else:
+                ir_keys.extend(ir.keys())
+        self.assertEqual(deltas, ["HELLO ", "FURY, ", "HOW ", "ARE ", "YOU? "])
+        self.assertEqual(out, "".join(deltas))
+        self.assertEqual(ir_keys, ["hello/hello", "greet/greet"])
+
+
+class SlowModel(Model):
+    """Model that records how many calls are running at the same time"""
+
+    def __init__(self):
+        super().__init__(id="test-slow", description="slow")
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def chat(self, chats, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return chats[-1]["content"]
+
+
+class TestModelConcurrencyLimit(unittest.TestCase):
+    def test_limit(self):
+        model = SlowModel().set_concurrency_limit(2)
+        chain = Chain(main_in="name", main_out="hello/hello", default_model=model)
+        chain.add_thread("hello", Thread(human("hello {{ name }}")))
+        results = chain.batch([str(i) for i in range(12)], max_concurrency=8)
+        self.assertEqual(results[3][0], "hello 3")
+        self.assertEqual(model.peak, 2)
+
+
+class TestAsyncModelConcurrencyLimit(unittest.IsolatedAsyncioTestCase):
+    async def test_more_calls_than_threads(self):
+        # the calls waiting for a slot must not hold the threads that achat needs
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=2)
+        )
+        model = SlowModel().set_concurrency_limit(1)
+        calls = [model.acall({"chat": [{"content": str(i)}]}) for i in range(7)]
+        results = await asyncio.wait_for(asyncio.gather(*calls), timeout=5)
+        self.assertEqual([out for out, _ in results], [str(i) for i in range(7)])
+        self.assertEqual(model.peak, 1)
+
+    async def test_cancelled_waiter(self):
+        model = SlowModel().set_concurrency_limit(1)
+        first = asyncio.ensure_future(model.acall({"chat": [{"content": "a"}]}))
+        waiter = asyncio.ensure_future(model.acall({"chat": [{"content": "b"}]}))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        self.assertEqual(await first, ("a", None))
+        # the slot is free again and was not released twice
+        self.assertEqual(await model.acall({"chat": [{"content": "c"}]}), ("c", None))
+        self.assertEqual(model._async_limit()._value, 1)  # type: ignore
+
+
+class TestDeadlines(unittest.TestCase):
+    def setUp(self):
+        _stuck.clear()
+
+    def tearDown(self):
+        _stuck.set()
+
+    def test_chain_timeout(self):
+        chain = get_chain("plain_upper", "stuck_reverse")
+        st = time.monotonic()
+        with self.assertRaises(ChainTimeoutError) as ctx:
+            chain("hello", timeout=0.2)
+        self.assertLess(time.monotonic() - st, 2)
+        self.assertEqual(ctx.exception.node_ids, ["test-stuck_reverse"])
+        self.assertEqual(list(ctx.exception.full_ir), ["test-plain_upper/out"])
+
+    def test_stream_partial(self):
+        chain = get_chain("plain_upper", "stuck_reverse")
+        seen = []
+        with self.assertRaises(ChainTimeoutError):
+            for ir, _ in chain.stream("hello", timeout=0.2, max_workers=2):
+                seen.extend(ir.keys())
+        self.assertEqual(seen, ["test-plain_upper/out"])
+
+    def test_node_timeout(self):
+        chain = get_chain("plain_upper", "stuck_reverse")
+        chain.nodes["test-stuck_reverse"].timeout = 0.1
+        with self.assertRaises(ChainTimeoutError) as ctx:
+            chain("hello")
+        self.assertEqual(ctx.exception.node_ids, ["test-stuck_reverse"])
+
+    def test_node_timeout_queued(self):
+        # with one worker the reverse waits for the upper, that time is not part of its own timeout
+        chain = get_chain("slow_upper", "slow_reverse")
+        chain.nodes["test-slow_reverse"].timeout = 0.35
+        self.assertEqual(chain("hello", max_workers=1)[0], "HELLO|olleh")
+        chain.nodes["test-slow_reverse"].timeout = 0.1
+        with self.assertRaises(ChainTimeoutError) as ctx:
+            chain("hello", max_workers=1)
+        self.assertEqual(ctx.exception.node_ids, ["test-slow_reverse"])
+
+    def test_remaining_time(self):
+        chain = get_chain("plain_upper", "timed_reverse")
+        self.assertEqual(chain("hello")[0], "HELLO|30")
+        self.assertEqual(chain("hello", timeout=10)[0], "HELLO|10")
+        node = chain.nodes["test-timed_reverse"]
+        self.assertEqual(node.to_dict()["timeout"], 30)
+        node.timeout = None
+        self.assertEqual(chain("hello")[0], "HELLO|none")
+
+    def test_no_timeout(self):
+        chain = get_chain("plain_upper", "plain_reverse")
+        self.assertEqual(chain("hello", timeout=5)[0], "HELLO|olleh")
+
+
+class TestAsyncDeadlines(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        _stuck.clear()
+
+    def tearDown(self):
+        _stuck.set()
+
+    async def test_acall_timeout(self):
+        chain = get_chain("plain_upper", "stuck_reverse")
+        with self.assertRaises(ChainTimeoutError) as ctx:
+            await chain.acall("hello", timeout=0.2)
+        self.assertEqual(ctx.exception.node_ids, ["test-stuck_reverse"])
+        self.assertIn("test-plain_upper/out", ctx.exception.full_ir)
+
+    async def test_acall_node_timeout(self):
+        chain = get_chain("slow_upper", "slow_reverse")
+        chain.nodes["test-slow_reverse"].timeout = 0.1
+        with self.assertRaises(ChainTimeoutError) as ctx:
+            await chain.acall("hello")
+        self.assertEqual(ctx.exception.node_ids, ["test-slow_reverse"])
+
+    async def test_acall_remaining_time(self):
+        chain = get_chain("plain_upper", "timed_reverse")
+        out, _ = await chain.acall("hello", timeout=10)
+        self.assertEqual(out, "HELLO|10")
+
+
+if __name__ == "__main__":
+    unittest.main()
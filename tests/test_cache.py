@@ -0,0 +1,176 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import os
+import tempfile
+import unittest
+from typing import List, Optional, Tuple
+
+from chainfury import (
+    Chain,
+    Model,
+    Node,
+    Thread,
+    human,
+    InMemoryCache,
+    SQLiteCache,
+    programatic_actions_registry,
+)
+from chainfury.cache import hash_key
+
+_slow_calls = []
+
+
+def slow_words(text: str) -> Tuple[List[str], Optional[Exception]]:
+    _slow_calls.append(text)
+    return text.split(), None
+
+
+programatic_actions_registry.register(
+    fn=slow_words,
+    outputs={"words": ()},  # type: ignore
+    node_id="test-slow_words",
+    pure=True,
+    cache=InMemoryCache(maxsize=2),
+)
+
+
+class CountingModel(Model):
+    """Model that echoes back the last message and counts the number of calls"""
+
+    def __init__(self):
+        super().__init__(id="test-counting", description="counts calls")
+        self.calls = 0
+
+    def chat(self, chats, **kwargs):
+        self.calls += 1
+        return chats[-1]["content"]
+
+
+def get_chain(model: Model, llm_cache: bool = True) -> Chain:
+    chain = Chain(
+        main_in="name",
+        main_out="hello/hello",
+        default_model=model,
+        sample={"name": "fury"},
+        llm_cache=llm_cache,
+    )
+    chain.add_thread("hello", Thread(human("hello {{ name }}")))
+    return chain
+
+
+class TestCacheBackends(unittest.TestCase):
+    def test_hash_key_order(self):
+        self.assertEqual(
+            hash_key("m", {"a": 1, "b": 2}), hash_key("m", {"b": 2, "a": 1})
+        )
+        self.assertNotEqual(hash_key("m", {"a": 1}), hash_key("n", {"a": 1}))
+
+    def test_lru(self):
+        cache = InMemoryCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("a"), (True, 1))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_ttl(self):
+        cache = InMemoryCache(ttl=-1)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as d:
+            fp = os.path.join(d, "cache.db")
+            cache = SQLiteCache(fp)
+            cache.set("a", {"x": [1, 2]})
+            self.assertEqual(SQLiteCache(fp).get("a"), (True, {"x": [1, 2]}))
+            self.assertEqual(len(cache), 1)
+            cache.clear()
+            self.assertEqual(cache.get("a"), (False, None))
+
+
+class TestModelCache(unittest.TestCase):
+    def test_no_cache_by_default(self):
+        model = CountingModel()
+        chain = get_chain(model)
+        chain("fury")
+        chain("fury")
+        self.assertEqual(model.calls, 2)
+
+    def test_cache_hits(self):
+        model = CountingModel().set_cache(InMemoryCache())
+        chain = get_chain(model)
+        out, _ = chain("fury")
+        self.assertEqual(chain("fury")[0], out)
+        chain("fire")
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(model.cache.stats()["hits"], 1)  # type: ignore
+        self.assertEqual(model.cache.stats()["misses"], 2)  # type: ignore
+
+    def test_chain_opt_out(self):
+        model = CountingModel().set_cache(InMemoryCache())
+        chain = get_chain(model, llm_cache=False)
+        chain("fury")
+        chain("fury")
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(len(model.cache), 0)  # type: ignore
+
+    def test_shared_node(self):
+        # the flag of one chain does not change the nodes it shares with another
+        model = CountingModel().set_cache(InMemoryCache())
+        cached = get_chain(model)
+        fresh = Chain(
+            nodes=list(cached.nodes.values()),
+            main_in="name",
+            main_out="hello/hello",
+            sample={"name": "fury"},
+            llm_cache=False,
+        )
+        cached("fury")
+        fresh("fury")
+        self.assertEqual(model.calls, 2)
+        cached("fury")
+        self.assertEqual(model.calls, 2)
+
+    def test_errors_not_cached(self):
+        model = CountingModel().set_cache(InMemoryCache())
+        _, err = model({"wrong_key": 1})
+        self.assertIsNotNone(err)
+        self.assertEqual(len(model.cache), 0)  # type: ignore
+
+
+class TestPureNodes(unittest.TestCase):
+    def setUp(self):
+        _slow_calls.clear()
+
+    def test_memoized_across_copies(self):
+        node_a = programatic_actions_registry.get("test-slow_words")
+        node_b = programatic_actions_registry.get("test-slow_words")
+        self.assertEqual(node_a({"text": "a b"}), ({"words": ["a", "b"]}, None))  # type: ignore
+        self.assertEqual(node_b({"text": "a b"}), ({"words": ["a", "b"]}, None))  # type: ignore
+        self.assertEqual(_slow_calls, ["a b"])
+
+    def test_outputs_are_copied(self):
+        node = programatic_actions_registry.get("test-slow_words")
+        out, _ = node({"text": "x y"})  # type: ignore
+        out["words"].append("z")
+        self.assertEqual(node({"text": "x y"})[0], {"words": ["x", "y"]})  # type: ignore
+
+    def test_eviction(self):
+        node = programatic_actions_registry.get("test-slow_words")
+        for text in ["1", "2", "3", "1"]:
+            node({"text": text})  # type: ignore
+        self.assertEqual(_slow_calls, ["1", "2", "3", "1"])
+
+    def test_pure_roundtrip(self):
+        node = programatic_actions_registry.get("test-slow_words")
+        self.assertTrue(node.to_dict()["pure"])  # type: ignore
+        self.assertIsNotNone(Node.from_dict(node.to_dict()).cache)  # type: ignore
+
+
+if __name__ == "__main__":
+    unittest.main()
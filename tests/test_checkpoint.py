@@ -0,0 +1,137 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import os
+import tempfile
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import programatic_actions_registry, Chain, Edge, FileCheckpoint
+
+_calls = []
+_fail = {"ck-shout": False}
+
+
+def ck_count(text: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("ck-count")
+    return str(len(text)), None
+
+
+def ck_shout(text: str, count: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("ck-shout")
+    if _fail["ck-shout"]:
+        return "", RuntimeError("worker died")
+    return f"{text.upper()}:{count}", None
+
+
+programatic_actions_registry.register(
+    fn=ck_count, outputs={"out": (0,)}, node_id="test-ck_count"
+)
+programatic_actions_registry.register(
+    fn=ck_shout, outputs={"out": (0,)}, node_id="test-ck_shout"
+)
+
+
+def get_chain() -> Chain:
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get("test-ck_count"),  # type: ignore
+            programatic_actions_registry.get("test-ck_shout"),  # type: ignore
+        ],
+        edges=[Edge("test-ck_count", "out", "test-ck_shout", "count")],
+        sample={"text": "hello"},
+        main_in="text",
+        main_out="test-ck_shout/out",
+    )
+
+
+class TestFileCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fp = os.path.join(self.dir.name, "run.jsonl")
+        _calls.clear()
+        _fail["ck-shout"] = False
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_save_load(self):
+        checkpoint = FileCheckpoint(self.fp)
+        self.assertEqual(checkpoint.load(), {})
+        checkpoint.save({"a/out": {"value": 1}})
+        checkpoint.save({"b/out": {"value": [2]}})
+        with open(self.fp, "a") as f:
+            f.write('{"c/out": {"val')  # died while writing
+        self.assertEqual(
+            FileCheckpoint(self.fp).load(),
+            {"a/out": {"value": 1}, "b/out": {"value": [2]}},
+        )
+        checkpoint.clear()
+        self.assertEqual(checkpoint.load(), {})
+
+    def test_resume(self):
+        chain = get_chain()
+        checkpoint = FileCheckpoint(self.fp)
+        _fail["ck-shout"] = True
+        with self.assertRaises(RuntimeError):
+            chain("abc", checkpoint=checkpoint)
+        self.assertEqual(list(checkpoint.load()), ["test-ck_count/out"])
+
+        _fail["ck-shout"] = False
+        _calls.clear()
+        out, full_ir = chain.resume("abc", checkpoint)
+        self.assertEqual(out, "ABC:3")
+        self.assertEqual(_calls, ["ck-shout"])
+        self.assertEqual(set(full_ir), {"test-ck_count/out", "test-ck_shout/out"})
+
+        # everything is in the checkpoint now
+        _calls.clear()
+        self.assertEqual(chain.resume("abc", checkpoint)[0], "ABC:3")
+        self.assertEqual(_calls, [])
+
+    def test_stream_checkpoint(self):
+        chain = get_chain()
+        checkpoint = FileCheckpoint(self.fp)
+        events = list(chain.stream("abc", checkpoint=checkpoint))
+        self.assertEqual(events[-1], ("ABC:3", True))
+        self.assertEqual(
+            set(checkpoint.load()), {"test-ck_count/out", "test-ck_shout/out"}
+        )
+
+
+class TestAsyncCheckpoint(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fp = os.path.join(self.dir.name, "run.jsonl")
+        _calls.clear()
+        _fail["ck-shout"] = False
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_acall_resume(self):
+        chain = get_chain()
+        checkpoint = FileCheckpoint(self.fp)
+        _fail["ck-shout"] = True
+        with self.assertRaises(RuntimeError):
+            await chain.acall("abc", checkpoint=checkpoint)
+        self.assertEqual(list(checkpoint.load()), ["test-ck_count/out"])
+
+        _fail["ck-shout"] = False
+        _calls.clear()
+        out, full_ir = await chain.acall("abc", checkpoint=checkpoint)
+        self.assertEqual(out, "ABC:3")
+        self.assertEqual(_calls, ["ck-shout"])
+        self.assertEqual(set(full_ir), {"test-ck_count/out", "test-ck_shout/out"})
+
+    async def test_astream_checkpoint(self):
+        chain = get_chain()
+        checkpoint = FileCheckpoint(self.fp)
+        events = [e async for e in chain.astream("abc", checkpoint=checkpoint)]
+        self.assertEqual(events[-1], ("ABC:3", True))
+        self.assertEqual(
+            set(checkpoint.load()), {"test-ck_count/out", "test-ck_shout/out"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
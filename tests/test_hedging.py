@@ -0,0 +1,154 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import os
+import asyncio
+import time
+import threading
+import unittest
+from unittest.mock import patch
+
+from chainfury import Model, HedgePolicy, LatencyWindow, model_registry
+
+
+class StallingModel(Model):
+    """Model whose first call stalls until ``release`` is set, every other call returns right away"""
+
+    def __init__(self, id: str):
+        super().__init__(id=id, description="stalls on the first call")
+        self.calls = 0
+        self.cancelled = False
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def chat(self, chats, **kwargs):
+        with self.lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            self.release.wait(5)
+            return "slow"
+        return "fast"
+
+    async def achat(self, chats, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            return "slow"
+        return "fast"
+
+
+MODEL_DATA = {"chats": [{"role": "user", "content": "hi"}]}
+
+
+class TestLatencyWindow(unittest.TestCase):
+    def test_percentile(self):
+        window = LatencyWindow(size=100)
+        self.assertIsNone(window.percentile(50))
+        for i in range(1, 101):
+            window.record(i / 100)
+        self.assertEqual(window.percentile(50), 0.5)
+        self.assertEqual(window.percentile(99), 0.99)
+        self.assertEqual(window.percentile(100), 1.0)
+        window.record(2.0)
+        self.assertEqual(len(window), 100)
+        self.assertEqual(window.percentile(100), 2.0)
+
+    def test_policy_delay(self):
+        policy = HedgePolicy(percentile=90, min_samples=10, min_delay=0.2, max_delay=1)
+        window = LatencyWindow()
+        self.assertEqual(policy.delay(window), 1)
+        for i in range(10):
+            window.record(0.1)
+        self.assertEqual(policy.delay(window), 0.2)
+        for i in range(10):
+            window.record(5)
+        self.assertEqual(policy.delay(window), 1)
+        self.assertIsNone(HedgePolicy(min_samples=10).delay(LatencyWindow()))
+
+    def test_policy_roundtrip(self):
+        policy = HedgePolicy(percentile=99, max_delay=3)
+        self.assertEqual(
+            HedgePolicy.from_dict(policy.to_dict()).to_dict(), policy.to_dict()
+        )
+
+
+class TestHedgedModel(unittest.TestCase):
+    def test_no_hedging_by_default(self):
+        model = StallingModel("test-hedge-off")
+        model.release.set()
+        self.assertEqual(model(MODEL_DATA), ("slow", None))
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(model_registry.latency("test-hedge-off").stats()["count"], 1)
+
+    def test_hedge_wins(self):
+        model = StallingModel("test-hedge-sync")
+        model.set_hedging(HedgePolicy(max_delay=0.05))
+        try:
+            st = time.monotonic()
+            self.assertEqual(model(MODEL_DATA), ("fast", None))
+            self.assertLess(time.monotonic() - st, 2)
+        finally:
+            model.release.set()
+        stats = model_registry.get_latency_stats()["test-hedge-sync"]
+        self.assertEqual(stats["hedges"], 1)
+        self.assertEqual(stats["hedge_wins"], 1)
+
+    def test_fast_calls_not_hedged(self):
+        model = StallingModel("test-hedge-fast")
+        model.release.set()
+        self.assertEqual(
+            model(MODEL_DATA, hedging=HedgePolicy(max_delay=5)), ("slow", None)
+        )
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(model.latency.hedges, 0)
+
+    def test_queue_time_not_hedged(self):
+        model = StallingModel("test-hedge-queue")
+        model.release.set()
+        model.set_concurrency_limit(1)
+        # another call holds the only slot for longer than the hedge delay
+        model.concurrency_limit.acquire()
+        threading.Timer(0.2, model.concurrency_limit.release).start()
+        out = model(MODEL_DATA, hedging=HedgePolicy(max_delay=0.05))
+        self.assertEqual(out, ("slow", None))
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(model.latency.hedges, 0)
+        self.assertLess(model.latency.percentile(100), 0.2)
+
+    def test_pool_size(self):
+        from chainfury import hedging
+
+        with patch.dict(os.environ, {"CF_HEDGE_WORKERS": "3"}):
+            with patch.object(hedging, "_executor", None):
+                self.assertEqual(hedging._get_executor()._max_workers, 3)
+
+
+class TestAsyncHedgedModel(unittest.IsolatedAsyncioTestCase):
+    async def test_loser_cancelled(self):
+        model = StallingModel("test-hedge-async")
+        model.set_hedging(HedgePolicy(max_delay=0.05))
+        out = await model.acall(MODEL_DATA)
+        self.assertEqual(out, ("fast", None))
+        await asyncio.sleep(0)
+        self.assertTrue(model.cancelled)
+        self.assertEqual(model.latency.hedge_wins, 1)
+
+    async def test_queue_time_not_hedged(self):
+        model = StallingModel("test-hedge-aqueue")
+        model.calls = 1
+        model.set_concurrency_limit(1)
+        limit = model._async_limit()
+        await limit.acquire()
+        asyncio.get_running_loop().call_later(0.2, limit.release)
+        out = await model.acall(MODEL_DATA, hedging=HedgePolicy(max_delay=0.05))
+        self.assertEqual(out, ("fast", None))
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(model.latency.hedges, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import asyncio
+import threading
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import (
+    programatic_actions_registry,
+    ai_actions_registry,
+    model_registry,
+    Chain,
+    Edge,
+    Model,
+    Node,
+)
+
+# every item waits on this barrier, so they can only finish if they are running at the same time
+_item_barrier = threading.Barrier(3, timeout=5)
+
+
+def map_split(text: str) -> Tuple[list, Optional[Exception]]:
+    return text.split(","), None
+
+
+def map_wrap(doc: str, prefix: str) -> Tuple[str, Optional[Exception]]:
+    if doc == "boom":
+        return "", ValueError("cannot wrap boom")
+    return f"{prefix}{doc}", None
+
+
+def map_wrap_together(doc: str, prefix: str) -> Tuple[str, Optional[Exception]]:
+    _item_barrier.wait()
+    return f"{prefix}{doc}", None
+
+
+programatic_actions_registry.register(
+    fn=map_split, outputs={"out": ()}, node_id="test-map_split"
+)
+for _fn in [map_wrap, map_wrap_together]:
+    programatic_actions_registry.register(
+        fn=_fn, outputs={"out": (0,)}, node_id=f"test-{_fn.__name__}"
+    )
+
+
+class CountModel(Model):
+    def __init__(self):
+        super().__init__(id="test-map-count", description="counts the words")
+
+    def chat(self, messages, **kwargs):
+        return {"words": len(messages[-1]["content"].split())}
+
+    async def achat(self, messages, **kwargs):
+        await asyncio.sleep(0)
+        return self.chat(messages)
+
+
+model_registry.register(CountModel())
+
+
+def get_map_node(node_id: str = "test-map_wrap", max_workers: int = 4) -> Node:
+    inner = programatic_actions_registry.get(node_id)
+    return Node.from_map(inner, over="doc", max_workers=max_workers)  # type: ignore
+
+
+def get_chain(max_workers: int = 4) -> Chain:
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get("test-map_split"),  # type: ignore
+            get_map_node(max_workers=max_workers),
+        ],
+        edges=[Edge("test-map_split", "out", "test-map_wrap-map", "doc")],
+        sample={"text": "a,b,c", "prefix": "> "},
+        main_in="text",
+        main_out="test-map_wrap-map/out",
+    )
+
+
+class TestMapNode(unittest.TestCase):
+    def test_vars(self):
+        node = get_map_node()
+        self.assertEqual(node.type, Node.types.MAP)
+        fields = {f.name: f for f in node.fields}
+        self.assertEqual(fields["doc"].type, "array")
+        self.assertEqual(fields["doc"].items[0].type, "string")
+        self.assertEqual(fields["prefix"].type, "string")
+        self.assertEqual(node.outputs[0].type, "array")
+        with self.assertRaises(ValueError):
+            Node.from_map(node, over="nope")
+
+    def test_call(self):
+        node = get_map_node()
+        out, err = node({"doc": ["a", "b"], "prefix": "- "})
+        self.assertIsNone(err)
+        self.assertEqual(out, {"out": ["- a", "- b"]})
+        self.assertEqual(node({"doc": [], "prefix": "- "}), ({"out": []}, None))
+
+    def test_items_in_parallel(self):
+        node = get_map_node("test-map_wrap_together", max_workers=3)
+        out, err = node({"doc": ["a", "b", "c"], "prefix": ""})
+        self.assertIsNone(err)
+        self.assertEqual(out, {"out": ["a", "b", "c"]})
+
+    def test_errors(self):
+        for max_workers in [1, 4]:
+            node = get_map_node(max_workers=max_workers)
+            _, err = node({"doc": ["a", "boom", "c"], "prefix": ""})
+            self.assertIsInstance(err, ValueError)
+        _, err = get_map_node()({"doc": "a", "prefix": ""})
+        self.assertIsInstance(err, ValueError)
+
+    def test_chain(self):
+        out, full_ir = get_chain()({"text": "x,y,z", "prefix": "# "})
+        self.assertEqual(out, ["# x", "# y", "# z"])
+
+    def test_serialisation(self):
+        chain = get_chain(max_workers=2)
+        node_dict = chain.nodes["test-map_wrap-map"].to_dict()
+        self.assertEqual(node_dict["fn"]["over"], "doc")
+        self.assertEqual(node_dict["fn"]["max_workers"], 2)
+        self.assertEqual(Node.from_dict(node_dict).to_dict(), node_dict)
+
+        chain = Chain.from_dag(chain.to_dag(), check_server=False)
+        self.assertEqual(chain("p,q")[0], ["> p", "> q"])
+
+    def test_ai_inner_node(self):
+        count = ai_actions_registry.to_action(
+            action_name="test-map-count",
+            node_id="test-map-count",
+            model_id="test-map-count",
+            model_params={},
+            fn={"messages": [{"role": "user", "content": "{{ doc }}"}]},
+            outputs={"words": ("words",)},
+        )
+        node = Node.from_dict(Node.from_map(count, over="doc").to_dict())
+        out, err = node({"doc": ["one", "one two", "one two three"]})
+        self.assertIsNone(err)
+        self.assertEqual(out, {"words": [1, 2, 3]})
+
+
+class TestAsyncMapNode(unittest.IsolatedAsyncioTestCase):
+    async def test_acall(self):
+        node = get_map_node("test-map_wrap_together", max_workers=3)
+        out, err = await node.acall({"doc": ["a", "b", "c"], "prefix": "+"})
+        self.assertIsNone(err)
+        self.assertEqual(out, {"out": ["+a", "+b", "+c"]})
+
+    async def test_achain(self):
+        out, _ = await get_chain().acall({"text": "x,y", "prefix": ""})
+        self.assertEqual(out, ["x", "y"])
+        _, err = await get_map_node().acall({"doc": ["boom"], "prefix": ""})
+        self.assertIsInstance(err, ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import programatic_actions_registry, Chain, Edge
+
+_calls = []
+
+
+def opt_upper(text: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("upper")
+    return text.upper(), None
+
+
+def opt_exclaim(text: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("exclaim")
+    return text + "!", None
+
+
+def opt_join(left: str, right: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("join")
+    return f"{left}|{right}", None
+
+
+# the same action wired twice, like the UI does when a node is copy pasted
+for _id in ["test-opt_upper", "test-opt_upper2"]:
+    programatic_actions_registry.register(
+        fn=opt_upper, outputs={"out": (0,)}, node_id=_id
+    )
+for _id in ["test-opt_exclaim", "test-opt_exclaim2"]:
+    programatic_actions_registry.register(
+        fn=opt_exclaim, outputs={"out": (0,)}, node_id=_id
+    )
+programatic_actions_registry.register(
+    fn=opt_join, outputs={"out": (0,)}, node_id="test-opt_join"
+)
+programatic_actions_registry.register(
+    fn=opt_exclaim, outputs={"out": (0,)}, node_id="test-opt_log", side_effect=True
+)
+
+
+def _get(node_id: str):
+    return programatic_actions_registry.get(node_id)
+
+
+def get_chain(optimize: bool = True, **kwargs) -> Chain:
+    """upper -> exclaim and upper2 -> exclaim2 are the same, both go to join"""
+    return Chain(
+        nodes=[
+            _get("test-opt_upper"),  # type: ignore
+            _get("test-opt_upper2"),  # type: ignore
+            _get("test-opt_exclaim"),  # type: ignore
+            _get("test-opt_exclaim2"),  # type: ignore
+            _get("test-opt_join"),  # type: ignore
+        ],
+        edges=[
+            Edge("test-opt_upper", "out", "test-opt_exclaim", "text"),
+            Edge("test-opt_upper2", "out", "test-opt_exclaim2", "text"),
+            Edge("test-opt_exclaim", "out", "test-opt_join", "left"),
+            Edge("test-opt_exclaim2", "out", "test-opt_join", "right"),
+        ],
+        sample=kwargs.pop("sample", {"text": "hi"}),
+        main_in="text",
+        main_out=kwargs.pop("main_out", "test-opt_join/out"),
+        optimize=optimize,
+        **kwargs,
+    )
+
+
+class TestOptimize(unittest.TestCase):
+    def setUp(self):
+        _calls.clear()
+
+    def test_not_by_default(self):
+        chain = get_chain(optimize=False)
+        self.assertIsNone(chain.optimize_report)
+        self.assertEqual(chain("hi")[0], "HI!|HI!")
+        self.assertEqual(len(_calls), 5)
+
+    def test_merge_duplicates(self):
+        chain = get_chain()
+        report = chain.optimize_report
+        self.assertEqual(
+            report.merged,  # type: ignore
+            {
+                "test-opt_upper2": "test-opt_upper",
+                "test-opt_exclaim2": "test-opt_exclaim",
+            },
+        )
+        self.assertEqual(report.removed, [])  # type: ignore
+        self.assertEqual((report.edges_before, report.edges_after), (4, 3))  # type: ignore
+        self.assertEqual(
+            set(chain.nodes), {"test-opt_upper", "test-opt_exclaim", "test-opt_join"}
+        )
+
+        out, full_ir = chain("hi")
+        self.assertEqual(out, "HI!|HI!")
+        self.assertEqual(_calls, ["upper", "exclaim", "join"])
+        self.assertNotIn("test-opt_upper2/out", full_ir)
+
+    def test_main_out_moved(self):
+        # the log needs exclaim, and main_out is its duplicate
+        chain = Chain(
+            nodes=[
+                _get("test-opt_upper"),  # type: ignore
+                _get("test-opt_exclaim"),  # type: ignore
+                _get("test-opt_exclaim2"),  # type: ignore
+                _get("test-opt_log"),  # type: ignore
+            ],
+            edges=[
+                Edge("test-opt_upper", "out", "test-opt_exclaim", "text"),
+                Edge("test-opt_upper", "out", "test-opt_exclaim2", "text"),
+                Edge("test-opt_exclaim", "out", "test-opt_log", "text"),
+            ],
+            sample={"text": "hi"},
+            main_in="text",
+            main_out="test-opt_exclaim2/out",
+            optimize=True,
+        )
+        self.assertEqual(
+            chain.optimize_report.merged,  # type: ignore
+            {"test-opt_exclaim2": "test-opt_exclaim"},
+        )
+        self.assertEqual(chain.main_out, "test-opt_exclaim/out")
+        self.assertEqual(chain("yo")[0], "YO!")
+        self.assertEqual(_calls, ["upper", "exclaim", "exclaim"])
+
+    def test_dead_nodes(self):
+        chain = get_chain(main_out="test-opt_exclaim2/out")
+        self.assertEqual(chain.optimize_report.merged, {})  # type: ignore
+        self.assertEqual(
+            set(chain.optimize_report.removed),  # type: ignore
+            {"test-opt_upper", "test-opt_exclaim", "test-opt_join"},
+        )
+        self.assertEqual(chain("yo")[0], "YO!")
+        self.assertEqual(_calls, ["upper", "exclaim"])
+
+    def test_side_effect_kept(self):
+        chain = Chain(
+            nodes=[
+                _get("test-opt_upper"),  # type: ignore
+                _get("test-opt_exclaim"),  # type: ignore
+                _get("test-opt_exclaim2"),  # type: ignore
+                _get("test-opt_log"),  # type: ignore
+            ],
+            edges=[
+                Edge("test-opt_upper", "out", "test-opt_exclaim", "text"),
+                Edge("test-opt_upper", "out", "test-opt_exclaim2", "text"),
+                Edge("test-opt_upper", "out", "test-opt_log", "text"),
+            ],
+            sample={"text": "hi"},
+            main_in="text",
+            main_out="test-opt_upper/out",
+            optimize=True,
+        )
+        self.assertEqual(chain.optimize_report.merged, {})  # type: ignore
+        self.assertEqual(
+            chain.optimize_report.removed,  # type: ignore
+            ["test-opt_exclaim", "test-opt_exclaim2"],
+        )
+        self.assertEqual(set(chain.nodes), {"test-opt_upper", "test-opt_log"})
+
+    def test_node_inputs_not_merged(self):
+        chain = get_chain(sample={"text": "hi", "test-opt_upper2/text": "bye"})
+        self.assertEqual(chain.optimize_report.merged, {})  # type: ignore
+        self.assertFalse(chain.optimize_report)
+        self.assertEqual(chain("hi")[0], "HI!|BYE!")
+
+    def test_node_inputs_at_run_time(self):
+        chain = get_chain()
+        self.assertEqual(
+            chain({"text": "hi", "test-opt_upper2/text": "hi"})[0], "HI!|HI!"
+        )
+        for data in [
+            {"text": "hi", "test-opt_upper2/text": "bye"},
+            {"text": "hi", "test-opt_upper/text": "bye"},
+            {"text": "hi", "test-opt_exclaim2/out": "BYE!"},
+        ]:
+            with self.assertRaises(ValueError):
+                chain(data)
+
+    def test_isolated_nodes_reported(self):
+        chain = get_chain(optimize=False)
+        chain.nodes["test-opt_log"] = _get("test-opt_log")  # type: ignore
+        report = chain.optimize()
+        self.assertEqual(report.removed, ["test-opt_log"])
+        self.assertNotIn("test-opt_log", chain.nodes)
+
+    def test_closures_not_merged(self):
+        def make(suffix: str):
+            def add_suffix(text: str) -> Tuple[str, Optional[Exception]]:
+                return text + suffix, None
+
+            return add_suffix
+
+        nodes = [
+            programatic_actions_registry.to_action(
+                fn=make(suffix), outputs={"out": (0,)}, node_id=node_id
+            )
+            for node_id, suffix in [("test-opt_a", "A"), ("test-opt_b", "B")]
+        ]
+        chain = Chain(
+            nodes=nodes + [_get("test-opt_join")],  # type: ignore
+            edges=[
+                Edge("test-opt_a", "out", "test-opt_join", "left"),
+                Edge("test-opt_b", "out", "test-opt_join", "right"),
+            ],
+            sample={"text": "hi"},
+            main_in="text",
+            main_out="test-opt_join/out",
+            optimize=True,
+        )
+        self.assertEqual(chain.optimize_report.merged, {})  # type: ignore
+        self.assertEqual(chain("hi")[0], "hiA|hiB")
+
+    def test_from_dag(self):
+        dag = get_chain(optimize=False).to_dag()
+        chain = Chain.from_dag(dag, check_server=False, optimize=True)
+        self.assertEqual(len(chain.nodes), 3)
+        self.assertEqual(chain("ok")[0], "OK!|OK!")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import time
+import threading
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import programatic_actions_registry, Chain, Edge
+
+# the stages wait on this barrier for some items, so they can only finish if they are running at the same time
+_barrier = threading.Barrier(2, timeout=5)
+_release = threading.Event()
+
+
+def pipe_fetch(url: str) -> Tuple[str, Optional[Exception]]:
+    if url == "b":
+        _barrier.wait()
+    if url == "hold":
+        _release.wait(5)
+    if url == "bad":
+        return "", ValueError("cannot fetch bad")
+    return f"<{url}>", None
+
+
+def pipe_clean(page: str) -> Tuple[str, Optional[Exception]]:
+    if page == "<a>":
+        _barrier.wait()
+    return page.strip("<>"), None
+
+
+def pipe_embed(text: str) -> Tuple[str, Optional[Exception]]:
+    if text.startswith("pair"):
+        _barrier.wait()
+    return text.upper(), None
+
+
+for _fn in [pipe_fetch, pipe_clean, pipe_embed]:
+    programatic_actions_registry.register(
+        fn=_fn, outputs={"out": (0,)}, node_id=f"test-{_fn.__name__}"
+    )
+
+
+def get_chain() -> Chain:
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get("test-pipe_fetch"),  # type: ignore
+            programatic_actions_registry.get("test-pipe_clean"),  # type: ignore
+            programatic_actions_registry.get("test-pipe_embed"),  # type: ignore
+        ],
+        edges=[
+            Edge("test-pipe_fetch", "out", "test-pipe_clean", "page"),
+            Edge("test-pipe_clean", "out", "test-pipe_embed", "text"),
+        ],
+        sample={"url": ""},
+        main_in="url",
+        main_out="test-pipe_embed/out",
+    )
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        _barrier.reset()
+        _release.clear()
+
+    def tearDown(self):
+        _release.set()
+
+    def test_results(self):
+        results = list(get_chain().pipeline(["x", "y", "z"]))
+        self.assertEqual([i for i, _ in results], [0, 1, 2])
+        self.assertEqual([out for _, (out, _) in results], ["X", "Y", "Z"])
+        self.assertEqual(results[0][1][1]["test-pipe_clean/out"]["value"], "x")
+
+    def test_stages_overlap(self):
+        # clean of 'a' can only finish while fetch of 'b' is running
+        out = [out for _, (out, _) in get_chain().pipeline(["a", "b", "c"])]
+        self.assertEqual(out, ["A", "B", "C"])
+
+    def test_stage_workers(self):
+        items = ["pair1", "pair2"]
+        out = get_chain().pipeline(items, workers={"test-pipe_embed": 2})
+        self.assertEqual([out for _, (out, _) in out], ["PAIR1", "PAIR2"])
+        with self.assertRaises(ValueError):
+            list(get_chain().pipeline(items, workers={"nope": 2}))
+
+    def test_backpressure(self):
+        read = []
+
+        def _inputs():
+            for i in range(100):
+                read.append(i)
+                yield "hold" if i == 0 else str(i)
+
+        gen = get_chain().pipeline(_inputs(), queue_size=1)
+        thread = threading.Thread(target=lambda: list(gen))
+        thread.start()
+        time.sleep(0.3)
+        # one item in fetch, one in its queue and one waiting to be put
+        self.assertTrue(len(read) <= 3, read)
+        _release.set()
+        thread.join(5)
+        self.assertEqual(len(read), 100)
+
+    def test_errors(self):
+        results = list(get_chain().pipeline(["x", "bad", "y"], return_exceptions=True))
+        self.assertEqual(results[0][1][0], "X")
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(results[2][1][0], "Y")
+        with self.assertRaises(ValueError):
+            list(get_chain().pipeline(["x", "bad", "y"]))
+
+    def test_unordered_and_close(self):
+        results = get_chain().pipeline(["x", "y", "z"], ordered=False)
+        self.assertEqual({i for i, _ in results}, {0, 1, 2})
+
+        # closing early stops the stages instead of running all the inputs
+        gen = get_chain().pipeline(str(i) for i in range(10**6))
+        self.assertEqual(next(gen)[1][0], "0")
+        st = time.monotonic()
+        gen.close()
+        self.assertTrue(time.monotonic() - st < 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import os
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import (
+    programatic_actions_registry,
+    shutdown_process_pool,
+    warm_process_pool,
+    remaining_time,
+    Chain,
+    Node,
+)
+
+
+def proc_sum_squares(n: int) -> Tuple[Tuple[int, int, float], Optional[Exception]]:
+    total = sum(i * i for i in range(n))
+    return (total, os.getpid(), remaining_time()), None  # type: ignore
+
+
+programatic_actions_registry.register(
+    fn=proc_sum_squares,
+    outputs={"total": (0,), "pid": (1,), "left": (2,)},
+    node_id="test-proc_sum_squares",
+    executor="process",
+)
+
+
+def get_inline_node() -> Node:
+    def inline_sum(n: int) -> Tuple[Tuple[int, int], Optional[Exception]]:
+        return (n, os.getpid()), None
+
+    return programatic_actions_registry.to_action(
+        fn=inline_sum,
+        outputs={"total": (0,), "pid": (1,)},
+        node_id="test-inline_sum",
+        executor="process",
+    )
+
+
+class TestProcessExecutor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        warm_process_pool()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_process_pool()
+
+    def test_runs_in_worker(self):
+        node = programatic_actions_registry.get("test-proc_sum_squares")
+        out, err = node({"n": 1000})  # type: ignore
+        self.assertIsNone(err)
+        self.assertEqual(out["total"], sum(i * i for i in range(1000)))
+        self.assertNotEqual(out["pid"], os.getpid())
+        self.assertIsNone(out["left"])
+
+    def test_deadline_passed_to_worker(self):
+        node = programatic_actions_registry.get("test-proc_sum_squares")
+        node.timeout = 30  # type: ignore
+        out, err = node({"n": 10})  # type: ignore
+        self.assertIsNone(err)
+        self.assertTrue(0 < out["left"] <= 30)
+
+    def test_unpicklable_runs_inline(self):
+        out, err = get_inline_node()({"n": 3})
+        self.assertIsNone(err)
+        self.assertEqual(out, {"total": 3, "pid": os.getpid()})
+
+    def test_invalid_executor(self):
+        with self.assertRaises(ValueError):
+            programatic_actions_registry.to_action(
+                fn=proc_sum_squares, outputs={"total": (0,)}, executor="gpu"
+            )
+
+    def test_chain(self):
+        chain = Chain(
+            nodes=[programatic_actions_registry.get("test-proc_sum_squares")],  # type: ignore
+            edges=[],
+            sample={"n": 4},
+            main_in="n",
+            main_out="test-proc_sum_squares/total",
+        )
+        self.assertEqual(chain({"n": 4})[0], 14)
+        node_dict = chain.nodes["test-proc_sum_squares"].to_dict()
+        self.assertEqual(node_dict["executor"], "process")
+        self.assertEqual(Node.from_dict(node_dict).to_dict(), node_dict)
+
+
+class TestAsyncProcessExecutor(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_process_pool()
+
+    async def test_acall(self):
+        node = programatic_actions_registry.get("test-proc_sum_squares")
+        out, err = await node.acall({"n": 5})  # type: ignore
+        self.assertIsNone(err)
+        self.assertEqual(out["total"], 30)
+        self.assertNotEqual(out["pid"], os.getpid())
+
+        out, err = await get_inline_node().acall({"n": 2})
+        self.assertIsNone(err)
+        self.assertEqual(out["total"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
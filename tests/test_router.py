@@ -0,0 +1,180 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import programatic_actions_registry, Chain, Edge, Node
+
+_calls = []
+
+
+def rt_intent(message: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("intent")
+    if "invoice" in message:
+        return "billing", None
+    if "all" in message:
+        return ["billing", "support"], None  # type: ignore
+    if "?" in message:
+        return "support", None
+    return "spam", None
+
+
+def rt_billing(message: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("billing")
+    return f"billing: {message}", None
+
+
+def rt_support(message: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("support")
+    return f"support: {message}", None
+
+
+def rt_polish(text: str) -> Tuple[str, Optional[Exception]]:
+    _calls.append("polish")
+    return text.upper(), None
+
+
+def rt_pick(billing: str = "", support: str = "") -> Tuple[str, Optional[Exception]]:
+    _calls.append("pick")
+    return " + ".join(x for x in [billing, support] if x), None
+
+
+# the intent can be a list of routes, so it is not indexed
+programatic_actions_registry.register(
+    fn=rt_intent, outputs={"route": ()}, node_id="test-rt_intent"
+)
+for _fn in [rt_billing, rt_support, rt_polish, rt_pick]:
+    programatic_actions_registry.register(
+        fn=_fn, outputs={"out": (0,)}, node_id=f"test-{_fn.__name__}"
+    )
+
+
+def get_chain(default: str = "") -> Chain:
+    """intent routes to billing -> polish or support, both go to pick"""
+    router = Node.from_router(
+        programatic_actions_registry.get("test-rt_intent"),  # type: ignore
+        routes=["billing", "support"],
+        node_id="router",
+        default=default,
+    )
+    return Chain(
+        nodes=[
+            router,
+            programatic_actions_registry.get("test-rt_billing"),  # type: ignore
+            programatic_actions_registry.get("test-rt_polish"),  # type: ignore
+            programatic_actions_registry.get("test-rt_support"),  # type: ignore
+            programatic_actions_registry.get("test-rt_pick"),  # type: ignore
+        ],
+        edges=[
+            Edge("router", "billing", "test-rt_billing", "message"),
+            Edge("test-rt_billing", "out", "test-rt_polish", "text"),
+            Edge("router", "support", "test-rt_support", "message"),
+            Edge("test-rt_polish", "out", "test-rt_pick", "billing"),
+            Edge("test-rt_support", "out", "test-rt_pick", "support"),
+        ],
+        sample={"message": "hi"},
+        main_in="message",
+        main_out="test-rt_pick/out",
+    )
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        _calls.clear()
+
+    def test_router_node(self):
+        router = get_chain().nodes["router"]
+        self.assertEqual(router.type, Node.types.ROUTER)
+        self.assertEqual([o.name for o in router.outputs], ["billing", "support"])
+        self.assertEqual(router({"message": "invoice"}), ({"billing": "invoice"}, None))
+        _, err = router({"message": "buy now"})
+        self.assertIsInstance(err, ValueError)
+
+    def test_untaken_branch_skipped(self):
+        for max_workers in [1, 4]:
+            _calls.clear()
+            out, full_ir = get_chain()("help?", max_workers=max_workers)
+            self.assertEqual(out, "support: help?")
+            self.assertEqual(_calls, ["intent", "support", "pick"])
+            self.assertNotIn("router/billing", full_ir)
+            self.assertNotIn("test-rt_polish/out", full_ir)
+
+            _calls.clear()
+            out, _ = get_chain()("my invoice", max_workers=max_workers)
+            self.assertEqual(out, "BILLING: MY INVOICE")
+            self.assertEqual(_calls, ["intent", "billing", "polish", "pick"])
+
+    def test_many_routes(self):
+        out, _ = get_chain()("all of it", max_workers=2)
+        self.assertEqual(out, "BILLING: ALL OF IT + support: all of it")
+
+    def test_default_route(self):
+        out, _ = get_chain(default="support")("buy now")
+        self.assertEqual(out, "support: buy now")
+        with self.assertRaises(ValueError):
+            get_chain()("buy now")
+
+    def test_main_out_not_taken(self):
+        chain = get_chain()
+        chain.main_out = "test-rt_polish/out"
+        self.assertIsNone(chain("help?")[0])
+
+    def test_stream(self):
+        events = list(get_chain().stream("help?"))
+        keys = [list(ir)[0] for ir, done in events if not done]
+        self.assertEqual(
+            keys, ["router/support", "test-rt_support/out", "test-rt_pick/out"]
+        )
+
+    def test_batch(self):
+        results = get_chain().batch(["help?", "my invoice"], max_concurrency=4)
+        self.assertEqual(
+            [out for out, _ in results], ["support: help?", "BILLING: MY INVOICE"]
+        )
+
+    def test_rerun(self):
+        chain = get_chain()
+        _, full_ir = chain("help?")
+        self.assertEqual(chain._dirty_nodes([], full_ir), set())
+        _calls.clear()
+        out, _ = chain.rerun("my invoice", full_ir)
+        self.assertEqual(out, "BILLING: MY INVOICE")
+        self.assertEqual(_calls, ["intent", "billing", "polish", "pick"])
+
+    def test_frontier(self):
+        chain = get_chain()
+        self.assertEqual(chain.frontier({}), (["router"], set()))
+        full_ir = {}
+        chain.step("router", {"message": "help?"}, full_ir)
+        ready, inactive = chain.frontier(full_ir)
+        self.assertEqual(ready, ["test-rt_support"])
+        # the whole billing branch is skipped as soon as the router is done
+        self.assertEqual(
+            inactive, {"router/billing", "test-rt_billing/out", "test-rt_polish/out"}
+        )
+        chain.step("test-rt_support", {}, full_ir, inactive=inactive)
+        ready, inactive = chain.frontier(full_ir)
+        self.assertEqual(ready, ["test-rt_pick"])
+        chain.step("test-rt_pick", {}, full_ir, inactive=inactive)
+        self.assertEqual(chain.frontier(full_ir)[0], [])
+        self.assertEqual(full_ir["test-rt_pick/out"]["value"], "support: help?")
+
+    def test_serialisation(self):
+        chain = get_chain(default="support")
+        node_dict = chain.nodes["router"].to_dict()
+        self.assertEqual(node_dict["fn"]["routes"], ["billing", "support"])
+        self.assertEqual(Node.from_dict(node_dict).to_dict(), node_dict)
+        chain = Chain.from_dag(chain.to_dag(), check_server=False)
+        self.assertEqual(chain("buy now")[0], "support: buy now")
+
+
+class TestAsyncRouter(unittest.IsolatedAsyncioTestCase):
+    async def test_acall(self):
+        _calls.clear()
+        out, full_ir = await get_chain().acall("my invoice")
+        self.assertEqual(out, "BILLING: MY INVOICE")
+        self.assertNotIn("support", _calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
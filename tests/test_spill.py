@@ -0,0 +1,130 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import os
+import json
+import tempfile
+import unittest
+from typing import Optional, Tuple
+from unittest.mock import patch
+
+from chainfury import (
+    programatic_actions_registry,
+    BlobRef,
+    Chain,
+    Edge,
+    FileCheckpoint,
+)
+from chainfury.utils import spill_to_blob
+
+_seen = []
+
+
+def spill_pages(n: int) -> Tuple[list, Optional[Exception]]:
+    return [f"page {i} " * 50 for i in range(n)], None
+
+
+def spill_count(pages: list) -> Tuple[int, Optional[Exception]]:
+    _seen.append(pages)
+    return len(pages), None
+
+
+programatic_actions_registry.register(
+    fn=spill_pages, outputs={"pages": ()}, node_id="test-spill_pages"
+)
+programatic_actions_registry.register(
+    fn=spill_count, outputs={"count": (0,)}, node_id="test-spill_count"
+)
+
+
+def get_chain(spill_bytes: int = 1000, main_out: str = "test-spill_count/count"):
+    return Chain(
+        nodes=[
+            programatic_actions_registry.get("test-spill_pages"),  # type: ignore
+            programatic_actions_registry.get("test-spill_count"),  # type: ignore
+        ],
+        edges=[Edge("test-spill_pages", "pages", "test-spill_count", "pages")],
+        sample={"n": 10},
+        main_in="n",
+        main_out=main_out,
+        spill_bytes=spill_bytes,
+    )
+
+
+class TestSpill(unittest.TestCase):
+    def setUp(self):
+        _seen.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "blob"))
+        env = {"CF_FOLDER": self.tmp.name, "CF_BLOB_ENGINE": "local"}
+        self.env = patch.dict(os.environ, env)
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_spill_to_blob(self):
+        self.assertEqual(spill_to_blob("small", 100), "small")
+        self.assertEqual(spill_to_blob({"a": 1}, 100), {"a": 1})
+        obj = {"a": object()}
+        self.assertIs(spill_to_blob(obj, 1), obj)
+        ref = spill_to_blob({"a": "x" * 200}, 100)
+        self.assertIsInstance(ref, BlobRef)
+        self.assertEqual(ref.load(), {"a": "x" * 200})
+        self.assertEqual(BlobRef.from_dict(ref.to_dict()), ref)
+        os.environ["CF_BLOB_ENGINE"] = "no"
+        self.assertEqual(spill_to_blob("x" * 200, 100), "x" * 200)
+
+    def test_chain(self):
+        for max_workers in [1, 2]:
+            _seen.clear()
+            out, full_ir = get_chain()({"n": 10}, max_workers=max_workers)
+            self.assertEqual(out, 10)
+            # the downstream node gets the value, the IR keeps the reference
+            self.assertEqual(len(_seen[0]), 10)
+            stored = full_ir["test-spill_pages/pages"]["value"]
+            self.assertTrue(BlobRef.is_ref(stored))
+            self.assertEqual(full_ir["test-spill_count/count"]["value"], 10)
+            self.assertEqual(BlobRef.from_dict(stored).load(), spill_pages(10)[0])
+            self.assertTrue(len(json.dumps(stored)) < 200)
+
+    def test_main_out_loaded(self):
+        out, _ = get_chain(main_out="test-spill_pages/pages")({"n": 3})
+        self.assertEqual(out, spill_pages(3)[0])
+
+    def test_no_spill(self):
+        _, full_ir = get_chain(spill_bytes=0)({"n": 10})
+        self.assertIsInstance(full_ir["test-spill_pages/pages"]["value"], list)
+
+    def test_checkpoint(self):
+        fp = os.path.join(self.tmp.name, "run.jsonl")
+        checkpoint = FileCheckpoint(fp)
+        chain = get_chain()
+        chain({"n": 4}, checkpoint=checkpoint)
+
+        # the run died after the first node
+        with open(fp) as f:
+            first = f.readline()
+        self.assertIn("cf_blob", first)
+        with open(fp, "w") as f:
+            f.write(first)
+        _seen.clear()
+        out, full_ir = chain.resume({"n": 4}, checkpoint)
+        self.assertEqual(out, 4)
+        self.assertEqual(_seen, [spill_pages(4)[0]])
+        self.assertTrue(BlobRef.is_ref(full_ir["test-spill_pages/pages"]["value"]))
+
+
+class TestAsyncSpill(unittest.IsolatedAsyncioTestCase):
+    async def test_acall(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "blob"))
+            env = {"CF_FOLDER": tmp, "CF_BLOB_ENGINE": "local"}
+            with patch.dict(os.environ, env):
+                out, full_ir = await get_chain().acall({"n": 6})
+        self.assertEqual(out, 6)
+        self.assertTrue(BlobRef.is_ref(full_ir["test-spill_pages/pages"]["value"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
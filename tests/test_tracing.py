@@ -0,0 +1,204 @@
+# Copyright © 2023- Frello Technology Private Limited
+
+import json
+import os
+import contextvars
+import tempfile
+import unittest
+from typing import Optional, Tuple
+
+from chainfury import (
+    programatic_actions_registry,
+    Chain,
+    Edge,
+    Model,
+    Thread,
+    human,
+    exponential_backoff,
+    SummaryTracer,
+    JSONLTracer,
+    OTelTracer,
+    Tracer,
+)
+from chainfury.tracing import add_usage, current_span
+
+
+def tr_words(text: str) -> Tuple[str, Optional[Exception]]:
+    return " ".join(text.split()), None
+
+
+_flaky = {"calls": 0}
+
+
+def tr_flaky(text: str) -> Tuple[str, Optional[Exception]]:
+    def _fn():
+        _flaky["calls"] += 1
+        if _flaky["calls"] == 1:
+            raise ValueError("try again")
+        return text[::-1]
+
+    return exponential_backoff(_fn, max_retries=2, retry_delay=0), None
+
+
+programatic_actions_registry.register(
+    fn=tr_words, outputs={"out": (0,)}, node_id="test-tr_words"
+)
+programatic_actions_registry.register(
+    fn=tr_flaky, outputs={"out": (0,)}, node_id="test-tr_flaky"
+)
+
+
+class UsageModel(Model):
+    def __init__(self):
+        super().__init__(id="test-usage", description="reports usage")
+
+    def chat(self, chats, **kwargs):
+        add_usage({"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5})
+        return chats[-1]["content"]
+
+    def stream_chat(self, chats, **kwargs):
+        for word in self.chat(chats).split(" "):
+            yield word + " "
+
+
+def get_chain() -> Chain:
+    return Chain(
+        name="tracing",
+        nodes=[
+            programatic_actions_registry.get("test-tr_words"),  # type: ignore
+            programatic_actions_registry.get("test-tr_flaky"),  # type: ignore
+        ],
+        edges=[Edge("test-tr_words", "out", "test-tr_flaky", "text")],
+        sample={"text": "hello"},
+        main_in="text",
+        main_out="test-tr_flaky/out",
+    )
+
+
+class RecordingTracer(Tracer):
+    def __init__(self):
+        self.events = []
+
+    def on_start(self, span):
+        self.events.append(("start", span.name))
+
+    def on_end(self, span):
+        self.events.append(("end", span.name))
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        _flaky["calls"] = 0
+
+    def test_hooks(self):
+        chain = get_chain()
+        tracer = chain.add_tracer(RecordingTracer())
+        chain("a  b")
+        self.assertEqual(
+            tracer.events,  # type: ignore
+            [
+                ("start", "tracing"),
+                ("start", "test-tr_words"),
+                ("end", "test-tr_words"),
+                ("start", "test-tr_flaky"),
+                ("end", "test-tr_flaky"),
+                ("end", "tracing"),
+            ],
+        )
+        chain.remove_tracer(tracer)
+        chain("a  b")
+        self.assertEqual(len(tracer.events), 6)  # type: ignore
+
+    def test_summary(self):
+        chain = get_chain()
+        summary = chain.add_tracer(SummaryTracer())
+        chain("a  b", max_workers=2)
+        rows = summary.summary()  # type: ignore
+        self.assertEqual(rows["test-tr_flaky"]["retries"], 1)
+        self.assertEqual(rows["test-tr_words"]["count"], 1)
+        self.assertEqual(rows["test-tr_words"]["output_bytes"], len('{"out": "a b"}'))
+        self.assertEqual(rows["tracing"]["kind"], "chain")
+        self.assertIn("test-tr_flaky", summary.table())  # type: ignore
+
+    def test_jsonl(self):
+        with tempfile.TemporaryDirectory() as d:
+            fp = os.path.join(d, "spans.jsonl")
+            chain = get_chain()
+            chain.add_tracer(JSONLTracer(fp))
+            chain("x")
+            with open(fp) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertEqual([s["name"] for s in spans][-1], "tracing")
+        run = spans[-1]
+        self.assertTrue(all(s["trace_id"] == run["trace_id"] for s in spans))
+        self.assertTrue(all(s["parent_id"] == run["span_id"] for s in spans[:-1]))
+
+    def test_otel_and_usage(self):
+        chain = Chain(
+            main_in="name", main_out="hello/hello", default_model=UsageModel()
+        )
+        chain.add_thread("hello", Thread(human("hello {{ name }}")))
+        otel = chain.add_tracer(OTelTracer())
+        chain("fury")
+        payload = otel.export()  # type: ignore
+        spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        node = [s for s in spans if s["name"] == "hello"][0]
+        attributes = {a["key"]: a["value"] for a in node["attributes"]}
+        self.assertEqual(
+            attributes["chainfury.model_id"], {"stringValue": "test-usage"}
+        )
+        self.assertEqual(attributes["llm.usage.total_tokens"], {"intValue": "5"})
+        self.assertEqual(node["status"], {"code": 1})
+        payload = otel.export()  # type: ignore
+        self.assertEqual(payload["resourceSpans"][0]["scopeSpans"][0]["spans"], [])
+
+    def test_stream_other_context(self):
+        chain = Chain(
+            main_in="name", main_out="hello/hello", default_model=UsageModel()
+        )
+        chain.add_thread("hello", Thread(human("hello {{ name }}")))
+        summary = chain.add_tracer(SummaryTracer())
+
+        # like a server that pulls every chunk in a new context
+        gen = chain.stream("fury", stream_tokens=True)
+        events = []
+        while True:
+            ctx = contextvars.Context()
+            try:
+                events.append(ctx.run(next, gen))
+            except StopIteration:
+                break
+            self.assertIsNone(ctx.run(current_span))
+        self.assertEqual(events[-1], ("hello fury ", True))
+        rows = summary.summary()  # type: ignore
+        self.assertEqual(rows["hello"]["count"], 1)
+        self.assertEqual(rows["hello"]["tokens"], 5)
+
+        # closing early from another context
+        gen = chain.stream("fury", stream_tokens=True)
+        contextvars.Context().run(next, gen)
+        contextvars.Context().run(gen.close)
+        self.assertEqual(summary.summary()["hello"]["count"], 2)  # type: ignore
+
+    def test_error_span(self):
+        chain = get_chain()
+        summary = chain.add_tracer(SummaryTracer())
+        with self.assertRaises(Exception):
+            chain({"test-tr_words/text": None})
+        rows = summary.summary()  # type: ignore
+        self.assertEqual(rows["test-tr_words"]["errors"], 1)
+
+
+class TestAsyncTracing(unittest.IsolatedAsyncioTestCase):
+    async def test_acall(self):
+        _flaky["calls"] = 0
+        chain = get_chain()
+        summary = chain.add_tracer(SummaryTracer())
+        await chain.acall("a b")
+        rows = summary.summary()  # type: ignore
+        self.assertEqual(set(rows), {"tracing", "test-tr_words", "test-tr_flaky"})
+        self.assertEqual(rows["test-tr_flaky"]["retries"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()